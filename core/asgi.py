@@ -9,3 +9,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# oversized uploads are refused before django reads them
+from pdf_img_handler.api.asgi import LimitBodySize
+application = LimitBodySize(application)
@@ -133,4 +133,74 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Media settings
 MEDIA_URL = '/media/'  # URL prefix for media files
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')  # Directory to store media files
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')  # Directory to store media files
+# media files sent by the front proxy instead of the app: '' (off), 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd)
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+# internal nginx location mapped to MEDIA_ROOT, used with 'x-accel-redirect'
+MEDIA_SENDFILE_PREFIX = os.getenv('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+# seconds browsers may keep media files not named by their content (those are cached for a year)
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', 3600))
+
+# Upload settings
+# bodies above this size are rejected before they are read
+FILE_UPLOAD_MAX_SIZE = int(os.getenv('FILE_UPLOAD_MAX_SIZE', 200 * 1024 * 1024))
+# size of each chunk read from the request body while streaming an upload
+FILE_UPLOAD_CHUNK_SIZE = 64 * 1024
+# files accepted by a single batch upload, and threads processing them
+BATCH_UPLOAD_MAX_FILES = int(os.getenv('BATCH_UPLOAD_MAX_FILES', 1000))
+BATCH_UPLOAD_WORKERS = int(os.getenv('BATCH_UPLOAD_WORKERS', 4))
+
+# Async API settings (see pdf_img_handler/api/asgi.py)
+# serve the upload, rotate and convert endpoints as async views, for an ASGI server (uvicorn core.asgi:application)
+ASYNC_API = os.getenv('ASYNC_API', '0') == '1'
+# threads running the decoding, parsing, rendering and file writes of the async views
+ASYNC_API_WORKERS = int(os.getenv('ASYNC_API_WORKERS', os.cpu_count() or 1))
+
+# PDF settings
+# open documents and image headers kept by every process (see pdf_img_handler/documents.py)
+DOCUMENT_CACHE_SIZE = int(os.getenv('DOCUMENT_CACHE_SIZE', 16))
+# estimated memory of the open documents kept by every process, in bytes
+DOCUMENT_CACHE_MAX_MEMORY = int(os.getenv('DOCUMENT_CACHE_MAX_MEMORY', 256 * 1024 * 1024))
+# PDF engine used to read uploaded PDFs ('pymupdf' or 'pypdf2'), empty for the first available
+PDF_ENGINE = os.getenv('PDF_ENGINE', '')
+# processes rendering the pages of a PDF conversion in parallel
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', os.cpu_count() or 1))
+# lower the resolution of a PDF conversion too large for its image format, instead of refusing it
+PDF_CONVERT_DOWNSCALE = True
+# largest combined image (width x height) of a conversion to a format other than PNG, which is encoded
+# from the whole image in memory (about 4 bytes per pixel), the larger ones are downscaled or refused
+PDF_CONVERT_MAX_CANVAS_PIXELS = int(os.getenv('PDF_CONVERT_MAX_CANVAS_PIXELS', 40_000_000))
+
+# Near-duplicate images settings (see pdf_img_handler/image_hash.py)
+# seconds before the hash index of a process is read again from the database, dropping the deleted images
+IMAGE_HASH_INDEX_MAX_AGE = int(os.getenv('IMAGE_HASH_INDEX_MAX_AGE', 3600))
+# perceptual hash bits which may differ between an upload and a stored image for a near duplicate (of 64)
+IMAGE_NEAR_DUPLICATE_DISTANCE = int(os.getenv('IMAGE_NEAR_DUPLICATE_DISTANCE', 10))
+
+# Background jobs settings (see pdf_img_handler/jobs.py)
+# number of conversions run at the same time by `manage.py run_jobs`
+CONVERSION_JOB_WORKERS = int(os.getenv('CONVERSION_JOB_WORKERS', 2))
+# seconds a conversion attempt may run before it is killed
+CONVERSION_JOB_TIMEOUT = int(os.getenv('CONVERSION_JOB_TIMEOUT', 300))
+# attempts of a conversion before it is marked as failed
+CONVERSION_JOB_MAX_ATTEMPTS = 3
+# seconds an idle worker waits before it checks the queue again
+CONVERSION_JOB_POLL_INTERVAL = 1
+# seconds before a failed attempt is retried, doubled after every attempt
+CONVERSION_JOB_RETRY_DELAY = int(os.getenv('CONVERSION_JOB_RETRY_DELAY', 10))
+# seconds between two checks for the jobs left running by a worker which died
+CONVERSION_JOB_REQUEUE_INTERVAL = int(os.getenv('CONVERSION_JOB_REQUEUE_INTERVAL', 60))
+
+# Derivative cache settings (see pdf_img_handler/cache.py)
+# size of the files kept in MEDIA_ROOT/cache before the least recently used ones are deleted
+DERIVATIVE_CACHE_MAX_SIZE = int(os.getenv('DERIVATIVE_CACHE_MAX_SIZE', 5 * 1024 * 1024 * 1024))
+
+# Storage reaper settings (see pdf_img_handler/reaper.py)
+# tombstones (files of deleted rows and evicted derivatives) removed per batch
+REAPER_BATCH_SIZE = 100
+# files removed per second at most, to leave the disk to the requests
+REAPER_MAX_FILES_PER_SECOND = float(os.getenv('REAPER_MAX_FILES_PER_SECOND', 50))
+# seconds a file is kept after its tombstone, for the responses still sending it
+REAPER_GRACE_PERIOD = int(os.getenv('REAPER_GRACE_PERIOD', 300))
+# seconds the reaper waits before it checks the tombstones again
+REAPER_POLL_INTERVAL = 10
@@ -4,7 +4,8 @@ URL configuration for core project.
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from pdf_img_handler.media import serve_media
+from pdf_img_handler.metrics import metrics_view
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
@@ -26,10 +27,12 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('pdf_img_handler.api.urls')),
+    # originals and derived files, with conditional and range requests
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", serve_media, name='media'),
+    # Prometheus metrics of the processing stages
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 
-# Add media file serving in development
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
\ No newline at end of file
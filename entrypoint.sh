@@ -3,5 +3,14 @@
 # Run the tests with pytest
 pytest --disable-warnings
 
+# Run the background conversion jobs workers
+python manage.py run_jobs &
+
+# Run the reaper removing the files of deleted rows
+python manage.py run_reaper &
+
+# Index the text of the uploaded PDFs for the search endpoint
+python manage.py index_text --watch &
+
 # After tests, run the Django server
 python manage.py runserver 0.0.0.0:8000
@@ -3,4 +3,6 @@ from . import models
 
 admin.site.register(models.PdfFile)
 
-admin.site.register(models.ImgFile)
\ No newline at end of file
+admin.site.register(models.ImgFile)
+
+admin.site.register(models.ConversionJob)
@@ -0,0 +1,123 @@
+import asyncio, functools, json, threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Threads running the blocking part of the async API views (ASYNC_API_WORKERS of them),
+    shared by every request of the process.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.ASYNC_API_WORKERS, thread_name_prefix='api')
+    return _executor
+
+
+def run_view(view, request, *args, **kwargs):
+    # like a sync request, the thread gets its own database connection, closed when it's done
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response = response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+async def iter_async(iterator):
+    """
+    Async iterator over a sync iterator, every item is read on the bounded executor.
+    The sync iterator is still closed by the response (its resource closers).
+    """
+    loop = asyncio.get_running_loop()
+    end = object()
+    while (item := await loop.run_in_executor(get_executor(), next, iterator, end)) is not end:
+        yield item
+
+
+def offload(view):
+    """
+    Async version of a sync (DRF) view for the ASGI server.
+    The request body is already read by the event loop, decoding, sniffing, parsing and writing the
+    file happen on the bounded executor, so a slow upload holds no thread while it's received and
+    the requests don't queue on the single thread django runs sync views on.
+    A streamed response is read chunk by chunk on the executor as it's sent, django would read a sync
+    stream in full before sending it.
+    """
+    async def async_view(request, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(get_executor(), functools.partial(run_view, view, request, *args, **kwargs))
+        if getattr(response, 'streaming', False) and not response.is_async:
+            response.streaming_content = iter_async(iter(response.streaming_content))
+        return response
+
+    # keep csrf_exempt, cls and initkwargs of the DRF view (used by django and the schema generator)
+    async_view.__dict__.update(view.__dict__)
+    async_view.__name__ = view.__name__
+    return markcoroutinefunction(async_view)
+
+
+class LimitBodySize:
+    """
+    ASGI middleware rejecting bodies above FILE_UPLOAD_MAX_SIZE with a 413 response.
+    The declared size is checked before anything is read, and the received bytes are counted
+    for chunked bodies, so django never spools an oversized body.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        max_size = settings.FILE_UPLOAD_MAX_SIZE
+        headers = dict(scope.get('headers') or [])
+        try:
+            content_length = int(headers.get(b'content-length', 0))
+        except ValueError:
+            content_length = 0
+        if content_length > max_size:
+            return await self.send_too_large(send, max_size)
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > max_size:
+                    # django stops reading the request on a disconnect
+                    too_large = True
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, tracked_send)
+        if too_large and not response_started:
+            await self.send_too_large(send, max_size)
+
+    async def send_too_large(self, send, max_size):
+        body = json.dumps({'detail': f"Uploaded file is larger than {max_size} bytes."}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
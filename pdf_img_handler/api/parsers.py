@@ -0,0 +1,99 @@
+import hashlib
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import BaseParser, DataAndFiles, MultiPartParser
+from pdf_img_handler.utils import SpooledUploadFile
+
+
+class FileTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Uploaded file is too large.'
+    default_code = 'file_too_large'
+
+
+def check_content_length(parser_context):
+    """
+    Reject the request early when its declared body size is above FILE_UPLOAD_MAX_SIZE.
+    """
+    request = parser_context['request']
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+
+    if content_length > settings.FILE_UPLOAD_MAX_SIZE:
+        raise FileTooLarge(f"Uploaded file is larger than {settings.FILE_UPLOAD_MAX_SIZE} bytes.")
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Upload handler counting the bytes of the uploaded files while they are read, before the next handlers
+    spool them, the declared body size can be missing or wrong (a chunked body).
+    """
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > settings.FILE_UPLOAD_MAX_SIZE:
+            raise FileTooLarge(f"Uploaded file is larger than {settings.FILE_UPLOAD_MAX_SIZE} bytes.")
+        return raw_data
+
+    def file_complete(self, file_size):
+        # the next handlers return the file
+        return None
+
+
+class LimitedMultiPartParser(MultiPartParser):
+    """
+    Multipart parser that checks the body size before django's upload handlers
+    spool the file to memory or to a temporary file, then counts the bytes really read.
+    """
+    def parse(self, stream, media_type=None, parser_context=None):
+        check_content_length(parser_context)
+        request = parser_context['request']
+        request.upload_handlers.insert(0, LimitedUploadHandler(request))
+        return super().parse(stream, media_type, parser_context)
+
+
+class StreamingFileParser(BaseParser):
+    """
+    Parser for a raw binary request body (the whole body is the file).
+    The body is read in bounded chunks into a spooled temporary file, which stays
+    in memory for small uploads and rolls over to disk for large ones.
+    """
+    media_type = '*/*'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        check_content_length(parser_context)
+
+        max_size = settings.FILE_UPLOAD_MAX_SIZE
+        chunk_size = settings.FILE_UPLOAD_CHUNK_SIZE
+        spooled_file = SpooledUploadFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+
+        # hash the body while it is read, to find already stored files without reading it again
+        sha256 = hashlib.sha256()
+        size = 0
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            # the declared length can be missing or wrong, so count what is really read
+            if size > max_size:
+                spooled_file.close()
+                raise FileTooLarge(f"Uploaded file is larger than {max_size} bytes.")
+            spooled_file.write(chunk)
+            sha256.update(chunk)
+
+        spooled_file.seek(0)
+
+        # the real name is given later from the sniffed MIME type
+        uploaded_file = File(spooled_file, name='upload')
+        uploaded_file.size = size
+        uploaded_file.content_hash = sha256.hexdigest()
+        return DataAndFiles({}, {'file': uploaded_file})
@@ -1,69 +1,114 @@
 from rest_framework import serializers
-import magic
-from pdf_img_handler.models import ImgFile, PdfFile
-from pdf_img_handler.utils import ProcessFileData
-import uuid, io, base64
-from django.core.files.base import ContentFile
+from pdf_img_handler.models import ImgFile, PdfFile, ConversionJob
+from pdf_img_handler.image_hash import find_similar_images
+from pdf_img_handler.jobs import enqueue_conversion
+from pdf_img_handler.metrics import measure
+from pdf_img_handler.page_export import EXPORT_CONTENT_TYPES, iter_export
+from pdf_img_handler.pdf_engine import get_rendered_sizes
+from pdf_img_handler.reaper import bury
+from pdf_img_handler.image_writer import get_max_dimension
+from pdf_img_handler.thumbnails import THUMBNAIL_FORMATS
+from pdf_img_handler.utils import ProcessFileData, SpooledUploadFile, get_extension_from_mime, get_file_hash, get_mime_type, iter_base64_decode, save_content, MIME_SNIFF_SIZE
+import uuid, base64, binascii, hashlib, os
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
 
 
 class Base64FileField(serializers.Field):
     """
     Custom serializer field to handle base64-encoded file input.
     This will decode the base64 string and return a file-like object.
+    Only the header is decoded before the MIME type is checked, the rest is decoded
+    in chunks to a spooled temporary file.
     """
     def to_internal_value(self, data):
         """
         Convert the base64 string to a file-like object.
         """
+        if not isinstance(data, str):
+            raise serializers.ValidationError("Invalid file format")
+
+        # Skip the base64 encoding prefix (data:image/png;base64,...) without copying the string
+        start = 0
+        if data.lstrip().startswith('data:'):
+            # Find the comma separating metadata and the base64 string
+            start = data.find(',') + 1
+
+        # Reject early from the decoded size, 3 bytes for every 4 characters
+        if (len(data) - start) * 3 // 4 > settings.FILE_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"File is larger than {settings.FILE_UPLOAD_MAX_SIZE} bytes.")
+
         try:
-            # Remove the base64 encoding prefix (data:image/png;base64,...)
-            if isinstance(data, str):
-                data = data.strip()
-                if data.startswith('data:'):
-                    # Find the comma separating metadata and the base64 string
-                    base64_data = data.split(',', 1)[1]
-                else:
-                    base64_data = data
-            else:
-                raise serializers.ValidationError("Invalid file format")
-            
-            # Decode the base64 string to bytes
-            file_data = base64.b64decode(base64_data)
+            chunks = iter_base64_decode(data, start, chunk_size=settings.FILE_UPLOAD_CHUNK_SIZE)
 
-            # Use python-magic to determine the MIME type of the file
-            mime = magic.Magic(mime=True)
-            mime_type = mime.from_buffer(file_data)
+            # Decode only the header and use python-magic to determine the MIME type of the file
+            header = next(chunks, b'')
+            mime_type = get_mime_type(header)
 
-            # Validate file type: image or pdf only
-            if not mime_type.startswith('image') and mime_type != 'application/pdf':
+            # Validate file type: image or pdf only, and map MIME type to file extension
+            extension = get_extension_from_mime(mime_type)
+            if not extension:
                 raise serializers.ValidationError(f"Unsupported file type: {mime_type}. Only images and PDF files are allowed.")
 
-            # Map MIME type to file extension
-            if mime_type.startswith('image'):
-                extension = mime_type.split('/')[1]  # e.g., 'jpeg', 'png'
-            elif mime_type == 'application/pdf':
-                extension = 'pdf'
-            
-            # Create a file name with the appropriate extension
-            file_name = f"{uuid.uuid4()}.{extension}"
-
-            # Wrap the byte data in a ContentFile and assign the file name
-            content_file = ContentFile(file_data, name=file_name)
-            
-            return content_file
-        except Exception as e:
+            # Decode the rest of the base64 string straight to the file, hashing it on the way
+            with measure('base64_decode') as stage:
+                spooled_file = SpooledUploadFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+                sha256 = hashlib.sha256(header)
+                spooled_file.write(header)
+                for chunk in chunks:
+                    spooled_file.write(chunk)
+                    sha256.update(chunk)
+                size = stage.size = spooled_file.tell()
+                spooled_file.seek(0)
+        except (binascii.Error, ValueError):
             raise serializers.ValidationError("Invalid base64 string")
 
+        # Create a file name with the appropriate extension
+        file_name = f"{uuid.uuid4()}.{extension}"
+
+        # Wrap the spooled file in a django File and assign the file name
+        file = File(spooled_file, name=file_name)
+        file.size = size
+        file.content_hash = sha256.hexdigest()
+        return file
+
     def to_representation(self, value):
         """
         Convert the file-like object back to a base64 string.
         """
         return  base64.b64encode(value.read()).decode('utf-8')
     
+
+class StreamFileField(serializers.FileField):
+    """
+    Custom serializer field for binary uploads (multipart or raw body).
+    Only the first bytes are read to sniff the MIME type, the file itself stays
+    where the parser put it (memory, spooled or temporary file).
+    """
+    def to_internal_value(self, data):
+        file = super().to_internal_value(data)
+
+        # Use python-magic on the file header to determine the MIME type
+        file.seek(0)
+        header = file.read(MIME_SNIFF_SIZE)
+        file.seek(0)
+        mime_type = get_mime_type(header)
+
+        extension = get_extension_from_mime(mime_type)
+        if not extension:
+            raise serializers.ValidationError(f"Unsupported file type: {mime_type}. Only images and PDF files are allowed.")
+
+        file.name = f"{uuid.uuid4()}.{extension}"
+        return file
+
 # ---------------------------------------------------------------- 
 
 class Base64FileUploadSerializer(serializers.Serializer):
     file = Base64FileField(write_only=True)
+    # refuse an image close to a stored one (perceptual hash), also read from ?reject_near_duplicates= for raw bodies
+    reject_near_duplicates = serializers.BooleanField(default=False, write_only=True)
 
     def validate(self, attrs):
         file = attrs['file']
@@ -74,6 +119,16 @@ class Base64FileUploadSerializer(serializers.Serializer):
         if not file_processor.valid():
             raise serializers.ValidationError(f"Invalid file format. Only supports {file_processor.allowed_extensions.keys()}")
 
+        # An already stored file with the same content is reused with its metadata, without processing it again
+        attrs['content_hash'] = get_file_hash(file)
+        stored_file = self.get_stored_file(attrs['content_hash'])
+        if stored_file:
+            attrs['model_class'] = type(stored_file)
+            attrs['meta_data'] = stored_file.get_meta_data()
+            attrs['stored_file'] = stored_file
+            self.check_near_duplicates(attrs)
+            return attrs
+
         try :
             file_type , meta_data = file_processor.get_file_data()
         except Exception as e :
@@ -89,9 +144,28 @@ class Base64FileUploadSerializer(serializers.Serializer):
         
         attrs['model_class'] = model_class
         attrs['meta_data'] = meta_data
+        self.check_near_duplicates(attrs)
 
         return attrs
 
+    def rejects_near_duplicates(self, attrs):
+        request = self.context.get('request')
+        param = request.query_params.get('reject_near_duplicates') if request else None
+        return attrs['reject_near_duplicates'] or (param is not None and serializers.BooleanField().to_internal_value(param))
+
+    def check_near_duplicates(self, attrs):
+        """
+        Refuse an image whose perceptual hash is at most IMAGE_NEAR_DUPLICATE_DISTANCE bits from a stored image,
+        when asked to. A stored copy of the same content is a near duplicate too.
+        """
+        dhash = attrs['meta_data'].get('dhash')
+        if attrs['model_class'] is not ImgFile or dhash is None or not self.rejects_near_duplicates(attrs):
+            return
+        similar_images = find_similar_images(dhash, settings.IMAGE_NEAR_DUPLICATE_DISTANCE, limit=5)
+        if similar_images:
+            ids = ', '.join(str(image.id) for image, distance in similar_images)
+            raise serializers.ValidationError(f"The image is a near duplicate of the stored image(s) {ids}.")
+
     # to auto get model from file type
     def get_model_class(self,):
         return {
@@ -99,13 +173,36 @@ class Base64FileUploadSerializer(serializers.Serializer):
             'img': ImgFile,
         }
 
+    def get_stored_file(self, content_hash):
+        # get a stored file with the same content, from any model
+        for model_class in self.get_model_class().values():
+            stored_file = model_class.objects.filter(content_hash=content_hash).first()
+            if stored_file:
+                return stored_file
+        return None
+
     def create(self, validated_data):
         file = validated_data.get('file')
         meta_data = validated_data.get('meta_data')
         model_class = validated_data.get('model_class')
+        content_hash = validated_data.get('content_hash')
+        stored_file = validated_data.get('stored_file')
 
-        file_name = f"{uuid.uuid4()}.{file.name.split('.')[-1]}"
-        instance = model_class.objects.create(location=file, name=file_name, **meta_data)
+        extension = file.name.split('.')[-1]
+        file_name = f"{uuid.uuid4()}.{extension}"
+
+        if stored_file:
+            # point to the stored blob instead of saving the same content again
+            location = stored_file.location.name
+        else:
+            # files are stored under their content hash, a buried file of the same content is kept
+            location_field = model_class._meta.get_field('location')
+            name = location_field.generate_filename(None, f"{content_hash}.{extension}")
+            with measure('storage_write', getattr(file, 'size', None)):
+                location = save_content(location_field.storage, name, file)
+
+        with measure('db_insert'):
+            instance = model_class.objects.create(location=location, name=file_name, content_hash=content_hash, **meta_data)
 
         return instance
     
@@ -118,6 +215,168 @@ class Base64FileUploadSerializer(serializers.Serializer):
         }
 
 
+class StreamFileUploadSerializer(Base64FileUploadSerializer):
+    """
+    Same validation and model creation as the base64 upload, for binary uploads.
+    """
+    file = StreamFileField(write_only=True)
+
+
+class BatchFileUploadSerializer(serializers.Serializer):
+    """
+    Serializer for uploading many files at once, as base64 strings (JSON) or files (multipart), in the "files" field.
+    Files are decoded, processed and stored on a pool of threads, BATCH_UPLOAD_WORKERS files at a time and closed
+    once stored, then rows are inserted with one query per model in a transaction.
+    Every file gets its own result, an invalid file doesn't fail the others.
+    """
+    files = serializers.ListField(allow_empty=False)
+
+    def validate_files(self, files):
+        if len(files) > settings.BATCH_UPLOAD_MAX_FILES:
+            raise serializers.ValidationError(f"At most {settings.BATCH_UPLOAD_MAX_FILES} files can be uploaded at once.")
+        return files
+
+    def get_model_class(self):
+        return Base64FileUploadSerializer().get_model_class()
+
+    def get_error(self, error):
+        if isinstance(error, serializers.ValidationError):
+            detail = error.detail
+            return detail[0] if isinstance(detail, list) and len(detail) == 1 else detail
+        return f"Error processing file: {error}"
+
+    def read_file(self, item):
+        """
+        Decode a file and hash its content (in a worker thread).
+        """
+        field = Base64FileField() if isinstance(item, str) else StreamFileField()
+        file = field.to_internal_value(item)
+        try:
+            file_processor = ProcessFileData(file)
+            if not file_processor.valid():
+                raise serializers.ValidationError(f"Invalid file format. Only supports {file_processor.allowed_extensions.keys()}")
+            get_file_hash(file)
+        except Exception:
+            file.close()
+            raise
+        return file, file_processor
+
+    def store_file(self, file, file_processor):
+        """
+        Process a new file and save it under its content hash (in a worker thread).
+        """
+        file_type, meta_data = file_processor.get_file_data()
+        model_class = self.get_model_class().get(file_type)
+        if not model_class:
+            raise serializers.ValidationError("Unsupported file type, only supported for images and PDFs.")
+
+        location_field = model_class._meta.get_field('location')
+        extension = file.name.split('.')[-1]
+        name = location_field.generate_filename(None, f"{file.content_hash}.{extension}")
+        with measure('storage_write', getattr(file, 'size', None)):
+            location = save_content(location_field.storage, name, file)
+        return model_class, location, meta_data
+
+    def run_in_pool(self, function, tasks):
+        """
+        Run function(*task) for every task on a bounded pool of threads, returns (result, error) in the tasks order.
+        """
+        def run(task):
+            try:
+                return function(*task), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(settings.BATCH_UPLOAD_WORKERS) as executor:
+            return list(executor.map(run, tasks))
+
+    def store_new_files(self, read_files, stored_files, errors, saved_locations):
+        """
+        Store the contents of `read_files` ({index: (file, file_processor)}) not stored yet.
+        Contents already stored reuse their blob and metadata, the first file of every new content is processed.
+        `stored_files` gets (model class, location, meta data) and `errors` the error of every content hash.
+        """
+        content_hashes = {file.content_hash for file, file_processor in read_files.values()} - stored_files.keys() - errors.keys()
+        for model_class in self.get_model_class().values():
+            for stored_file in model_class.objects.filter(content_hash__in=content_hashes):
+                stored_files.setdefault(stored_file.content_hash, (type(stored_file), stored_file.location.name, stored_file.get_meta_data()))
+
+        new_files = {}
+        for file, file_processor in read_files.values():
+            if file.content_hash not in stored_files and file.content_hash not in errors:
+                new_files.setdefault(file.content_hash, (file, file_processor))
+
+        for content_hash, (stored, error) in zip(new_files, self.run_in_pool(self.store_file, list(new_files.values()))):
+            if error:
+                errors[content_hash] = self.get_error(error)
+            else:
+                stored_files[content_hash] = stored
+                saved_locations.append(stored[1])
+
+    def create(self, validated_data):
+        items = validated_data['files']
+        results = [None] * len(items)
+        # index : (content hash, extension) of the files read
+        read_files = {}
+        # content hash : (model class, location, meta data) of the stored contents, or the error of its first file
+        stored_files = {}
+        errors = {}
+        # blobs saved by this batch
+        saved_locations = []
+
+        try:
+            # files are read, stored and closed by chunks, only the files of a chunk are open at a time
+            chunk_size = settings.BATCH_UPLOAD_WORKERS
+            for start in range(0, len(items), chunk_size):
+                chunk = items[start:start + chunk_size]
+                chunk_files = {}
+                try:
+                    for index, (read_file, error) in enumerate(self.run_in_pool(self.read_file, [(item,) for item in chunk]), start):
+                        if error:
+                            results[index] = {'index': index, 'error': self.get_error(error)}
+                        else:
+                            chunk_files[index] = read_file
+                    self.store_new_files(chunk_files, stored_files, errors, saved_locations)
+                finally:
+                    for file, file_processor in chunk_files.values():
+                        file.close()
+                for index, (file, file_processor) in chunk_files.items():
+                    read_files[index] = (file.content_hash, file.name.split('.')[-1])
+
+            # one insert query per model, a copy of a file which couldn't be stored gets its error
+            instances = {}
+            for index, (content_hash, extension) in read_files.items():
+                if content_hash in errors:
+                    results[index] = {'index': index, 'error': errors[content_hash]}
+                    continue
+                model_class, location, meta_data = stored_files[content_hash]
+                instance = model_class(location=location, name=f"{uuid.uuid4()}.{extension}", content_hash=content_hash, **meta_data)
+                instances.setdefault(model_class, []).append((index, instance))
+
+            with transaction.atomic():
+                for model_class, model_instances in instances.items():
+                    with measure('db_insert'):
+                        model_class.objects.bulk_create([instance for index, instance in model_instances])
+        except Exception:
+            # the blobs saved for the batch are left to the reaper, which keeps them if a row references them by then
+            bury(saved_locations)
+            raise
+
+        for model_class, model_instances in instances.items():
+            for index, instance in model_instances:
+                results[index] = {
+                    'index': index,
+                    'id': instance.id,
+                    'name': instance.name,
+                    'location': instance.get_file_location,
+                }
+
+        return results
+
+    def to_representation(self, instance):
+        return {'results': instance}
+
+
 class PdfModelSerializer(serializers.ModelSerializer):
     """
     Serializer for view PDF files.
@@ -158,28 +417,126 @@ class RotateImageSerializer(serializers.Serializer):
     Serializer for rotate image files.
     """
     image_id = serializers.PrimaryKeyRelatedField(queryset=ImgFile.objects.all())
+    # counter-clockwise rotation in degrees
+    angle = serializers.FloatField(default=90)
+    # rotate JPEG images by changing their EXIF orientation only
+    exif_only = serializers.BooleanField(default=False)
 
     def validate(self, attrs):
         image = attrs['image_id']
-        image.rotate()  # This will rotate the image and save it back
+        try:
+            image.rotate(attrs['angle'], exif_only=attrs['exif_only'])  # This will rotate the image and save it back
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
         return image 
 
     def to_representation(self, instance):
         return ImgModelSerializer(instance).to_representation(instance)
 
+class ConversionJobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for view PDF conversion jobs.
+    """
+    image_path = serializers.CharField(source='result', read_only=True)
+
+    class Meta:
+        model = ConversionJob
+        fields = ('id', 'pdf', 'image_format', 'dpi', 'first_page', 'last_page', 'status', 'progress', 'image_path', 'error',
+                  'attempts', 'max_attempts', 'created_at', 'started_at', 'finished_at')
+
+
 class ConvertPdfToImageSerializer(serializers.Serializer):
     """
     Serializer for convert PDF to image files.
+    The stitched image is queued as a job, run by the background workers.
+    The other outputs (a ZIP of page images, a multi-page TIFF) are streamed while the pages are rendered.
     """
     pdf_id = serializers.PrimaryKeyRelatedField(queryset=PdfFile.objects.all())
-    
+    output = serializers.ChoiceField(choices=['stitched', 'zip', 'tiff'], default='stitched')
+    image_format = serializers.ChoiceField(choices=['png', 'jpeg', 'webp'], default='png')
+    dpi = serializers.IntegerField(min_value=18, max_value=600, default=300)
+    first_page = serializers.IntegerField(min_value=1, required=False)
+    last_page = serializers.IntegerField(min_value=1, required=False)
+
     def validate(self, attrs):
         pdf = attrs['pdf_id']
-        file_path = pdf.convert_to_image()
-        return file_path
+        try:
+            pages_number = pdf.get_pages_number()
+        except Exception:
+            raise serializers.ValidationError("The PDF file can't be read.")
+        first_page = attrs.get('first_page', 1)
+        last_page = attrs.get('last_page', pages_number)
+
+        if first_page > last_page:
+            raise serializers.ValidationError("first_page must not be after last_page.")
+        if last_page > pages_number:
+            raise serializers.ValidationError(f"The PDF file has only {pages_number} pages.")
+
+        if attrs['output'] == 'zip':
+            # a page too large for the format would fail in the middle of the stream
+            max_dimension = get_max_dimension(attrs['image_format'])
+            page_sizes = get_rendered_sizes(pdf.location.path, attrs['dpi'], self.get_page_numbers(attrs))
+            if any(max(width, height) > max_dimension for width, height in page_sizes):
+                raise serializers.ValidationError(f"A page is larger than the {max_dimension} pixels {attrs['image_format']} limit at {attrs['dpi']} dpi.")
+        return attrs
+
+    def get_page_numbers(self, attrs):
+        # 0-based numbers of the pages to convert, the page count is read from the document when it isn't stored
+        pdf = attrs['pdf_id']
+        return range(attrs.get('first_page', 1) - 1, attrs.get('last_page') or pdf.get_pages_number())
+
+    def get_export(self):
+        """
+        Get the bytes iterator, the content type and the file name of a streamed export.
+        """
+        attrs = self.validated_data
+        pdf = attrs['pdf_id']
+        page_numbers = self.get_page_numbers(attrs)
+        chunks = iter_export(attrs['output'], pdf.location.path, attrs['dpi'], page_numbers, attrs['image_format'])
+        file_name = f"{os.path.splitext(pdf.name)[0]}.{attrs['output']}"
+        return chunks, EXPORT_CONTENT_TYPES[attrs['output']], file_name
+    
+    def create(self, validated_data):
+        return enqueue_conversion(
+            validated_data['pdf_id'],
+            image_format=validated_data['image_format'],
+            dpi=validated_data['dpi'],
+            first_page=validated_data.get('first_page'),
+            last_page=validated_data.get('last_page'),
+        )
     
     def to_representation(self, instance):
-        print(instance)
-        return {
-            'image_path' : instance
-        }
+        return ConversionJobSerializer(instance).data
+
+
+class ThumbnailSerializer(serializers.Serializer):
+    """
+    Serializer for the thumbnail query parameters, the thumbnail fits in w x h pixels.
+    """
+    w = serializers.IntegerField(min_value=1, max_value=2048, default=256)
+    h = serializers.IntegerField(min_value=1, max_value=2048, default=256)
+    format = serializers.ChoiceField(choices=list(THUMBNAIL_FORMATS), default='jpeg')
+
+
+class TileSerializer(serializers.Serializer):
+    """
+    Serializer for the tile query parameters.
+    """
+    format = serializers.ChoiceField(choices=list(THUMBNAIL_FORMATS), default='jpeg')
+
+
+class SearchSerializer(serializers.Serializer):
+    """
+    Serializer for the PDF text search query parameters.
+    """
+    q = serializers.CharField(max_length=500)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20)
+    offset = serializers.IntegerField(min_value=0, max_value=10000, default=0)
+
+
+class SimilarImagesSerializer(serializers.Serializer):
+    """
+    Serializer for the similar images query parameters, distances are in bits of the 64 bits perceptual hash.
+    """
+    max_distance = serializers.IntegerField(min_value=0, max_value=32, default=10)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20)
@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.urls import path, include
 from . import views
+from .asgi import offload
 from rest_framework import routers
 
 router = routers.DefaultRouter()
@@ -8,9 +10,17 @@ router.register(r'images', views.ImgFileViewSet, basename='images')
 router.register(r'pdfs', views.PdfFileViewSet, basename='pdfs')
 
 
+def api_view(view):
+    # under an ASGI server (ASYNC_API), the blocking work of the view runs on a bounded executor
+    return offload(view) if settings.ASYNC_API else view
+
+
 urlpatterns = [
-    path('upload/', views.FileUploadView.as_view(), name='file.upload'),
-    path('rotate/', views.RotateImageView.as_view(), name='image.rotate'),
-    path('convert-pdf-to-image/', views.ConvertPdfToSingleImage.as_view(), name='pdf.convert_to_image'),
+    path('upload/', api_view(views.FileUploadView.as_view()), name='file.upload'),
+    path('upload/batch/', api_view(views.BatchFileUploadView.as_view()), name='file.upload_batch'),
+    path('upload/stream/', api_view(views.FileStreamUploadView.as_view()), name='file.upload_stream'),
+    path('rotate/', api_view(views.RotateImageView.as_view()), name='image.rotate'),
+    path('convert-pdf-to-image/', api_view(views.ConvertPdfToSingleImage.as_view()), name='pdf.convert_to_image'),
+    path('jobs/<int:pk>/', views.ConversionJobView.as_view(), name='job.detail'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
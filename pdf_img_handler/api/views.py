@@ -1,13 +1,62 @@
-from rest_framework.generics import CreateAPIView, DestroyAPIView
-from .serializers import Base64FileUploadSerializer, ImgModelSerializer, PdfModelSerializer, ImgShortModelSerializer, PdfShortModelSerializer, RotateImageSerializer, ConvertPdfToImageSerializer
-from pdf_img_handler.models import ImgFile, PdfFile
+from rest_framework import status
+from rest_framework.generics import CreateAPIView, DestroyAPIView, RetrieveAPIView
+from .serializers import Base64FileUploadSerializer, StreamFileUploadSerializer, BatchFileUploadSerializer, ImgModelSerializer, PdfModelSerializer, ImgShortModelSerializer, PdfShortModelSerializer, RotateImageSerializer, ConvertPdfToImageSerializer, ConversionJobSerializer, ThumbnailSerializer, TileSerializer, SearchSerializer, SimilarImagesSerializer
+from pdf_img_handler.models import ImgFile, PdfFile, ConversionJob
 from rest_framework.viewsets import ReadOnlyModelViewSet
+from rest_framework.parsers import JSONParser
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from django.http import StreamingHttpResponse
+from rest_framework.response import Response
+from pdf_img_handler.image_hash import find_similar_images
+from pdf_img_handler.media import serve_media
+from pdf_img_handler.search import search_pages
+from pdf_img_handler.thumbnails import PageNotFound, get_image_thumbnail, get_pdf_page_thumbnail
+from pdf_img_handler.tiles import TileNotFound, get_page_tile_info, get_pdf_tile
+from .pagination import KeysetPagination
+from .parsers import LimitedMultiPartParser, StreamingFileParser
 
 
 
 class BaseFileMVC(ReadOnlyModelViewSet, DestroyAPIView):
-    """Base class for retrieving, listing, and deleting"""
-    pass
+    """
+    Base class for retrieving, listing, and deleting.
+    Lists are paginated on (created_at, id) and filtered with ?<field>=, ?min_<field>= and ?max_<field>=
+    for the fields of `filter_fields`.
+    """
+    pagination_class = KeysetPagination
+    filter_fields = ()
+    # actions returning files, their ?format= is the file format and not a renderer
+    file_actions = ('thumbnail', 'page_thumbnail', 'tile')
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=force or self.action in self.file_actions)
+
+    def get_thumbnail_params(self):
+        serializer = ThumbnailSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def thumbnail_response(self, cached_file):
+        # served like the other media files, with validators and ranges
+        return serve_media(self.request._request, cached_file.location)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+
+        filters = {}
+        for field in self.filter_fields:
+            for param, lookup in ((field, field), (f'min_{field}', f'{field}__gte'), (f'max_{field}', f'{field}__lte')):
+                value = self.request.query_params.get(param)
+                if value is None:
+                    continue
+                try:
+                    filters[lookup] = int(value)
+                except ValueError:
+                    raise ValidationError({param: "A valid integer is required."})
+        return queryset.filter(**filters)
 
 # ----------------------------------------------------
 
@@ -19,6 +68,31 @@ class FileUploadView(CreateAPIView):
     serializer_class = Base64FileUploadSerializer
 
 
+class FileStreamUploadView(CreateAPIView):
+    """
+    API endpoint for uploading a binary file, either as multipart form data (field "file")
+    or as the raw request body, without the base64 overhead.
+    """
+    serializer_class = StreamFileUploadSerializer
+    parser_classes = (LimitedMultiPartParser, StreamingFileParser)
+
+
+class BatchFileUploadView(CreateAPIView):
+    """
+    API endpoint for uploading many files in one request, as a JSON list of base64 strings
+    or as multipart form data (repeated "files" field).
+    Returns a result per file, 207 when some of the files failed.
+    """
+    serializer_class = BatchFileUploadSerializer
+    parser_classes = (JSONParser, LimitedMultiPartParser)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if any('error' in result for result in response.data['results']):
+            response.status_code = status.HTTP_207_MULTI_STATUS
+        return response
+
+
 class ImgFileViewSet(BaseFileMVC):
     """
     API endpoint for 
@@ -28,12 +102,42 @@ class ImgFileViewSet(BaseFileMVC):
     """
     queryset = ImgFile.objects.all()
     serializer_class = ImgModelSerializer
+    filter_fields = ('width', 'height', 'channels_number')
 
     def get_serializer_class(self):
         if self.action == 'list':
             self.serializer_class = ImgShortModelSerializer
         return super().get_serializer_class()
 
+    @action(detail=True, methods=['get'])
+    def thumbnail(self, request, pk=None):
+        """
+        Get a thumbnail of the image (?w=&h=&format=), rendered on the first request then cached.
+        """
+        params = self.get_thumbnail_params()
+        cached_file = get_image_thumbnail(self.get_object(), params['w'], params['h'], params['format'])
+        return self.thumbnail_response(cached_file)
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """
+        Get the images close to this one (?max_distance=&limit=), resized or recompressed copies,
+        closest first with the number of different bits of their perceptual hashes.
+        """
+        serializer = SimilarImagesSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        image = self.get_object()
+        if image.dhash is None:
+            raise ValidationError("The image has no perceptual hash yet, it is computed by `manage.py backfill_metadata`.")
+
+        similar_images = find_similar_images(
+            image.dhash, serializer.validated_data['max_distance'], serializer.validated_data['limit'], exclude_id=image.id,
+        )
+        return Response({'results': [
+            dict(ImgShortModelSerializer(similar_image).data, distance=distance)
+            for similar_image, distance in similar_images
+        ]})
+
 
 class PdfFileViewSet(BaseFileMVC):
     """
@@ -44,16 +148,68 @@ class PdfFileViewSet(BaseFileMVC):
     """
     queryset = PdfFile.objects.all()
     serializer_class = PdfModelSerializer
+    filter_fields = ('page_width', 'page_height', 'pages_number')
 
     def get_serializer_class(self):
         if self.action == 'list':
             self.serializer_class = PdfShortModelSerializer
         return super().get_serializer_class()
 
+    @action(detail=True, methods=['get'], url_path=r'pages/(?P<page>\d+)/thumbnail')
+    def page_thumbnail(self, request, pk=None, page=None):
+        """
+        Get a thumbnail of a page (1-based) of the pdf (?w=&h=&format=), rendered on the first request then cached.
+        """
+        params = self.get_thumbnail_params()
+        pdf = self.get_object()
+        page = int(page)
+        if page < 1 or (pdf.pages_number and page > pdf.pages_number):
+            raise NotFound("Page not found.")
+        # the page count is checked on the document too, it isn't stored for every row
+        try:
+            cached_file = get_pdf_page_thumbnail(pdf, page, params['w'], params['h'], params['format'])
+        except PageNotFound as e:
+            raise NotFound(str(e))
+        return self.thumbnail_response(cached_file)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Search the text of the PDF pages (?q=&limit=&offset=), best matches first, with a snippet of every page.
+        Every term must be on the page, a term ending with * matches the words starting with it.
+        """
+        serializer = SearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': search_pages(**serializer.validated_data)})
+
+    @action(detail=True, methods=['get'], url_path=r'pages/(?P<page>\d+)/tiles')
+    def tiles(self, request, pk=None, page=None):
+        """
+        Get the tile size and the zoom levels of a page (1-based), for the tiles endpoint.
+        """
+        try:
+            return Response(get_page_tile_info(self.get_object().location.path, int(page) - 1))
+        except TileNotFound as e:
+            raise NotFound(str(e))
+
+    @action(detail=True, methods=['get'], url_path=r'pages/(?P<page>\d+)/tiles/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)')
+    def tile(self, request, pk=None, page=None, zoom=None, x=None, y=None):
+        """
+        Get the tile (x, y) of a page (1-based) at a zoom level (?format=), only the tile is rendered.
+        At level 0 the page fits in one tile, and every level doubles the resolution.
+        """
+        serializer = TileSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        try:
+            cached_file = get_pdf_tile(self.get_object(), int(page), int(zoom), int(x), int(y), serializer.validated_data['format'])
+        except TileNotFound as e:
+            raise NotFound(str(e))
+        return self.thumbnail_response(cached_file)
+
         
 class RotateImageView(CreateAPIView):
     """
-    API endpoint for rotating an image by 90 degrees clockwise.
+    API endpoint for rotating an image (by 90 degrees counter-clockwise by default).
     """
     serializer_class = RotateImageSerializer
     def perform_create(self, serializer):
@@ -62,8 +218,32 @@ class RotateImageView(CreateAPIView):
     
 class ConvertPdfToSingleImage(CreateAPIView):
     """
-    API for converting an pdf to a single image file
+    API for converting an pdf to a single image file (output=stitched),
+    a ZIP of page images (output=zip) or a multi-page TIFF (output=tiff).
+    The single image conversion is queued and the job is returned at once (202), its status is at jobs/<id>/
+    A conversion already in the cache returns its done job (200).
+    The ZIP and TIFF files are streamed, the first bytes are sent once the first page is rendered.
     """
     serializer_class = ConvertPdfToImageSerializer
-    def perform_create(self, serializer):
-        pass
\ No newline at end of file
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data['output'] != 'stitched':
+            chunks, content_type, file_name = serializer.get_export()
+            response = StreamingHttpResponse(chunks, content_type=content_type)
+            response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+            return response
+
+        self.perform_create(serializer)
+        # a conversion served from the cache is done, nothing was queued
+        done = serializer.instance.status == ConversionJob.DONE
+        return Response(serializer.data, status=status.HTTP_200_OK if done else status.HTTP_202_ACCEPTED)
+
+
+class ConversionJobView(RetrieveAPIView):
+    """
+    API endpoint for getting the status, progress and result of a conversion job.
+    """
+    queryset = ConversionJob.objects.all()
+    serializer_class = ConversionJobSerializer
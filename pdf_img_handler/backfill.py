@@ -0,0 +1,189 @@
+import multiprocessing, os, time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from .utils import ProcessFileData, ProcessImage, ProcessPdf
+
+# models are imported in the functions, this module is imported by the worker processes before django is set up
+
+# orphaned files younger than this may belong to an upload or an ingest not committed yet
+ORPHAN_MIN_AGE = 60 * 60
+# images written by PdfFile.convert_to_image without an output name, pdf_images/<pdf id>.<format>
+CONVERSIONS_DIRECTORY = 'pdf_images/'
+
+
+def get_model_classes():
+    from .models import ImgFile, PdfFile
+    return {'img': ImgFile, 'pdf': PdfFile}
+
+
+def get_extractor_versions():
+    return {'img': ProcessImage.version, 'pdf': ProcessPdf.version}
+
+
+def extract_metadata(path):
+    """
+    Extract the metadata of a stored file (in a worker process), with its extractor version.
+    Returns (meta data, None) or (None, error).
+    """
+    try:
+        with open(path, 'rb') as file:
+            file_type, meta_data = ProcessFileData(File(file, name=path)).get_file_data()
+    except FileNotFoundError:
+        return None, "File not found."
+    except Exception as e:
+        return None, str(e)
+    if not file_type:
+        return None, "Unsupported file type."
+    return meta_data, None
+
+
+class Backfill:
+    """
+    Recompute the metadata of the rows extracted by an older extractor version (ProcessImage/ProcessPdf.version).
+    Rows are read in id order by chunks of `chunk_size`, the files of a chunk are processed on a pool of
+    `workers` processes, and each chunk is written with one bulk_update in a short transaction,
+    so the tables are never locked for long and a stopped backfill continues where it was.
+    """
+    def __init__(self, workers=None, chunk_size=500, force=False, report=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # recompute every row, whatever its version
+        self.force = force
+        # called with (model name, updated rows, rows per second) after every chunk
+        self.report = report
+        # (model name, id, location, error) of the rows which couldn't be updated
+        self.errors = []
+
+    def get_stale_rows(self, model_class, version):
+        queryset = model_class.objects.all() if self.force else model_class.objects.filter(extractor_version__lt=version)
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', 'location')[:self.chunk_size])
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield rows
+
+    def run(self):
+        counts = {}
+        if self.workers <= 1:
+            for name, model_class in get_model_classes().items():
+                counts[name] = self.backfill(name, model_class, map)
+            return counts
+
+        # spawned processes, forking a process with open database connections is not safe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context, initializer=django.setup) as executor:
+            for name, model_class in get_model_classes().items():
+                counts[name] = self.backfill(name, model_class, executor.map)
+        return counts
+
+    def backfill(self, name, model_class, map_function):
+        version = get_extractor_versions()[name]
+        # updated_at is set too, for the readers of the changed rows (the perceptual hash index)
+        fields = list(model_class.meta_fields) + ['updated_at']
+        storage = model_class._meta.get_field('location').storage
+        updated = 0
+        start = time.perf_counter()
+
+        for rows in self.get_stale_rows(model_class, version):
+            # rows sharing a stored file are processed once
+            locations = sorted({location for row_id, location in rows})
+            results = dict(zip(locations, map_function(extract_metadata, [storage.path(location) for location in locations])))
+
+            with transaction.atomic():
+                # rows changed since they were read (rotated, deleted) are left as they are
+                current = dict(model_class.objects.select_for_update().filter(id__in=[row_id for row_id, location in rows]).values_list('id', 'location'))
+                instances = []
+                for row_id, location in rows:
+                    meta_data, error = results[location]
+                    if error:
+                        self.errors.append((name, row_id, location, error))
+                    elif current.get(row_id) == location:
+                        instances.append(model_class(id=row_id, updated_at=timezone.now(), **meta_data))
+                model_class.objects.bulk_update(instances, fields)
+            updated += len(instances)
+
+            if self.report:
+                elapsed = time.perf_counter() - start
+                self.report(name, updated, updated / elapsed if elapsed else 0)
+        return updated
+
+
+def find_dangling_rows(chunk_size=1000):
+    """
+    Yield (model name, id, location) of the rows whose stored file doesn't exist.
+    """
+    for name, model_class in get_model_classes().items():
+        storage = model_class._meta.get_field('location').storage
+        last_id = 0
+        while True:
+            rows = list(model_class.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'location')[:chunk_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # rows sharing a stored file check it once
+            missing = {location for location in {location for row_id, location in rows} if not storage.exists(location)}
+            for row_id, location in rows:
+                if location in missing:
+                    yield name, row_id, location
+
+
+def get_referenced_locations(names):
+    """
+    Get the names (relative to MEDIA_ROOT) referenced by a row, among `names`.
+    The conversions of a PDF (PdfFile.get_derived_locations) are referenced by its row.
+    """
+    from .models import CachedFile, PdfFile
+    referenced = set()
+    for model_class in get_model_classes().values():
+        referenced.update(model_class.objects.filter(location__in=names).values_list('location', flat=True))
+    referenced.update(CachedFile.objects.filter(location__in=names).values_list('location', flat=True))
+
+    conversions = {}
+    for name in names:
+        if name.startswith(CONVERSIONS_DIRECTORY):
+            pdf_id = name[len(CONVERSIONS_DIRECTORY):].split('.')[0]
+            if pdf_id.isdigit():
+                conversions.setdefault(int(pdf_id), []).append(name)
+    if conversions:
+        for pdf_file in PdfFile.objects.filter(id__in=conversions).only('id'):
+            derived_locations = pdf_file.get_derived_locations()
+            referenced.update(name for name in conversions[pdf_file.id] if name in derived_locations)
+    return referenced
+
+
+def find_orphaned_files(chunk_size=1000, min_age=ORPHAN_MIN_AGE):
+    """
+    Yield the names (relative to MEDIA_ROOT) of the stored originals, cached files and conversions
+    referenced by no row, older than `min_age` seconds. Names are checked against the database by chunks.
+    """
+    model_classes = get_model_classes()
+    directories = [model_class._meta.get_field('location').upload_to for model_class in model_classes.values()] + ['cache/', CONVERSIONS_DIRECTORY]
+    now = time.time()
+
+    def check(names):
+        referenced = get_referenced_locations(names)
+        return [name for name in names if name not in referenced]
+
+    chunk = []
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(settings.MEDIA_ROOT, directory)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                try:
+                    if now - os.path.getmtime(path) < min_age:
+                        continue
+                except OSError:
+                    continue
+                chunk.append(os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/'))
+                if len(chunk) >= chunk_size:
+                    yield from check(chunk)
+                    chunk = []
+    if chunk:
+        yield from check(chunk)
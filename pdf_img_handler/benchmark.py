@@ -0,0 +1,327 @@
+import base64, json, os, platform, random, resource, shutil, subprocess, threading, time
+from django.conf import settings
+from django.core.files import File
+from PIL import Image, ImageDraw
+from .models import ImgFile, PdfFile
+from .pdf_engine import get_pdf_engine
+from .utils import ProcessFileData, ProcessImage, ProcessPdf
+
+# Pillow format of every generated image extension, and the modes it can be saved with
+IMAGE_FORMATS = {
+    'png': ('PNG', ('RGB', 'RGBA', 'L', 'P')),
+    'jpeg': ('JPEG', ('RGB', 'L', 'CMYK')),
+    'webp': ('WEBP', ('RGB', 'RGBA')),
+}
+
+# page sizes (points) the generated PDFs pick from: A4, Letter, A3, A4 landscape, A5
+PAGE_SIZES = [(595, 842), (612, 792), (842, 1191), (842, 595), (420, 595)]
+
+# corpus and runs of every profile
+PROFILES = {
+    # a few small files, to check the suite itself
+    'smoke': {
+        'image_sizes': [(64, 64), (640, 480)],
+        'image_modes': ['RGB', 'L'],
+        'pdf_pages': [1, 5],
+        'repeat': 1,
+        'convert_dpi': 36,
+        'convert_max_pages': 5,
+    },
+    'default': {
+        'image_sizes': [(64, 64), (640, 480), (1920, 1080), (4000, 3000)],
+        'image_modes': ['RGB', 'RGBA', 'L', 'P', 'CMYK'],
+        'pdf_pages': [1, 10, 100, 500, 2000],
+        'repeat': 3,
+        'convert_dpi': 72,
+        'convert_max_pages': 100,
+    },
+    'large': {
+        'image_sizes': [(640, 480), (4000, 3000), (12000, 9000)],
+        'image_modes': ['RGB', 'RGBA', 'L', 'P', 'CMYK'],
+        'pdf_pages': [10, 500, 2000],
+        'repeat': 3,
+        'convert_dpi': 150,
+        'convert_max_pages': 500,
+    },
+}
+
+BENCHMARKS = ('process_image', 'process_pdf', 'process_file_data', 'rotate', 'convert_to_image', 'upload')
+
+
+# ---------------------------------------------------------------- corpus
+
+def generate_image(path, size, mode, pillow_format, rng):
+    """
+    Image with a gradient background and random shapes, compressing like a real picture more than noise does.
+    """
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        box = [x, y, x + rng.randrange(1, size[0]), y + rng.randrange(1, size[1])]
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse(box, fill=color) if rng.random() < 0.5 else draw.rectangle(box, fill=color)
+
+    if mode == 'P':
+        image = image.quantize(256)
+    elif mode == 'RGBA':
+        image = image.convert('RGBA')
+        image.putalpha(Image.linear_gradient('L').resize(size))
+    else:
+        image = image.convert(mode)
+    image.save(path, pillow_format)
+
+
+def generate_pdf(path, pages, rng):
+    """
+    PDF of `pages` pages of mixed sizes, each with some text and shapes.
+    """
+    fitz = get_pdf_engine('pymupdf').fitz
+    doc = fitz.open()
+    for page_num in range(pages):
+        width, height = rng.choice(PAGE_SIZES)
+        page = doc.new_page(width=width, height=height)
+        page.insert_text((50, 72), f"Benchmark page {page_num + 1}", fontsize=18)
+        for _ in range(5):
+            x, y = rng.randrange(width - 100), rng.randrange(100, height - 100)
+            page.draw_rect(fitz.Rect(x, y, x + 100, y + 80), color=(0, 0, 0), fill=(rng.random(), rng.random(), rng.random()))
+    doc.save(path)
+    doc.close()
+
+
+def generate_corpus(corpus_dir, profile, seed=0):
+    """
+    Generate the images and PDFs of a profile in `corpus_dir` (files already there are kept).
+    The same seed always generates the same files.
+    Returns {'images': [paths], 'pdfs': [paths]}.
+    """
+    config = PROFILES[profile]
+    rng = random.Random(seed)
+    os.makedirs(corpus_dir, exist_ok=True)
+
+    corpus = {'images': [], 'pdfs': []}
+    for width, height in config['image_sizes']:
+        for mode in config['image_modes']:
+            for extension, (pillow_format, modes) in IMAGE_FORMATS.items():
+                if mode not in modes:
+                    continue
+                path = os.path.join(corpus_dir, f'image-{seed}-{width}x{height}-{mode}.{extension}')
+                # the random state moves on even for existing files, so the next files stay the same
+                image_rng = random.Random(rng.random())
+                if not os.path.exists(path):
+                    generate_image(path, (width, height), mode, pillow_format, image_rng)
+                corpus['images'].append(path)
+
+    for pages in config['pdf_pages']:
+        path = os.path.join(corpus_dir, f'pdf-{seed}-{pages}.pdf')
+        pdf_rng = random.Random(rng.random())
+        if not os.path.exists(path):
+            generate_pdf(path, pages, pdf_rng)
+        corpus['pdfs'].append(path)
+    return corpus
+
+
+# ---------------------------------------------------------------- measures
+
+def get_rss():
+    """
+    Resident memory of the process in bytes (the peak so far where /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """
+    Sample the resident memory on a thread while a benchmark runs, to get its peak.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, get_rss())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = get_rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, get_rss())
+
+
+def percentile(sorted_values, percent):
+    # nearest rank
+    index = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run_benchmark(name, cases, function, repeat=1, setup=None):
+    """
+    Call function(case) `repeat` times for every (case, size in bytes), timing every call.
+    `setup(case)` is called before every call, outside of the timing.
+    """
+    latencies = []
+    total_bytes = 0
+    with RssSampler() as sampler:
+        for _ in range(repeat):
+            for case, size in cases:
+                if setup:
+                    setup(case)
+                start = time.perf_counter()
+                function(case)
+                latencies.append(time.perf_counter() - start)
+                total_bytes += size
+
+    latencies.sort()
+    seconds = sum(latencies)
+    return {
+        'name': name,
+        'count': len(latencies),
+        'seconds': seconds,
+        'ops_per_second': len(latencies) / seconds if seconds else 0,
+        'bytes_per_second': total_bytes / seconds if seconds else 0,
+        'latency_ms': {
+            'mean': seconds / len(latencies) * 1000 if latencies else 0,
+            'p50': percentile(latencies, 50) * 1000 if latencies else 0,
+            'p90': percentile(latencies, 90) * 1000 if latencies else 0,
+            'p99': percentile(latencies, 99) * 1000 if latencies else 0,
+            'max': latencies[-1] * 1000 if latencies else 0,
+        },
+        'peak_rss_bytes': sampler.peak,
+    }
+
+
+# ---------------------------------------------------------------- benchmarks
+
+def process_path(processor):
+    def process(path):
+        with open(path, 'rb') as file:
+            processor.process_file(file)
+    return process
+
+
+def process_file_data(path):
+    with open(path, 'rb') as file:
+        file_type, meta_data = ProcessFileData(File(file, name=os.path.basename(path))).get_file_data()
+    if not file_type:
+        raise ValueError(f"Unsupported benchmark file {path}")
+
+
+def store_corpus_file(model_class, path):
+    """
+    Copy a corpus file to MEDIA_ROOT and create its row, with its metadata.
+    """
+    name = os.path.join(model_class._meta.get_field('location').upload_to, os.path.basename(path))
+    os.makedirs(os.path.join(settings.MEDIA_ROOT, os.path.dirname(name)), exist_ok=True)
+    shutil.copyfile(path, os.path.join(settings.MEDIA_ROOT, name))
+    with open(path, 'rb') as file:
+        file_type, meta_data = ProcessFileData(File(file, name=os.path.basename(path))).get_file_data()
+    return model_class.objects.create(name=os.path.basename(path), location=name, **meta_data)
+
+
+def upload_file(client, path):
+    with open(path, 'rb') as file:
+        data = base64.b64encode(file.read()).decode()
+    response = client.post('/api/upload/', data={'file': data}, format='json')
+    if response.status_code != 201:
+        raise RuntimeError(f"Upload of {path} failed: {response.status_code} {response.content[:200]}")
+
+
+def clear_uploads(path):
+    # uploads of the same content are deduplicated, the stored rows are removed to time the whole upload
+    ImgFile.objects.all().delete()
+    PdfFile.objects.all().delete()
+
+
+def run_benchmarks(corpus, profile, only=None):
+    """
+    Run the benchmarks (all, or the names in `only`) on a corpus from generate_corpus.
+    Rows are created in the current database and files in MEDIA_ROOT.
+    """
+    from rest_framework.test import APIClient
+
+    config = PROFILES[profile]
+    repeat = config['repeat']
+    images = [(path, os.path.getsize(path)) for path in corpus['images']]
+    pdfs = [(path, os.path.getsize(path)) for path in corpus['pdfs']]
+
+    results = []
+
+    def run(name, *args, **kwargs):
+        if not only or name in only:
+            results.append(run_benchmark(name, *args, **kwargs))
+
+    run('process_image', images, process_path(ProcessImage()), repeat)
+    run('process_pdf', pdfs, process_path(ProcessPdf()), repeat)
+    run('process_file_data', images + pdfs, process_file_data, repeat)
+
+    if not only or 'rotate' in only:
+        img_files = [(store_corpus_file(ImgFile, path), size) for path, size in images]
+        run('rotate', img_files, lambda img_file: img_file.rotate(90), repeat)
+
+    if not only or 'convert_to_image' in only:
+        pdf_files = [(store_corpus_file(PdfFile, path), size) for path, size in pdfs]
+
+        def convert(pdf_file):
+            page_numbers = range(min(pdf_file.pages_number, config['convert_max_pages']))
+            if not pdf_file.convert_to_image('png', dpi=config['convert_dpi'], page_numbers=page_numbers):
+                raise RuntimeError(f"Conversion of {pdf_file.name} failed.")
+        run('convert_to_image', pdf_files, convert, repeat)
+
+    client = APIClient()
+    run('upload', images + pdfs, lambda path: upload_file(client, path), repeat, setup=clear_uploads)
+    return results
+
+
+def get_environment(profile, seed):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'profile': profile,
+        'seed': seed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pdf_render_workers': settings.PDF_RENDER_WORKERS,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        # peak memory of the page render processes
+        'children_max_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+def compare_results(results, baseline):
+    """
+    Get (name, throughput change, p50 latency change) in percent against a baseline output, for the benchmarks in both.
+    """
+    baseline_results = {result['name']: result for result in baseline['results']}
+    changes = []
+    for result in results:
+        base = baseline_results.get(result['name'])
+        if not base or not base['ops_per_second'] or not base['latency_ms']['p50']:
+            continue
+        throughput = (result['ops_per_second'] / base['ops_per_second'] - 1) * 100
+        latency = (result['latency_ms']['p50'] / base['latency_ms']['p50'] - 1) * 100
+        changes.append((result['name'], throughput, latency))
+    return changes
+
+
+def write_results(output, environment, results):
+    data = {'environment': environment, 'results': results}
+    if output == '-':
+        return json.dumps(data, indent=2)
+    with open(output, 'w') as file:
+        json.dump(data, file, indent=2)
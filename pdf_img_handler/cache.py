@@ -0,0 +1,112 @@
+import hashlib
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from .models import CachedFile
+
+# a cache hit only updates its last use when the previous one is older than this
+TOUCH_INTERVAL = timedelta(minutes=1)
+
+
+class DerivativeCache:
+    """
+    Disk cache of files derived from uploaded files, under MEDIA_ROOT/cache/<namespace>/.
+    Entries are keyed by the source content and the parameters used to derive them,
+    and the least recently used ones are evicted once the cache is over DERIVATIVE_CACHE_MAX_SIZE.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def get_key(self, source_key, *params):
+        key = '|'.join(str(part) for part in (self.namespace, source_key) + params)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_name(self, key, extension):
+        # path relative to MEDIA_ROOT, split in sub directories to keep them small
+        return f'cache/{self.namespace}/{key[:2]}/{key}.{extension}'
+
+    def get_path(self, name):
+        return os.path.join(settings.MEDIA_ROOT, name)
+
+    def get(self, key):
+        """
+        Get the cached file of a key, None when it is not cached.
+        """
+        cached_file = CachedFile.objects.filter(key=key).first()
+        if not cached_file:
+            return None
+
+        if not os.path.exists(self.get_path(cached_file.location)):
+            cached_file.delete()
+            return None
+
+        now = timezone.now()
+        if cached_file.last_used_at < now - TOUCH_INTERVAL:
+            CachedFile.objects.filter(id=cached_file.id).update(last_used_at=now)
+        return cached_file
+
+    def add(self, key, source_key, name):
+        """
+        Record a file written to `name` (from get_name) and evict old entries if the cache is full.
+        The entry recorded first is kept when the same key is rendered by concurrent requests.
+        """
+        try:
+            with transaction.atomic():
+                cached_file = CachedFile.objects.create(
+                    key=key,
+                    source_key=source_key,
+                    location=name,
+                    size=os.path.getsize(self.get_path(name)),
+                    last_used_at=timezone.now(),
+                )
+        except IntegrityError:
+            # the other request wrote the same file (the name is given by the key), its entry is read
+            cached_file = CachedFile.objects.get(key=key)
+        evict()
+        return cached_file
+
+    def get_url(self, cached_file):
+        return os.path.join(settings.MEDIA_URL, cached_file.location)
+
+
+def delete_cached_files(cached_files):
+    """
+    Delete cache entries, their files get a tombstone and are removed by the reaper.
+    """
+    from .reaper import bury
+
+    with transaction.atomic():
+        locations = list(cached_files.values_list('location', flat=True))
+        cached_files.delete()
+        bury(locations)
+
+
+def evict(max_size=None):
+    """
+    Delete the least recently used entries until the cache is under `max_size` (DERIVATIVE_CACHE_MAX_SIZE).
+    """
+    max_size = settings.DERIVATIVE_CACHE_MAX_SIZE if max_size is None else max_size
+    total_size = CachedFile.objects.aggregate(total=Sum('size'))['total'] or 0
+
+    while total_size > max_size:
+        oldest = list(CachedFile.objects.order_by('last_used_at', 'id').values_list('id', 'size')[:100])
+        if not oldest:
+            break
+
+        evicted_ids = []
+        for cached_file_id, size in oldest:
+            evicted_ids.append(cached_file_id)
+            total_size -= size
+            if total_size <= max_size:
+                break
+        delete_cached_files(CachedFile.objects.filter(id__in=evicted_ids))
+
+
+def invalidate_source(source_key):
+    """
+    Delete every cached file derived from a source.
+    """
+    delete_cached_files(CachedFile.objects.filter(source_key=source_key))
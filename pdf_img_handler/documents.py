@@ -0,0 +1,130 @@
+import os, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from .metrics import document_cache_evictions, document_cache_requests
+
+# estimated memory of a cached header (parsed values, dict and key)
+HEADER_INFO_SIZE = 1024
+
+
+def get_stored_path(file):
+    """
+    Get the path of a file stored under MEDIA_ROOT (a path, or a file opened from one), None for other files.
+    Only stored files are cached, uploads and ingested files are read once.
+    """
+    path = file if isinstance(file, str) else getattr(file, 'name', None)
+    if not isinstance(path, str) or not os.path.isabs(path):
+        return None
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    path = os.path.abspath(path)
+    return path if os.path.commonpath([media_root, path]) == media_root else None
+
+
+class DocumentCache:
+    """
+    Per-process LRU of open documents (PyMuPDF or PyPDF2) and parsed image headers, keyed by kind, path,
+    modification time and size, so a changed file is read again. The parsed document (xref, page tree)
+    is reused by the next requests.
+    Entries are evicted beyond DOCUMENT_CACHE_SIZE entries or DOCUMENT_CACHE_MAX_MEMORY bytes,
+    the memory of a document is estimated as the size of its file.
+    A document is used by one thread at a time, PyMuPDF and PyPDF2 documents are not thread-safe.
+    """
+    def __init__(self, max_count=None, max_memory=None):
+        self.max_count = max_count
+        self.max_memory = max_memory
+        # key : (value, lock, estimated memory)
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_max_count(self):
+        return self.max_count or settings.DOCUMENT_CACHE_SIZE
+
+    def get_max_memory(self):
+        return self.max_memory or settings.DOCUMENT_CACHE_MAX_MEMORY
+
+    def get_key(self, kind, path):
+        stat = os.stat(path)
+        return kind, path, stat.st_mtime_ns, stat.st_size
+
+    def get_entry(self, kind, path, load):
+        """
+        Get the (value, lock, memory) entry of a file, `load()` reads it on a miss and returns (value, memory).
+        """
+        key = self.get_key(kind, path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        document_cache_requests.inc(kind=kind, result='hit' if entry else 'miss')
+        if entry:
+            return entry
+
+        # read without holding the cache lock
+        value, memory = load()
+        with self.lock:
+            self.misses += 1
+            # kept if another thread read it in the meantime
+            if key not in self.entries:
+                self.entries[key] = (value, threading.Lock(), memory)
+                self.memory += memory
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+            self.evict()
+        return entry
+
+    def evict(self):
+        # the most recent entry is kept, even alone over the memory limit
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.get_max_count() or self.memory > self.get_max_memory()
+        ):
+            # an evicted document is closed once its last user drops it
+            (kind, *_), (value, lock, memory) = self.entries.popitem(last=False)
+            self.memory -= memory
+            self.evictions += 1
+            document_cache_evictions.inc(kind=kind)
+
+    @contextmanager
+    def open(self, path, engine='pymupdf'):
+        """
+        Use the open document of a PDF file with a PDF engine ('pymupdf' or 'pypdf2'), opened on the first use.
+        """
+        from .pdf_engine import get_pdf_engine
+
+        def load():
+            return get_pdf_engine(engine).open(path), os.path.getsize(path)
+
+        doc, doc_lock, memory = self.get_entry(engine, path, load)
+        with doc_lock:
+            yield doc
+
+    def get_header_info(self, path, read):
+        """
+        Get the header info of an image file, `read(path)` parses it on the first use.
+        The info is shared by the callers, it must not be changed.
+        """
+        info, lock, memory = self.get_entry('image', path, lambda: (read(path), HEADER_INFO_SIZE))
+        return info
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'memory': self.memory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory = 0
+
+
+document_cache = DocumentCache()
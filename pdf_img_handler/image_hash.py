@@ -0,0 +1,208 @@
+import bisect, threading
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from PIL import Image
+from .image_rotation import apply_orientation, get_orientation
+from .metrics import measure
+
+# NumPy makes a search a few vectorized operations over every hash, without it the hashes are compared one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# models are imported in the functions, this module is imported by utils which is imported by the models
+
+# the image is reduced to (HASH_SIZE + 1) x HASH_SIZE pixels, one bit per pair of neighbour pixels
+HASH_SIZE = 8
+HASH_MASK = 2 ** 64 - 1
+# rows changed this long before the last sync are read again, their transaction may have committed after it
+SYNC_MARGIN = timedelta(seconds=5)
+
+
+def to_signed(value):
+    # hashes are stored in a signed 64 bits integer column
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+def get_dhash(image):
+    """
+    Get the difference hash (dHash) of an image, as a signed 64 bits integer:
+    the gray image is reduced to 9x8 pixels and every bit tells if a pixel is darker than its right neighbour.
+    Resized and recompressed copies of an image get the same hash, or one with a few different bits.
+    JPEG images are decoded at a reduced scale (draft mode).
+    The hash is the one of the displayed image, with its EXIF orientation applied.
+    """
+    orientation = get_orientation(image)
+    image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+    pixels = apply_orientation(image.convert('L'), orientation).resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS, reducing_gap=3.0).tobytes()
+    value = 0
+    for y in range(HASH_SIZE):
+        row = pixels[y * (HASH_SIZE + 1):(y + 1) * (HASH_SIZE + 1)]
+        for x in range(HASH_SIZE):
+            value = value << 1 | (row[x] < row[x + 1])
+    return to_signed(value)
+
+
+class ImageHashIndex:
+    """
+    Per-process index of the perceptual hashes (ImgFile.dhash) of the images, searched by Hamming distance.
+    The hashes are loaded from the database on the first search, then every search only reads the rows
+    changed since the previous one (updated_at), so new and rotated images are found without a reload.
+    Deleted images are left out by the lookup of the rows found and removed from the index then,
+    other processes drop them on their next lookup or reload (every IMAGE_HASH_INDEX_MAX_AGE seconds).
+    The ids are kept sorted, with NumPy the hashes are unsigned 64 bits arrays and a search is a XOR
+    and a popcount over all of them.
+    """
+    def __init__(self):
+        self.ids = None
+        self.hashes = None
+        self.loaded_at = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def get_rows(self, since=None):
+        from .models import ImgFile
+        queryset = ImgFile.objects.exclude(dhash=None)
+        if since:
+            queryset = queryset.filter(updated_at__gte=since)
+        return queryset.order_by('id').values_list('id', 'dhash').iterator(chunk_size=10000)
+
+    def to_arrays(self, rows):
+        if numpy is None:
+            ids, hashes = [], []
+            for row_id, value in rows:
+                ids.append(row_id)
+                hashes.append(value & HASH_MASK)
+            return ids, hashes
+
+        # read without a list of tuples, rows are (id, hash) pairs
+        pairs = numpy.fromiter((value for row in rows for value in row), dtype=numpy.int64).reshape(-1, 2)
+        return numpy.ascontiguousarray(pairs[:, 0]), numpy.ascontiguousarray(pairs[:, 1]).view(numpy.uint64)
+
+    def load(self):
+        self.synced_at = self.loaded_at = timezone.now()
+        self.ids, self.hashes = self.to_arrays(self.get_rows())
+
+    def merge(self, ids, hashes):
+        """
+        Replace the hashes of the ids already in the index, and add the other ones.
+        """
+        if numpy is None:
+            for row_id, value in zip(ids, hashes):
+                position = bisect.bisect_left(self.ids, row_id)
+                if position < len(self.ids) and self.ids[position] == row_id:
+                    self.hashes[position] = value
+                else:
+                    self.ids.insert(position, row_id)
+                    self.hashes.insert(position, value)
+            return
+
+        positions = numpy.searchsorted(self.ids, ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == ids[found]
+        self.hashes[positions[found]] = hashes[found]
+        if not found.all():
+            ids = numpy.concatenate([self.ids, ids[~found]])
+            hashes = numpy.concatenate([self.hashes, hashes[~found]])
+            order = numpy.argsort(ids, kind='stable')
+            self.ids, self.hashes = ids[order], hashes[order]
+
+    def remove(self, ids):
+        """
+        Remove the hashes of deleted images.
+        """
+        with self.lock:
+            if self.ids is None:
+                return
+            if numpy is None:
+                ids = set(ids)
+                kept = [(row_id, value) for row_id, value in zip(self.ids, self.hashes) if row_id not in ids]
+                self.ids, self.hashes = [row_id for row_id, value in kept], [value for row_id, value in kept]
+                return
+            kept = ~numpy.isin(self.ids, numpy.fromiter(ids, dtype=numpy.int64))
+            self.ids, self.hashes = self.ids[kept], self.hashes[kept]
+
+    def sync(self):
+        max_age = timedelta(seconds=settings.IMAGE_HASH_INDEX_MAX_AGE)
+        if self.loaded_at is None or timezone.now() - self.loaded_at > max_age:
+            self.load()
+            return
+        since = self.synced_at - SYNC_MARGIN
+        self.synced_at = timezone.now()
+        ids, hashes = self.to_arrays(self.get_rows(since))
+        if len(ids):
+            self.merge(ids, hashes)
+
+    def match(self, dhash, max_distance):
+        """
+        Get the ids and the distances of the images whose hash is at most `max_distance` bits from `dhash`,
+        in id order (NumPy arrays), the lock is only held while the hashes are compared.
+        """
+        with self.lock, measure('similar_search'):
+            self.sync()
+            query = dhash & HASH_MASK
+            if numpy is None:
+                matches = [
+                    (row_id, distance)
+                    for row_id, value in zip(self.ids, self.hashes)
+                    if (distance := (value ^ query).bit_count()) <= max_distance
+                ]
+                return [row_id for row_id, distance in matches], [distance for row_id, distance in matches]
+
+            distances = numpy.bitwise_count(self.hashes ^ numpy.uint64(query))
+            matches = numpy.flatnonzero(distances <= max_distance)
+            return self.ids[matches], distances[matches]
+
+    def search(self, dhash, max_distance, limit=None):
+        """
+        Get (id, distance) of the images whose hash is at most `max_distance` bits from `dhash`, closest first.
+        """
+        ids, distances = self.match(dhash, max_distance)
+        return [(int(ids[i]), int(distances[i])) for i in sort_matches(distances, limit)]
+
+    def clear(self):
+        with self.lock:
+            self.ids = self.hashes = self.loaded_at = self.synced_at = None
+
+
+image_hash_index = ImageHashIndex()
+
+
+def sort_matches(distances, limit=None):
+    """
+    Get the positions of the `limit` smallest distances, closest first then in id order.
+    """
+    if numpy is None:
+        return sorted(range(len(distances)), key=distances.__getitem__)[:limit]
+    if limit is not None and limit < len(distances):
+        # only the matches up to the distance of the limit-th closest one are sorted
+        threshold = numpy.partition(distances, limit - 1)[limit - 1]
+        candidates = numpy.flatnonzero(distances <= threshold)
+        return candidates[numpy.argsort(distances[candidates], kind='stable')][:limit]
+    return numpy.argsort(distances, kind='stable')
+
+
+def find_similar_images(dhash, max_distance, limit=20, exclude_id=None):
+    """
+    Get the images (ImgFile) whose hash is at most `max_distance` bits from `dhash`, with their distance, closest first.
+    """
+    from .models import ImgFile
+    # deleted images may still be in the index, the matches are read by chunks until `limit` images are found,
+    # only the chunks read are converted to Python objects
+    ids, distances = image_hash_index.match(dhash, max_distance)
+    order = sort_matches(distances)
+    found = []
+    chunk_size = limit * 2
+    for start in range(0, len(order), chunk_size):
+        chunk = [(int(ids[i]), int(distances[i])) for i in order[start:start + chunk_size]]
+        chunk = [(row_id, distance) for row_id, distance in chunk if row_id != exclude_id]
+        rows = ImgFile.objects.in_bulk([row_id for row_id, distance in chunk])
+        found.extend((rows[row_id], distance) for row_id, distance in chunk if row_id in rows)
+        deleted_ids = [row_id for row_id, distance in chunk if row_id not in rows]
+        if deleted_ids:
+            image_hash_index.remove(deleted_ids)
+        if len(found) >= limit:
+            break
+    return found[:limit]
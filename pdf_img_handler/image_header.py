@@ -0,0 +1,138 @@
+import struct
+
+# PNG color type : channels number
+PNG_CHANNELS = {
+    0: 1,  # grayscale
+    2: 3,  # RGB
+    3: 3,  # palette (4 with a tRNS chunk)
+    4: 2,  # grayscale + alpha
+    6: 4,  # RGBA
+}
+
+# JPEG start of frame markers (SOF0 - SOF15 without DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def read_image_header(file):
+    """
+    Read width, height, and channels number of a PNG, JPEG (JFIF/EXIF) or WebP image
+    from its first bytes, without decoding it.
+    Returns None for any other format or a header that can't be parsed,
+    the file position is restored in both cases.
+    """
+    position = file.tell()
+    try:
+        file.seek(0)
+        header = file.read(32)
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            return read_png_header(file, header)
+        if header.startswith(b'\xff\xd8'):
+            return read_jpeg_header(file)
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return read_webp_header(header)
+        return None
+    except (struct.error, ValueError, IndexError):
+        return None
+    finally:
+        file.seek(position)
+
+
+def image_data(width, height, channels_number):
+    if not width or not height:
+        return None
+    return {
+        'width': width,
+        'height': height,
+        'channels_number': channels_number,
+    }
+
+
+def read_png_header(file, header):
+    # the IHDR chunk always comes first, right after the 8 bytes signature
+    if header[12:16] != b'IHDR':
+        return None
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', header[16:26])
+    channels_number = PNG_CHANNELS.get(color_type)
+    if channels_number is None:
+        return None
+
+    if color_type == 3:
+        # a palette image has an alpha channel when a tRNS chunk comes before the image data
+        file.seek(33)  # signature (8) + IHDR chunk (25)
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', chunk_header)
+            if chunk_type == b'tRNS':
+                channels_number = 4
+                break
+            if chunk_type in (b'IDAT', b'IEND'):
+                break
+            file.seek(length + 4, 1)  # chunk data + CRC
+
+    return image_data(width, height, channels_number)
+
+
+def read_jpeg_header(file):
+    # walk the segments after SOI until the start of frame segment
+    file.seek(2)
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+
+        marker = file.read(1)
+        # skip fill bytes
+        while marker == b'\xff':
+            marker = file.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+
+        if marker in JPEG_STANDALONE_MARKERS or marker == 0x00:
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image or start of scan before any frame header
+            return None
+
+        length = struct.unpack('>H', file.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            precision, height, width, components = struct.unpack('>BHHB', file.read(6))
+            # a height of 0 is defined later by a DNL marker, let Pillow handle it
+            return image_data(width, height, components)
+        file.seek(length - 2, 1)
+
+
+def read_webp_header(header):
+    chunk_type = header[12:16]
+    if chunk_type == b'VP8 ':
+        # lossy: 3 bytes frame tag, 3 bytes start code, then 14 bits width and height
+        if header[23:26] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', header[26:30])
+        return image_data(width & 0x3FFF, height & 0x3FFF, 3)
+
+    if chunk_type == b'VP8L':
+        # lossless: signature byte, then 14 bits width - 1, 14 bits height - 1 and the alpha bit
+        if header[20] != 0x2F:
+            return None
+        bits = struct.unpack('<I', header[21:25])[0]
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        has_alpha = (bits >> 28) & 1
+        return image_data(width, height, 4 if has_alpha else 3)
+
+    if chunk_type == b'VP8X':
+        # extended: flags byte, 3 reserved bytes, then 24 bits canvas width - 1 and height - 1
+        has_alpha = header[20] & 0x10
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+        return image_data(width, height, 4 if has_alpha else 3)
+
+    return None
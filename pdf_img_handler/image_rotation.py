@@ -0,0 +1,204 @@
+import shutil
+import struct
+import subprocess
+from PIL import Image, JpegImagePlugin
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# EXIF orientation : (mirrored, clockwise rotation applied to display the stored pixels)
+EXIF_ORIENTATIONS = {
+    1: (False, 0),
+    6: (False, 90),
+    3: (False, 180),
+    8: (False, 270),
+    2: (True, 0),
+    7: (True, 90),
+    4: (True, 180),
+    5: (True, 270),
+}
+
+# EXIF orientation : transpose of the stored pixels showing the image as it is displayed
+EXIF_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# jpegtran (libjpeg-turbo) does lossless JPEG transforms when it is installed
+JPEGTRAN = shutil.which('jpegtran')
+
+
+def is_right_angle(angle):
+    return angle % 90 == 0
+
+
+def get_orientation(image):
+    # the EXIF of a JPEG image is read with its header, other formats without EXIF have none
+    return image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+
+
+def is_transposed(orientation):
+    """
+    Tell if an EXIF orientation shows the stored pixels turned by a quarter turn (5 to 8),
+    the displayed width and height are the stored height and width.
+    """
+    return EXIF_ORIENTATIONS.get(orientation, EXIF_ORIENTATIONS[1])[1] % 180 != 0
+
+
+def apply_orientation(image, orientation):
+    """
+    Get the pixels of an image as they are displayed with an EXIF orientation.
+    """
+    transpose = EXIF_TRANSPOSES.get(orientation)
+    return image.transpose(transpose) if transpose is not None else image
+
+
+def rotate_orientation(orientation, angle):
+    """
+    Get the EXIF orientation showing the image rotated counter-clockwise by `angle` (a right angle).
+    """
+    mirrored, rotation = EXIF_ORIENTATIONS.get(orientation, EXIF_ORIENTATIONS[1])
+    rotation = int(rotation - angle) % 360
+    for value, transform in EXIF_ORIENTATIONS.items():
+        if transform == (mirrored, rotation):
+            return value
+
+
+def read_jpeg_segments(file):
+    """
+    Get (marker, start, end) of the JPEG segments before the image data, end is the start of the next segment.
+    """
+    segments = []
+    file.seek(2)  # after SOI
+    while True:
+        start = file.tell()
+        marker_bytes = file.read(2)
+        if len(marker_bytes) < 2 or marker_bytes[0] != 0xFF:
+            raise ValueError("Invalid JPEG segment.")
+        marker = marker_bytes[1]
+        if marker == 0xDA:  # start of scan, the image data follows
+            return segments
+        length = struct.unpack('>H', file.read(2))[0]
+        file.seek(start + 2 + length)
+        segments.append((marker, start, start + 2 + length))
+
+
+def patch_exif_orientation(exif_data, orientation):
+    """
+    Replace the orientation value of an EXIF (APP1) payload in place, returns None when it has no orientation tag.
+    """
+    tiff = 6  # after b'Exif\0\0'
+    byte_order = '<' if exif_data[tiff:tiff + 2] == b'II' else '>'
+    ifd = tiff + struct.unpack(byte_order + 'I', exif_data[tiff + 4:tiff + 8])[0]
+    entries = struct.unpack(byte_order + 'H', exif_data[ifd:ifd + 2])[0]
+    for index in range(entries):
+        entry = ifd + 2 + index * 12
+        tag = struct.unpack(byte_order + 'H', exif_data[entry:entry + 2])[0]
+        if tag == EXIF_ORIENTATION_TAG:
+            patched = bytearray(exif_data)
+            patched[entry + 8:entry + 10] = struct.pack(byte_order + 'H', orientation)
+            return bytes(patched)
+    return None
+
+
+def rotate_jpeg_exif(source_path, output_path, angle):
+    """
+    Rotate a JPEG image by changing its EXIF orientation only, the image data is copied as is.
+    Returns the new orientation.
+    """
+    with open(source_path, 'rb') as source:
+        segments = read_jpeg_segments(source)
+
+        exif_segment = None
+        for marker, start, end in segments:
+            source.seek(start + 4)
+            if marker == 0xE1 and source.read(6) == b'Exif\x00\x00':
+                exif_segment = (start, end)
+                break
+
+        if exif_segment:
+            start, end = exif_segment
+            source.seek(start + 4)
+            exif_data = source.read(end - start - 4)
+            exif = Image.Exif()
+            exif.load(exif_data)
+            orientation = rotate_orientation(exif.get(EXIF_ORIENTATION_TAG, 1), angle)
+            # the tag is patched when it exists, otherwise the EXIF data is written again with it
+            new_exif_data = patch_exif_orientation(exif_data, orientation)
+            if new_exif_data is None:
+                exif[EXIF_ORIENTATION_TAG] = orientation
+                new_exif_data = exif.tobytes()
+        else:
+            # a new EXIF segment goes after the JFIF (APP0) one, if there is one
+            start = end = segments[0][2] if segments and segments[0][0] == 0xE0 else 2
+            orientation = rotate_orientation(1, angle)
+            exif = Image.Exif()
+            exif[EXIF_ORIENTATION_TAG] = orientation
+            new_exif_data = exif.tobytes()
+
+        with open(output_path, 'wb') as output:
+            source.seek(0)
+            output.write(source.read(start))
+            output.write(b'\xff\xe1' + struct.pack('>H', len(new_exif_data) + 2) + new_exif_data)
+            source.seek(end)
+            shutil.copyfileobj(source, output)
+
+    return orientation
+
+
+def rotate_jpeg_lossless(source_path, output_path, angle):
+    """
+    Rotate a JPEG image by a right angle without decoding it, with jpegtran.
+    Partial MCU blocks on the edges are trimmed, so the transform is lossless.
+    """
+    clockwise = int(-angle) % 360
+    subprocess.run(
+        [JPEGTRAN, '-rotate', str(clockwise), '-trim', '-copy', 'all', '-outfile', output_path, source_path],
+        check=True, capture_output=True,
+    )
+
+
+def get_save_options(image, source_path):
+    """
+    Get the options saving an image as close as possible to the way it was saved.
+    """
+    options = {}
+    for key in ('exif', 'icc_profile', 'dpi', 'transparency'):
+        if key in image.info:
+            options[key] = image.info[key]
+
+    if image.format == 'JPEG':
+        # the original quantization tables and subsampling keep the quality of the image
+        options['qtables'] = image.quantization
+        options['subsampling'] = JpegImagePlugin.get_sampling(image)
+        options['progressive'] = 'progressive' in image.info or 'progression' in image.info
+    elif image.format == 'WEBP':
+        with open(source_path, 'rb') as source:
+            options['lossless'] = source.read(16)[12:16] == b'VP8L'
+        options['quality'] = 100 if options['lossless'] else 90
+    return options
+
+
+def rotate_image_pillow(source_path, output_path, angle):
+    """
+    Rotate an image counter-clockwise by any angle with Pillow, saved with its format options.
+    Returns the rotated image.
+    """
+    image = Image.open(source_path)
+    image_format = image.format
+    options = get_save_options(image, source_path)
+
+    if is_right_angle(angle):
+        # right angles are pixel transposes, without resampling
+        transpose = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_270}
+        rotation = int(angle) % 360
+        rotated_image = image.transpose(transpose[rotation]) if rotation else image.copy()
+    else:
+        rotated_image = image.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True)
+
+    rotated_image.save(output_path, image_format, **options)
+    return rotated_image
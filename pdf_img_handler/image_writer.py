@@ -0,0 +1,155 @@
+import io
+import mmap
+import struct
+import tempfile
+import zlib
+from PIL import Image
+
+# largest width or height each output format can hold
+FORMAT_MAX_DIMENSION = {
+    'png': 2 ** 31 - 1,
+    'jpeg': 65535,
+    'jpg': 65535,
+    'webp': 16383,
+}
+
+# compressed bytes collected before a PNG IDAT chunk is written
+PNG_CHUNK_SIZE = 256 * 1024
+
+# Pillow format and options of the pages encoded one by one (page exports)
+PAGE_FORMATS = {
+    'png': ('PNG', {'compress_level': 6}),
+    'jpeg': ('JPEG', {'quality': 90}),
+    'webp': ('WEBP', {'quality': 90}),
+}
+
+
+def get_max_dimension(image_format):
+    return FORMAT_MAX_DIMENSION.get(image_format.lower(), 65535)
+
+
+def is_canvas_format(image_format):
+    # formats encoded from the whole image at once, their size is bounded by the memory they take
+    return image_format.lower() != 'png'
+
+
+def encode_page(width, height, samples, image_format):
+    """
+    Encode the RGB samples of a page to `image_format` (PAGE_FORMATS),
+    'tiff' gives the deflate compressed samples, the strip of a TIFF page.
+    """
+    if image_format == 'tiff':
+        return zlib.compress(samples, 6)
+
+    pillow_format, options = PAGE_FORMATS[image_format]
+    buffer = io.BytesIO()
+    Image.frombuffer('RGB', (width, height), samples, 'raw', 'RGB', 0, 1).save(buffer, pillow_format, **options)
+    return buffer.getvalue()
+
+
+def fit_rows(samples, width, height, canvas_width, canvas_height):
+    """
+    Yield `canvas_height` RGB rows of `canvas_width` pixels from a page,
+    narrower pages are padded with black, like the pages pasted on a new image.
+    """
+    stride = width * 3
+    canvas_stride = canvas_width * 3
+    padding = bytes(max(canvas_stride - stride, 0))
+    for y in range(canvas_height):
+        if y < height:
+            yield samples[y * stride:(y + 1) * stride][:canvas_stride] + padding
+        else:
+            yield bytes(canvas_stride)
+
+
+class PngStreamWriter:
+    """
+    Write an RGB PNG image row by row, so only the rows being compressed are in memory.
+    """
+    def __init__(self, path, width, height, compress_level=6):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.compressor = zlib.compressobj(compress_level)
+        self.buffer = []
+        self.buffer_size = 0
+
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits RGB, deflate compression, no interlace
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_compressed(self, data):
+        if data:
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+        if self.buffer_size >= PNG_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write_chunk(b'IDAT', b''.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def write_page(self, width, height, samples, page_height):
+        # every row starts with its filter type, 0 (none)
+        for row in fit_rows(samples, width, height, self.width, page_height):
+            self.write_compressed(self.compressor.compress(b'\x00' + row))
+
+    def close(self):
+        self.write_compressed(self.compressor.flush())
+        self.flush()
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+
+class CanvasWriter:
+    """
+    Write pages on an RGB canvas memory-mapped from a temporary file, then encode it with Pillow.
+    Pillow decodes the whole canvas in memory to encode it (about 4 bytes per pixel),
+    its size is capped by PDF_CONVERT_MAX_CANVAS_PIXELS (see PdfFile.get_render_sizes).
+    """
+    def __init__(self, path, width, height, image_format):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.image_format = image_format
+        self.offset = 0
+
+        self.file = tempfile.TemporaryFile()
+        self.file.truncate(width * height * 3)
+        self.canvas = mmap.mmap(self.file.fileno(), width * height * 3)
+
+    def write_page(self, width, height, samples, page_height):
+        if width == self.width and height == page_height:
+            self.canvas[self.offset:self.offset + len(samples)] = samples
+            self.offset += len(samples)
+            return
+        for row in fit_rows(samples, width, height, self.width, page_height):
+            self.canvas[self.offset:self.offset + len(row)] = row
+            self.offset += len(row)
+
+    def close(self):
+        try:
+            image = Image.frombuffer('RGB', (self.width, self.height), self.canvas, 'raw', 'RGB', 0, 1)
+            image.save(self.path, self.image_format.upper())
+            del image
+        finally:
+            self.canvas.close()
+            self.file.close()
+
+
+def open_image_writer(path, width, height, image_format):
+    """
+    Get a writer of a `width` x `height` image, pages are written one after the other.
+    PNG is encoded while the pages are written, other formats once the canvas is complete (CanvasWriter).
+    """
+    if image_format.lower() == 'png':
+        return PngStreamWriter(path, width, height)
+    return CanvasWriter(path, width, height, image_format)
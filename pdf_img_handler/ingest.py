@@ -0,0 +1,226 @@
+import multiprocessing, os, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import django
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from .search import index_pdf
+from .utils import MIME_SNIFF_SIZE, ProcessFileData, get_extension_from_mime, get_file_hash, get_mime_type, save_content
+
+# models are imported in the functions, this module is imported by the worker processes before django is set up
+
+
+def iter_files(root, after=None):
+    """
+    Yield the paths (relative to root, with '/') of the files of a directory tree, in path order.
+    With `after`, only the files after that path are yielded, and the directories before it are not read.
+    """
+    after_parts = tuple(after.split('/')) if after else None
+
+    def walk(parts):
+        with os.scandir(os.path.join(root, *parts)) as scan:
+            entries = sorted(scan, key=lambda entry: entry.name)
+        for entry in entries:
+            entry_parts = parts + (entry.name,)
+            if entry.is_dir(follow_symlinks=False):
+                if after_parts and entry_parts < after_parts[:len(entry_parts)]:
+                    continue
+                yield from walk(entry_parts)
+            elif entry.is_file():
+                if after_parts and entry_parts <= after_parts:
+                    continue
+                yield '/'.join(entry_parts)
+
+    yield from walk(())
+
+
+def inspect_file(path):
+    """
+    Sniff, hash and extract the metadata of a file (in a worker process).
+    Returns a dict with the extension, content_hash, file_type and meta_data,
+    or with 'skipped' or 'error' when the file can't be ingested.
+    """
+    try:
+        with open(path, 'rb') as file:
+            extension = get_extension_from_mime(get_mime_type(file.read(MIME_SNIFF_SIZE)))
+            if not extension:
+                return {'skipped': "Unsupported file type."}
+            file.seek(0)
+
+            content = File(file, name=f'ingest.{extension}')
+            content_hash = get_file_hash(content)
+            file_type, meta_data = ProcessFileData(content).get_file_data()
+            if not file_type:
+                return {'skipped': "Unsupported file type."}
+    except Exception as e:
+        return {'error': str(e)}
+
+    return {'extension': extension, 'content_hash': content_hash, 'file_type': file_type, 'meta_data': meta_data}
+
+
+def get_model_classes():
+    from .models import ImgFile, PdfFile
+    return {'pdf': PdfFile, 'img': ImgFile}
+
+
+def get_stored_files(content_hashes):
+    """
+    Get {content hash: (location, meta data)} of the stored files with one of the hashes.
+    """
+    stored_files = {}
+    for model_class in get_model_classes().values():
+        fields = ('content_hash', 'location') + model_class.meta_fields
+        for row in model_class.objects.filter(content_hash__in=content_hashes).values(*fields):
+            stored_files[row['content_hash']] = (row['location'], {field: row[field] for field in model_class.meta_fields})
+    return stored_files
+
+
+def store_file(path, model_class, content_hash, extension):
+    """
+    Copy a file to the storage of the model under its content hash, in chunks.
+    A file already copied under that name (by a batch interrupted before its checkpoint) is reused.
+    """
+    location_field = model_class._meta.get_field('location')
+    name = location_field.generate_filename(None, f"{content_hash}.{extension}")
+    with open(path, 'rb') as file:
+        return save_content(location_field.storage, name, File(file))
+
+
+class Ingest:
+    """
+    Ingest the image and PDF files of a directory tree, like uploads without HTTP:
+    files are sniffed, hashed and processed on a pool of `workers` processes, new contents are copied
+    to the storage, and rows are inserted with one query per model and batch.
+    Files with a stored content reuse the stored file and its metadata.
+    Progress is saved with every batch (IngestCheckpoint), running it again resumes after the last batch.
+    With `index_text`, the text of the new PDFs is indexed after every batch (see search.py),
+    the PDFs of a batch interrupted before are indexed by `manage.py index_text`.
+    """
+    def __init__(self, root, workers=None, batch_size=500, report=None, index_text=False):
+        self.root = os.path.abspath(root)
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.index_text = index_text
+        # called with the checkpoint and the files per second after every batch
+        self.report = report
+        self.errors = []
+
+    def get_checkpoint(self):
+        from .models import IngestCheckpoint
+        checkpoint, created = IngestCheckpoint.objects.get_or_create(root=self.root)
+        return checkpoint
+
+    def iter_batches(self, after):
+        batch = []
+        for path in iter_files(self.root, after):
+            batch.append(path)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self):
+        checkpoint = self.get_checkpoint()
+        batches = self.iter_batches(checkpoint.last_path)
+        start, start_count = time.perf_counter(), checkpoint.files_count
+
+        def save(batch, results):
+            self.save_batch(checkpoint, batch, results)
+            if self.report:
+                elapsed = time.perf_counter() - start
+                self.report(checkpoint, (checkpoint.files_count - start_count) / elapsed if elapsed else 0)
+
+        if self.workers <= 1:
+            for batch in batches:
+                save(batch, [inspect_file(os.path.join(self.root, path)) for path in batch])
+        else:
+            # spawned processes, forking a process with open database connections is not safe
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(self.workers, mp_context=context, initializer=django.setup) as executor:
+                # the next batch is processed while the current one is stored
+                pending = deque()
+                for batch in batches:
+                    pending.append((batch, [executor.submit(inspect_file, os.path.join(self.root, path)) for path in batch]))
+                    if len(pending) >= 2:
+                        batch, futures = pending.popleft()
+                        save(batch, [future.result() for future in futures])
+                while pending:
+                    batch, futures = pending.popleft()
+                    save(batch, [future.result() for future in futures])
+
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save(update_fields=['finished_at', 'updated_at'])
+        return checkpoint
+
+    def save_batch(self, checkpoint, batch, results):
+        """
+        Store the new contents of a batch, then insert its rows and move the checkpoint in one transaction.
+        The files copied for a batch which can't be saved get a tombstone, the reaper keeps the ones
+        referenced again (by the batch run again).
+        """
+        from .reaper import bury
+
+        model_classes = get_model_classes()
+        files = []
+        for path, result in zip(batch, results):
+            if 'error' in result:
+                self.errors.append((path, result['error']))
+                checkpoint.error_count += 1
+            elif 'skipped' in result:
+                checkpoint.skipped_count += 1
+            else:
+                files.append((path, result))
+
+        stored_files = get_stored_files({result['content_hash'] for path, result in files})
+
+        # every new content is copied once, on threads (I/O bound)
+        new_files = {}
+        for path, result in files:
+            if result['content_hash'] not in stored_files:
+                new_files.setdefault(result['content_hash'], (path, result))
+
+        def store(item):
+            path, result = item
+            return store_file(os.path.join(self.root, path), model_classes[result['file_type']], result['content_hash'], result['extension'])
+
+        saved_locations = []
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                futures = {content_hash: executor.submit(store, item) for content_hash, item in new_files.items()}
+            # the copies done are buried when another one fails too
+            saved_locations.extend(future.result() for future in futures.values() if not future.exception())
+            for content_hash, future in futures.items():
+                path, result = new_files[content_hash]
+                stored_files[content_hash] = (future.result(), result['meta_data'])
+
+            instances = {}
+            # (PdfFile, path) of the new PDFs, their text is indexed once they have an id
+            pdf_files = []
+            for path, result in files:
+                model_class = model_classes[result['file_type']]
+                location, meta_data = stored_files[result['content_hash']]
+                name = os.path.basename(path)[:model_class._meta.get_field('name').max_length]
+                instance = model_class(name=name, location=location, content_hash=result['content_hash'], **meta_data)
+                instances.setdefault(model_class, []).append(instance)
+                if result['file_type'] == 'pdf':
+                    pdf_files.append((instance, path))
+
+            with transaction.atomic():
+                for model_class, model_instances in instances.items():
+                    model_class.objects.bulk_create(model_instances)
+                checkpoint.last_path = batch[-1]
+                checkpoint.files_count += len(batch)
+                checkpoint.created_count += len(files)
+                checkpoint.save()
+        except Exception:
+            bury(saved_locations)
+            raise
+
+        if self.index_text:
+            for pdf_file, path in pdf_files:
+                try:
+                    index_pdf(pdf_file)
+                except Exception as e:
+                    self.errors.append((path, f"Text not indexed: {e}"))
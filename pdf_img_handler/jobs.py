@@ -0,0 +1,283 @@
+"""
+DB-backed queue of PDF to image conversions.
+Jobs are rows of ConversionJob, the worker pool (`manage.py run_jobs`) claims pending jobs
+and runs every attempt in its own process, so a job over its timeout can be killed.
+Models are imported inside the functions, the job process imports this module before django is set up.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+
+def get_conversion_cache():
+    from .cache import DerivativeCache
+    return DerivativeCache('conversions')
+
+
+def get_conversion_key(job):
+    """
+    Cache key of a conversion: source content, resolution, format and pages range.
+    """
+    page_range = f"{job.first_page or 1}-{job.last_page or job.pdf.pages_number}"
+    return get_conversion_cache().get_key(job.pdf.source_key, job.dpi, job.image_format, page_range)
+
+
+def enqueue_conversion(pdf, image_format='png', dpi=300, first_page=None, last_page=None):
+    """
+    Queue the conversion of a PDF file and return its job.
+    A conversion already in the cache is returned as a done job at once, without rendering it again,
+    and a conversion already queued or running returns its job instead of queuing it twice.
+    """
+    from .models import ConversionJob
+
+    job = ConversionJob(
+        pdf=pdf,
+        image_format=image_format,
+        dpi=dpi,
+        first_page=first_page,
+        last_page=last_page,
+        max_attempts=settings.CONVERSION_JOB_MAX_ATTEMPTS,
+        timeout=settings.CONVERSION_JOB_TIMEOUT,
+    )
+
+    conversion_cache = get_conversion_cache()
+    job.key = get_conversion_key(job)
+    cached_file = conversion_cache.get(job.key)
+    if cached_file:
+        job.status = ConversionJob.DONE
+        job.progress = 100
+        job.result = conversion_cache.get_url(cached_file)
+        job.finished_at = timezone.now()
+    else:
+        queued_job = ConversionJob.objects.filter(
+            key=job.key, status__in=[ConversionJob.PENDING, ConversionJob.RUNNING],
+        ).order_by('id').first()
+        if queued_job:
+            return queued_job
+
+    job.save()
+    return job
+
+
+def claim_next_job():
+    """
+    Mark the oldest pending job as running and return it, None when the queue is empty.
+    Jobs waiting for their retry delay (not_before) are left in the queue.
+    The status update only matches a pending row, so two workers can't claim the same job.
+    """
+    from .models import ConversionJob
+
+    while True:
+        ready = Q(not_before=None) | Q(not_before__lte=timezone.now())
+        job = ConversionJob.objects.filter(ready, status=ConversionJob.PENDING).order_by('created_at', 'id').first()
+        if not job:
+            return None
+
+        claimed = ConversionJob.objects.filter(id=job.id, status=ConversionJob.PENDING).update(
+            status=ConversionJob.RUNNING,
+            attempts=job.attempts + 1,
+            started_at=timezone.now(),
+            progress=0,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def requeue_stale_jobs():
+    """
+    Put back in the queue the running jobs which are past their timeout, left by a worker which died.
+    Run by the worker pool every CONVERSION_JOB_REQUEUE_INTERVAL seconds.
+    """
+    from .models import ConversionJob
+
+    now = timezone.now()
+    running_jobs = ConversionJob.objects.filter(status=ConversionJob.RUNNING)
+    for job in running_jobs:
+        if job.started_at and job.started_at + timedelta(seconds=job.timeout * 2) < now:
+            fail_job(job, "Worker stopped while running the job.")
+
+
+def convert(job_id):
+    """
+    Run one attempt of a job, and record its result.
+    """
+    from .models import ConversionJob
+
+    job = ConversionJob.objects.select_related('pdf').get(id=job_id)
+
+    def progress(pages_done, pages_number):
+        ConversionJob.objects.filter(id=job_id).update(progress=int(pages_done * 100 / pages_number))
+
+    # the image is rendered to the conversions cache
+    conversion_cache = get_conversion_cache()
+    key = job.key or get_conversion_key(job)
+    name = conversion_cache.get_name(key, job.image_format)
+
+    # the error of the conversion is stored on the job
+    result = job.pdf.convert_to_image(job.image_format, progress=progress, dpi=job.dpi,
+                                      page_numbers=job.get_page_numbers(), output_name=name, raise_errors=True)
+    conversion_cache.add(key, job.pdf.source_key, name)
+
+    ConversionJob.objects.filter(id=job_id).update(
+        status=ConversionJob.DONE,
+        progress=100,
+        result=result,
+        error='',
+        finished_at=timezone.now(),
+    )
+
+
+def convert_in_process(job_id):
+    """
+    Entry point of the process running a job attempt, errors are stored on the job.
+    """
+    import django
+    django.setup()
+
+    from .models import ConversionJob
+
+    try:
+        convert(job_id)
+    except Exception:
+        ConversionJob.objects.filter(id=job_id).update(error=traceback.format_exc(limit=3))
+        raise SystemExit(1)
+
+
+def run_in_process_group(target, *args):
+    """
+    Run target(*args) as the leader of a new process group (POSIX), the processes it starts
+    (the page rendering pool) are in the group and are killed with it.
+    """
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    target(*args)
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError):
+        # no process groups (Windows), or the process didn't lead its group yet
+        process.kill()
+    process.join()
+
+
+def fail_job(job, error):
+    """
+    Put a failed attempt back in the queue, or mark the job as failed when it has no attempts left.
+    A job put back is retried after CONVERSION_JOB_RETRY_DELAY seconds, doubled after every attempt.
+    """
+    from .models import ConversionJob
+
+    not_before = None
+    if job.attempts < job.max_attempts:
+        status, finished_at = ConversionJob.PENDING, None
+        delay = settings.CONVERSION_JOB_RETRY_DELAY * 2 ** max(job.attempts - 1, 0)
+        not_before = timezone.now() + timedelta(seconds=delay)
+    else:
+        status, finished_at = ConversionJob.FAILED, timezone.now()
+
+    ConversionJob.objects.filter(id=job.id).update(status=status, error=error, finished_at=finished_at, not_before=not_before)
+
+
+def run_job(job, isolate=True):
+    """
+    Run a claimed job.
+    Isolated jobs run in a new process which is killed after the job timeout, with the processes
+    rendering its pages, otherwise the job runs in the current thread without timeout.
+    """
+    from .models import ConversionJob
+
+    if not isolate:
+        try:
+            convert(job.id)
+        except Exception as e:
+            fail_job(job, str(e))
+        return
+
+    # spawn a clean process, a forked one would share the parent database connections.
+    # It isn't daemonic, a daemonic process can't start the page rendering pool (PDF_RENDER_WORKERS)
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=run_in_process_group, args=(convert_in_process, job.id))
+    process.start()
+    process.join(job.timeout)
+
+    if process.is_alive():
+        kill_process_group(process)
+        fail_job(job, f"Conversion timed out after {job.timeout} seconds.")
+    elif process.exitcode != 0:
+        error = ConversionJob.objects.filter(id=job.id).values_list('error', flat=True).first()
+        fail_job(job, error or f"Conversion process exited with code {process.exitcode}.")
+
+
+def process_next_job(isolate=True):
+    """
+    Claim and run the next pending job, returns False when the queue is empty.
+    """
+    job = claim_next_job()
+    if not job:
+        return False
+    run_job(job, isolate)
+    return True
+
+
+class JobWorkerPool:
+    """
+    Pool of worker threads, each one claiming and running jobs until the pool is stopped,
+    and a thread putting back in the queue the jobs of the workers which died.
+    """
+    def __init__(self, workers=None, isolate=True, poll_interval=None, requeue_interval=None):
+        self.workers = workers or settings.CONVERSION_JOB_WORKERS
+        self.isolate = isolate
+        self.poll_interval = poll_interval or settings.CONVERSION_JOB_POLL_INTERVAL
+        self.requeue_interval = requeue_interval or settings.CONVERSION_JOB_REQUEUE_INTERVAL
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def work(self):
+        while not self.stop_event.is_set():
+            close_old_connections()
+            try:
+                has_job = process_next_job(self.isolate)
+            except Exception:
+                traceback.print_exc()
+                has_job = False
+            if not has_job:
+                self.stop_event.wait(self.poll_interval)
+
+    def requeue(self):
+        while not self.stop_event.is_set():
+            close_old_connections()
+            try:
+                requeue_stale_jobs()
+            except Exception:
+                traceback.print_exc()
+            self.stop_event.wait(self.requeue_interval)
+
+    def start(self):
+        for target in [self.requeue] + [self.work] * self.workers:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stop()
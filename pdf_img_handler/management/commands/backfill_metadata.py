@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from pdf_img_handler.backfill import ORPHAN_MIN_AGE, Backfill, find_dangling_rows, find_orphaned_files
+from pdf_img_handler.reaper import bury
+
+
+class Command(BaseCommand):
+    help = "Recompute the metadata of the files extracted by an older extractor version, and check the stored files against the rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Processes extracting the metadata (the number of CPUs by default).")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows updated per transaction.")
+        parser.add_argument('--force', action='store_true', help="Recompute every row, whatever its extractor version.")
+        parser.add_argument('--check-files', action='store_true', help="Report the rows without a stored file and the stored files without a row.")
+        parser.add_argument('--delete-orphans', action='store_true', help="Bury the stored files without a row, the reaper deletes them unless a row references them again (implies --check-files).")
+        parser.add_argument('--orphan-min-age', type=int, default=ORPHAN_MIN_AGE, help="Seconds before a file without a row is an orphan.")
+
+    def handle(self, *args, **options):
+        def report(name, updated, rows_per_second):
+            self.stdout.write(f"{name}: {updated} rows updated, {rows_per_second:.1f} rows/s")
+
+        backfill = Backfill(workers=options['workers'], chunk_size=options['chunk_size'], force=options['force'], report=report)
+        counts = backfill.run()
+        for name, row_id, location, error in backfill.errors:
+            self.stderr.write(f"{name} {row_id} ({location}): {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated {counts['img']} image(s) and {counts['pdf']} PDF(s), {len(backfill.errors)} error(s)."
+        ))
+
+        if not (options['check_files'] or options['delete_orphans']):
+            return
+
+        dangling = 0
+        for name, row_id, location in find_dangling_rows():
+            dangling += 1
+            self.stdout.write(f"Missing file of {name} {row_id}: {location}")
+
+        orphans = 0
+        buried = []
+        for name in find_orphaned_files(min_age=options['orphan_min_age']):
+            orphans += 1
+            if options['delete_orphans']:
+                # the reaper checks the references again before the delete, an upload may reuse the file meanwhile
+                buried.append(name)
+                self.stdout.write(f"Buried orphaned file: {name}")
+                if len(buried) >= 1000:
+                    bury(buried)
+                    buried = []
+            else:
+                self.stdout.write(f"Orphaned file: {name}")
+        bury(buried)
+        self.stdout.write(self.style.SUCCESS(f"{dangling} row(s) without a file, {orphans} orphaned file(s)."))
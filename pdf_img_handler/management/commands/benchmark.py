@@ -0,0 +1,53 @@
+import os, tempfile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from pdf_img_handler.benchmark import BENCHMARKS, PROFILES, compare_results, generate_corpus, get_environment, run_benchmarks, write_results
+
+
+class Command(BaseCommand):
+    help = "Benchmark metadata extraction, rotation, conversion and uploads on a generated corpus, and write the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=PROFILES.keys(), default='default', help="Size of the corpus and number of runs.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the generated corpus.")
+        parser.add_argument('--corpus', default=None, help="Directory of the generated corpus, kept between runs (a temporary directory by default).")
+        parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=None, help="Benchmarks to run.")
+        parser.add_argument('--output', default='-', help="JSON output file, '-' for the standard output.")
+        parser.add_argument('--compare', default=None, help="JSON output of a previous run to compare with.")
+
+    def handle(self, *args, **options):
+        import json
+        profile, seed = options['profile'], options['seed']
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            corpus_dir = options['corpus'] or os.path.join(work_dir, 'corpus')
+            self.stderr.write(f"Generating the '{profile}' corpus in {corpus_dir}...")
+            corpus = generate_corpus(corpus_dir, profile, seed)
+
+            # rows go to a test database and files to a temporary media directory, never to the real ones
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(MEDIA_ROOT=os.path.join(work_dir, 'media'), ALLOWED_HOSTS=['testserver']):
+                    results = run_benchmarks(corpus, profile, options['only'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = write_results(options['output'], get_environment(profile, seed), results)
+        if output:
+            self.stdout.write(output)
+
+        for result in results:
+            latency = result['latency_ms']
+            self.stderr.write(
+                f"{result['name']:<18} {result['ops_per_second']:>10.1f} ops/s {result['bytes_per_second'] / 2 ** 20:>9.1f} MB/s "
+                f"p50 {latency['p50']:>9.2f} ms  p99 {latency['p99']:>9.2f} ms  peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MB"
+            )
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)
+            for name, throughput, latency in compare_results(results, baseline):
+                style = self.style.ERROR if throughput < -10 else self.style.SUCCESS
+                self.stderr.write(style(f"{name:<18} throughput {throughput:+.1f}%  p50 latency {latency:+.1f}%"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from pdf_img_handler.search import TextIndexer
+
+
+class Command(BaseCommand):
+    help = "Index the text of the PDF pages not indexed yet, for the search endpoint."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Index the text of every PDF again.")
+        parser.add_argument('--chunk-size', type=int, default=100, help="PDFs read from the database at a time.")
+        parser.add_argument('--watch', action='store_true', help="Keep running, indexing the new PDFs as they are uploaded.")
+        parser.add_argument('--interval', type=int, default=10, help="Seconds between two checks for new PDFs (with --watch).")
+
+    def handle(self, *args, **options):
+        if options['force'] and options['watch']:
+            raise CommandError("--force can't be used with --watch.")
+
+        indexer = TextIndexer(force=options['force'], chunk_size=options['chunk_size'], poll_interval=options['interval'])
+        if options['watch']:
+            self.stdout.write(f"Indexing new PDFs every {indexer.poll_interval}s, press CTRL+C to stop.")
+            indexer.run_forever()
+            return
+
+        count = indexer.index()
+        for pdf_id, error in indexer.errors:
+            self.stderr.write(f"PdfFile {pdf_id}: {error}")
+        self.stdout.write(self.style.SUCCESS(f"Indexed the text of {count} PDF(s), {len(indexer.errors)} error(s)."))
@@ -0,0 +1,40 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from pdf_img_handler.ingest import Ingest
+from pdf_img_handler.models import IngestCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Ingest the images and PDFs of a directory tree, resuming after the last ingested file of a previous run."
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="Directory to ingest, with its sub directories.")
+        parser.add_argument('--workers', type=int, default=None, help="Processes extracting the metadata (the number of CPUs by default).")
+        parser.add_argument('--batch-size', type=int, default=500, help="Files inserted per transaction.")
+        parser.add_argument('--index-text', action='store_true', help="Index the text of the new PDFs for the search endpoint.")
+        parser.add_argument('--restart', action='store_true', help="Forget the progress of previous runs and ingest every file.")
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options['directory'])
+        if not os.path.isdir(root):
+            raise CommandError(f"{root} is not a directory.")
+
+        if options['restart']:
+            IngestCheckpoint.objects.filter(root=root).delete()
+
+        def report(checkpoint, files_per_second):
+            self.stdout.write(
+                f"{checkpoint.files_count} files ({checkpoint.created_count} ingested, {checkpoint.skipped_count} skipped, "
+                f"{checkpoint.error_count} errors), {files_per_second:.1f} files/s"
+            )
+
+        ingest = Ingest(
+            root, workers=options['workers'], batch_size=options['batch_size'], report=report, index_text=options['index_text'],
+        )
+        checkpoint = ingest.run()
+
+        for path, error in ingest.errors:
+            self.stderr.write(f"{path}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Ingested {checkpoint.created_count} of {checkpoint.files_count} files from {root}."
+        ))
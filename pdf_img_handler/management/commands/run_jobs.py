@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from pdf_img_handler.jobs import JobWorkerPool, process_next_job
+
+
+class Command(BaseCommand):
+    help = "Run the worker pool of the background PDF conversion jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Number of jobs run at the same time.")
+        parser.add_argument('--once', action='store_true', help="Run the pending jobs one by one, then exit.")
+        parser.add_argument('--no-isolate', action='store_true', help="Run jobs in the worker threads, without timeout.")
+
+    def handle(self, *args, **options):
+        isolate = not options['no_isolate']
+
+        if options['once']:
+            count = 0
+            while process_next_job(isolate):
+                count += 1
+            self.stdout.write(self.style.SUCCESS(f"Ran {count} job(s)."))
+            return
+
+        pool = JobWorkerPool(workers=options['workers'], isolate=isolate)
+        self.stdout.write(f"Running {pool.workers} job worker(s), press CTRL+C to stop.")
+        pool.run_forever()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from pdf_img_handler.reaper import Reaper
+
+
+class Command(BaseCommand):
+    help = "Remove the stored files of deleted rows and evicted derivatives (tombstones), at a limited rate."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Reap the tombstones past the grace period, then exit.")
+        parser.add_argument('--rate', type=float, default=None, help="Files removed per second at most.")
+
+    def handle(self, *args, **options):
+        reaper = Reaper(max_rate=options['rate'])
+
+        if options['once']:
+            count = reaper.reap()
+            self.stdout.write(self.style.SUCCESS(f"Reaped {count} tombstone(s)."))
+            return
+
+        self.stdout.write(f"Reaping tombstones every {reaper.poll_interval}s, press CTRL+C to stop.")
+        reaper.run_forever()
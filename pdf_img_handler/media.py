@@ -0,0 +1,177 @@
+import mimetypes
+import os
+import re
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+# originals and derivatives stored under their content hash or cache key (64 hex characters, maybe with a storage suffix)
+HASHED_NAME_RE = re.compile(r'^([0-9a-f]{64})(_[0-9A-Za-z]+)?$')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# bytes read from the file for every chunk of a response
+CHUNK_SIZE = 64 * 1024
+
+
+def get_stored_hash(location):
+    # content hash recorded on the rows of an original stored under another name (uploaded before the hashed names)
+    from .models import ImgFile, PdfFile
+    for model_class in (ImgFile, PdfFile):
+        content_hash = model_class.objects.filter(location=location).exclude(content_hash='').values_list('content_hash', flat=True).first()
+        if content_hash:
+            return content_hash
+    return None
+
+
+def get_etag(path, stat):
+    """
+    ETag of a media file, and whether the file never changes:
+    the content hash in its name or stored on its row (strong), or its modification time and size (weak).
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    match = HASHED_NAME_RE.match(name)
+    if match:
+        return f'"{match.group(1)}"', True
+    content_hash = get_stored_hash(os.path.relpath(path, settings.MEDIA_ROOT).replace('\\', '/'))
+    if content_hash:
+        # the name may be given to another file once the row is deleted, so it isn't cached for ever
+        return f'"{content_hash}"', False
+    return f'W/"{int(stat.st_mtime)}-{stat.st_size}"', False
+
+
+def parse_range(header, size):
+    """
+    Get (start, end) (inclusive) of a single bytes range, None when the whole file is sent.
+    Raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    # several ranges are not supported, the whole file is sent instead
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # suffix range, the last bytes of the file
+        length = int(end)
+        if length == 0:
+            raise ValueError
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError
+    return start, end
+
+
+def iter_file(file, start, length):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def sendfile_response(path):
+    """
+    Response asking the front proxy to send the file itself (MEDIA_SENDFILE), the app sends no bytes.
+    """
+    response = HttpResponse()
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        # nginx internal location serving MEDIA_ROOT
+        relative_path = os.path.relpath(path, settings.MEDIA_ROOT).replace('\\', '/')
+        response['X-Accel-Redirect'] = settings.MEDIA_SENDFILE_PREFIX + relative_path
+    else:
+        response['X-Sendfile'] = path
+    # the proxy sets the content type from the file
+    del response['Content-Type']
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve an original or a derived file of MEDIA_ROOT, with ETag and Last-Modified validators
+    (304 responses), single bytes range requests (206 responses), and optional offload to the front proxy.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("File not found.")
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404("File not found.")
+    if not os.path.isfile(full_path):
+        raise Http404("File not found.")
+
+    etag, immutable = get_etag(full_path, stat)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.MEDIA_SENDFILE:
+            response = sendfile_response(full_path)
+        else:
+            response = file_response(request, full_path, stat.st_size, etag, last_modified)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    # a file named by its content never changes
+    if immutable:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}'
+    return response
+
+
+def file_response(request, path, size, etag, last_modified):
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+
+    start, end = 0, size - 1
+    status = 200
+
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and size and range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range:
+            start, end = byte_range
+            status = 206
+
+    length = end - start + 1 if size else 0
+    body = iter_file(open(path, 'rb'), start, length) if request.method != 'HEAD' else []
+    response = StreamingHttpResponse(body, status=status, content_type=content_type)
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+
+def range_matches(request, etag, last_modified):
+    """
+    Check the If-Range validator, a range of a changed file is not sent.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # only strong validators can be used with ranges
+        return not etag.startswith('W/') and if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
@@ -0,0 +1,135 @@
+import bisect, threading, time
+from contextlib import contextmanager
+from django.http import HttpResponse
+
+# upper bounds of the histogram buckets, in seconds and in bytes
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1KB to 1GB
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Counter per label values, in memory of the process.
+    """
+    type = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{format_labels(key)} {format_value(value)}'
+
+
+class Histogram:
+    """
+    Histogram per label values, an observation costs a lock and a binary search of its bucket.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # label values : [bucket counts (the last one for +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    def collect(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            # prometheus buckets are cumulative
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{format_labels(key + (("le", format_value(bound)),))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(key)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(key)} {count}'
+
+
+stage_duration = Histogram('pdf_img_handler_stage_duration_seconds', 'Time spent in each processing stage.', DURATION_BUCKETS)
+stage_size = Histogram('pdf_img_handler_stage_size_bytes', 'Bytes handled by each processing stage.', SIZE_BUCKETS)
+stage_errors = Counter('pdf_img_handler_stage_errors_total', 'Processing stages which raised an error.')
+document_cache_requests = Counter('pdf_img_handler_document_cache_requests_total', 'Document cache lookups, by kind and result (hit or miss).')
+document_cache_evictions = Counter('pdf_img_handler_document_cache_evictions_total', 'Documents evicted from the document cache.')
+
+METRICS = [stage_duration, stage_size, stage_errors, document_cache_requests, document_cache_evictions]
+
+
+class Stage:
+    # set `size` in the `measure` block to record the bytes handled by the stage
+    size = None
+
+
+def observe(stage, seconds, size=None):
+    stage_duration.observe(seconds, stage=stage)
+    if size is not None:
+        stage_size.observe(size, stage=stage)
+
+
+@contextmanager
+def measure(stage, size=None):
+    """
+    Record the duration (and the size) of a processing stage, and count it as an error when it raises.
+    """
+    current = Stage()
+    current.size = size
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, current.size)
+
+
+def render_metrics():
+    """
+    Render every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    Prometheus endpoint, the metrics are the ones of the process serving the request.
+    """
+    return HttpResponse(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
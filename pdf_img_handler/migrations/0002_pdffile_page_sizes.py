@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdffile',
+            name='page_sizes',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0002_pdffile_page_sizes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imgfile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='pdffile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0004_conversionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('source_key', models.CharField(db_index=True, max_length=100)),
+                ('location', models.CharField(max_length=255)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='dpi',
+            field=models.PositiveSmallIntegerField(default=300),
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='first_page',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='last_page',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
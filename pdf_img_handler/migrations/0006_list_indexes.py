@@ -0,0 +1,45 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0005_cachedfile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='imgfile',
+            index=models.Index(fields=['created_at', 'id'], name='imgfile_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imgfile',
+            index=models.Index(fields=['width', 'height'], name='imgfile_width_height_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imgfile',
+            index=models.Index(fields=['height', 'width'], name='imgfile_height_width_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imgfile',
+            index=models.Index(fields=['channels_number', 'created_at'], name='imgfile_channels_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pdffile',
+            index=models.Index(fields=['created_at', 'id'], name='pdffile_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pdffile',
+            index=models.Index(fields=['page_width', 'page_height'], name='pdffile_width_height_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pdffile',
+            index=models.Index(fields=['page_height', 'page_width'], name='pdffile_height_width_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pdffile',
+            index=models.Index(fields=['pages_number', 'created_at'], name='pdffile_pages_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0006_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root', models.CharField(max_length=1024, unique=True)),
+                ('last_path', models.TextField(blank=True, default='')),
+                ('files_count', models.PositiveBigIntegerField(default=0)),
+                ('created_count', models.PositiveBigIntegerField(default=0)),
+                ('skipped_count', models.PositiveBigIntegerField(default=0)),
+                ('error_count', models.PositiveBigIntegerField(default=0)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0007_ingestcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imgfile',
+            name='extractor_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='pdffile',
+            name='extractor_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+    ]
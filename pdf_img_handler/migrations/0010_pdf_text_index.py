@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0009_tombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdffile',
+            name='text_indexed',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        # page texts of the PDFs, the rowid is the PdfFile id and the page number (see search.py)
+        migrations.RunSQL(
+            "CREATE VIRTUAL TABLE pdf_img_handler_pdfpagetext USING fts5(text, tokenize='unicode61 remove_diacritics 2')",
+            "DROP TABLE pdf_img_handler_pdfpagetext",
+        ),
+    ]
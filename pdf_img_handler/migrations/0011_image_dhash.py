@@ -0,0 +1,22 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0010_pdf_text_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imgfile',
+            name='dhash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='imgfile',
+            index=models.Index(fields=['updated_at'], name='imgfile_updated_idx'),
+        ),
+    ]
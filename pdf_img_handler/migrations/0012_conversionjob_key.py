@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0011_image_dhash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionjob',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pdf_img_handler', '0012_conversionjob_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionjob',
+            name='not_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
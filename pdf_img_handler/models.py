@@ -1,8 +1,18 @@
-from django.db import models
-from PIL import Image
+from django.db import models, transaction
 from django.conf import settings
+import logging
 import os
-import fitz  # PyMuPDF
+import tempfile
+import time
+from django.core.files import File
+from .documents import document_cache
+from .image_rotation import JPEGTRAN, is_right_angle, rotate_image_pillow, rotate_jpeg_exif, rotate_jpeg_lossless
+from .pdf_engine import iter_page_sizes, iter_rendered_pages, get_rendered_sizes
+from .image_writer import open_image_writer, get_max_dimension, is_canvas_format
+from .utils import ProcessImage, get_file_hash
+from .metrics import measure, observe
+
+logger = logging.getLogger(__name__)
 
 
 class BaseFile(models.Model):
@@ -10,6 +20,10 @@ class BaseFile(models.Model):
     Abstract model for files with name and timestamps.
     """
     name = models.CharField(max_length=255)
+    # SHA-256 of the file content, rows with the same content share the same stored file
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # version of the extractor (ProcessImage/ProcessPdf.version) which computed the metadata, 0 when unknown
+    extractor_version = models.PositiveSmallIntegerField(default=0, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -22,6 +36,50 @@ class BaseFile(models.Model):
     @property
     def get_file_location(self):
         return self.location.url
+
+    @property
+    def source_key(self):
+        """
+        Key of the file content for its cached derivatives, rows stored before content hashing use their id.
+        """
+        return self.content_hash or f'{self._meta.model_name}-{self.id}'
+
+    # fields holding the metadata extracted from the file
+    meta_fields = ()
+
+    def get_meta_data(self):
+        return {field: getattr(self, field) for field in self.meta_fields}
+
+    def get_references_count(self):
+        """
+        Count the rows referencing the same stored file (this one included).
+        """
+        return type(self).objects.filter(location=self.location.name).count()
+
+    def get_derived_locations(self):
+        """
+        Get the files (relative to MEDIA_ROOT) derived from this row only, deleted with it.
+        """
+        return []
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the row, and the stored file with its cached derivatives once no other row references it.
+        Files are not removed here, they get a tombstone removed by the reaper (see reaper.py).
+        """
+        from .cache import invalidate_source
+        from .reaper import bury
+
+        location = self.location.name
+        source_key = self.source_key
+        derived_locations = self.get_derived_locations()
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            bury(derived_locations)
+            if location and not type(self).objects.filter(location=location).exists():
+                bury([location])
+                invalidate_source(source_key)
+        return result
     
     
 # ---------------------------------------------------------------- 
@@ -34,27 +92,89 @@ class ImgFile(BaseFile):
     width = models.PositiveIntegerField(null=True)
     height = models.PositiveIntegerField(null=True)
     channels_number = models.PositiveIntegerField(null=True)
+    # perceptual hash of the pixels for the near-duplicate searches (see image_hash.py), null until computed
+    dhash = models.BigIntegerField(null=True, blank=True)
+
+    meta_fields = ('width', 'height', 'channels_number', 'dhash', 'extractor_version')
 
-    def rotate(self):
+    class Meta:
+        # list pagination and filters
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='imgfile_created_id_idx'),
+            models.Index(fields=['width', 'height'], name='imgfile_width_height_idx'),
+            models.Index(fields=['height', 'width'], name='imgfile_height_width_idx'),
+            models.Index(fields=['channels_number', 'created_at'], name='imgfile_channels_idx'),
+            # changed rows read by the perceptual hash index
+            models.Index(fields=['updated_at'], name='imgfile_updated_idx'),
+        ]
+
+    def rotate(self, angle=90, exif_only=False):
         """
-        Rotate the image by a fixed 90 degrees and save it back to its original location.
+        Rotate the image counter-clockwise by `angle` degrees (90 by default).
+        Right angles on JPEG images are lossless with jpegtran (when installed), or re-encoded with
+        the original quantization tables. `exif_only` rotates a JPEG image by changing its EXIF orientation only.
+        Other images are saved with their format options.
+        The rotated image is stored under its new content hash, so rows sharing the original file are not changed.
 
-        :return: Rotated image
+        :return: the image file
         """
-        # Open the image
-        image = Image.open(self.location.path)
+        source_path = self.location.path
+        extension = os.path.splitext(self.location.name)[1]
+        is_jpeg = extension.lower() in ('.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi')
 
-        # Rotate the image by a fixed 90 degrees
-        rotated_image = image.rotate(90, expand=True)  # expand=True ensures the entire image is visible
+        if exif_only and not (is_jpeg and is_right_angle(angle)):
+            raise ValueError("Only JPEG images can be rotated by a right angle with the EXIF orientation.")
 
-        # Save the rotated image back to the original file path
-        rotated_image.save(self.location.path)
+        with tempfile.NamedTemporaryFile(suffix=extension, dir=os.path.dirname(source_path)) as output:
+            if exif_only:
+                with measure('rotate_exif', self.location.size):
+                    rotate_jpeg_exif(source_path, output.name, angle)
+            else:
+                with measure('rotate', self.location.size):
+                    if is_jpeg and is_right_angle(angle) and JPEGTRAN:
+                        rotate_jpeg_lossless(source_path, output.name, angle)
+                    else:
+                        rotate_image_pillow(source_path, output.name, angle)
 
-        # Update the width, height, and channels_number fields after rotation
-        self.width, self.height = rotated_image.size
-        self.channels_number = len(rotated_image.getbands()) 
-        self.save()
-        return rotated_image
+            # Update the width, height, and channels_number fields after rotation,
+            # the extractor reports the displayed size, swapped by an EXIF only rotation
+            with open(output.name, 'rb') as rotated_file:
+                meta_data = ProcessImage().process_file(rotated_file)
+            self.width, self.height = meta_data['width'], meta_data['height']
+            self.channels_number = meta_data['channels_number']
+            self.dhash = meta_data['dhash']
+            self.extractor_version = ProcessImage.version
+
+            with measure('rotate_store', os.path.getsize(output.name)), transaction.atomic():
+                self.replace_file(output.name, extension)
+                self.save(update_fields=['location', 'content_hash', 'width', 'height', 'channels_number', 'dhash', 'extractor_version', 'updated_at'])
+        return self
+
+    def replace_file(self, path, extension):
+        """
+        Point the row to the content of `path`, stored under its content hash,
+        and delete the previous file when no other row references it.
+        """
+        from .cache import invalidate_source
+        from .reaper import bury
+
+        old_location = self.location.name
+        old_source_key = self.source_key
+        storage = self.location.storage
+
+        with open(path, 'rb') as file:
+            content = File(file)
+            content_hash = get_file_hash(content)
+            stored_file = type(self).objects.filter(content_hash=content_hash).exclude(id=self.id).first()
+            if stored_file:
+                self.location.name = stored_file.location.name
+            else:
+                self.location.name = storage.save(f'img/{content_hash}{extension}', content)
+        self.content_hash = content_hash
+
+        if not type(self).objects.filter(location=old_location).exclude(id=self.id).exists():
+            bury([old_location])
+            invalidate_source(old_source_key)
 
 
 
@@ -66,57 +186,244 @@ class PdfFile(BaseFile):
     page_width = models.PositiveIntegerField()
     page_height = models.PositiveIntegerField()
     pages_number = models.PositiveIntegerField(null=True)
+    # sizes of all pages as [width, height, rotation, count] runs of identical pages
+    page_sizes = models.JSONField(default=list, blank=True)
+    # the text of every page is in the full-text index (see search.py)
+    text_indexed = models.BooleanField(default=False, db_index=True)
 
-    def convert_to_image(self, image_format="png"):
-        """
-        Convert the entire PDF to a single image by combining all pages.
-        """
-        pdf_path = self.location.path
-        output_image_path = os.path.join(settings.MEDIA_ROOT, 'pdf_images', f'{self.id}.{image_format}')
+    meta_fields = ('page_width', 'page_height', 'pages_number', 'page_sizes', 'extractor_version')
 
-        try:
-            # Open the PDF file using PyMuPDF
-            doc = fitz.open(pdf_path)
+    class Meta:
+        # list pagination and filters
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='pdffile_created_id_idx'),
+            models.Index(fields=['page_width', 'page_height'], name='pdffile_width_height_idx'),
+            models.Index(fields=['page_height', 'page_width'], name='pdffile_height_width_idx'),
+            models.Index(fields=['pages_number', 'created_at'], name='pdffile_pages_idx'),
+        ]
 
-            # Create a list to hold the images of each page
-            images = []
+    def delete(self, *args, **kwargs):
+        from .search import delete_page_texts
 
-            # Loop through each page and convert it to an image
-            for page_num in range(doc.page_count):
-                page = doc.load_page(page_num)  # Load the page
-                pix = page.get_pixmap(dpi=300)  # Create a pixmap (image) from the page
+        with transaction.atomic():
+            delete_page_texts(self.id)
+            return super().delete(*args, **kwargs)
 
-                # Convert the pixmap to a PIL image
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                images.append(img)
+    def get_derived_locations(self):
+        # images written by convert_to_image without an output name
+        return [f'pdf_images/{self.id}.{image_format}' for image_format in ('png', 'jpeg', 'webp')]
 
-            # Combine all images into one (vertically in this case)
-            total_height = sum(img.height for img in images)
-            max_width = max(img.width for img in images)
+    def get_page_sizes(self):
+        """
+        Get the (width, height, rotation) of every page, in page order.
+        """
+        return list(iter_page_sizes(self.page_sizes))
+
+    def get_pages_number(self):
+        """
+        Get the number of pages, read from the document (kept open by the process) when it isn't stored.
+        """
+        if self.pages_number:
+            return self.pages_number
+        with document_cache.open(self.location.path) as doc:
+            return doc.page_count
 
-            # Create a new blank image with the combined size
-            combined_image = Image.new('RGB', (max_width, total_height))
+    def convert_to_image(self, image_format="png", progress=None, dpi=300, page_numbers=None, output_name=None, raise_errors=False):
+        """
+        Convert the entire PDF (or the pages of `page_numbers`) to a single image by combining the pages (vertically).
+        Pages are written to the image as soon as they are rendered, a PNG is encoded while they are written
+        so only a few pages are in memory, other formats are encoded from the complete image (CanvasWriter).
+        The resolution is lowered when the image would be larger than the format allows, or than
+        PDF_CONVERT_MAX_CANVAS_PIXELS for the formats other than PNG (PDF_CONVERT_DOWNSCALE).
+        `progress` is called with (rendered pages, total pages) after every page.
+        The image is saved to `output_name` (relative to MEDIA_ROOT), pdf_images/<id>.<format> by default.
+        Errors are logged and None is returned, or they are raised with `raise_errors`.
+        """
+        pdf_path = self.location.path
+        output_name = output_name or os.path.join('pdf_images', f'{self.id}.{image_format}')
+        output_image_path = os.path.join(settings.MEDIA_ROOT, output_name)
 
-            # Paste each image into the combined image
-            y_offset = 0
-            for img in images:
-                combined_image.paste(img, (0, y_offset))
-                y_offset += img.height
+        try:
+            max_pixels = settings.PDF_CONVERT_MAX_CANVAS_PIXELS if is_canvas_format(image_format) else None
+            dpi, page_sizes = self.get_render_sizes(dpi, get_max_dimension(image_format), page_numbers, max_pixels)
+            total_height = sum(height for width, height in page_sizes)
+            max_width = max(width for width, height in page_sizes)
 
             # Ensure the output directory exists
             output_dir = os.path.dirname(output_image_path)
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
 
-            # Save the combined image
-            combined_image.save(output_image_path, image_format.upper())
+            # Render the pages (in parallel) and write them to the combined image, in page order.
+            # The image is written to a temporary file first, so a conversion being written is never served
+            # and two conversions to the same file don't write it at the same time
+            with tempfile.NamedTemporaryFile(dir=output_dir, delete=False) as output:
+                pass
+            try:
+                with measure('convert') as stage:
+                    writer = open_image_writer(output.name, max_width, total_height, image_format)
+                    try:
+                        rendered_pages = iter_rendered_pages(pdf_path, dpi=dpi, page_numbers=page_numbers)
+                        # time waiting for every rendered page, then time writing it
+                        start = time.perf_counter()
+                        for page_num, (width, height, samples) in enumerate(rendered_pages):
+                            rendered = time.perf_counter()
+                            observe('convert_render', rendered - start, len(samples))
+                            writer.write_page(width, height, samples, page_sizes[page_num][1])
+                            observe('convert_write', time.perf_counter() - rendered, len(samples))
+                            del samples
+
+                            if progress:
+                                progress(page_num + 1, len(page_sizes))
+                            start = time.perf_counter()
+                    finally:
+                        writer.close()
+                    stage.size = os.path.getsize(output.name)
+                os.replace(output.name, output_image_path)
+            finally:
+                if os.path.exists(output.name):
+                    os.remove(output.name)
 
             # Normalize the output path for URLs (use forward slashes for URLs)
-            output_url_path = os.path.join('pdf_images', f'{self.id}.{image_format}')
-            output_url_path = output_url_path.replace("\\", "/")  # Ensure forward slashes for URLs
+            output_url_path = output_name.replace("\\", "/")  # Ensure forward slashes for URLs
 
             return os.path.join(settings.MEDIA_URL, output_url_path)
 
-        except Exception as e:
-            print(f"Error during PDF conversion: {e}")
-            return None
\ No newline at end of file
+        except Exception:
+            logger.exception("Error during PDF conversion of PdfFile %s", self.id)
+            if raise_errors:
+                raise
+            return None
+
+    def get_render_sizes(self, dpi, max_dimension, page_numbers=None, max_pixels=None):
+        """
+        Get the resolution and the rendered (width, height) of every page (of `page_numbers`),
+        with the resolution lowered until the combined image fits in `max_dimension`
+        and has at most `max_pixels` pixels.
+        """
+        page_sizes = get_rendered_sizes(self.location.path, dpi, page_numbers)
+        if not page_sizes:
+            raise ValueError("The PDF file has no pages.")
+
+        while True:
+            total_height = sum(height for width, height in page_sizes)
+            max_width = max(width for width, height in page_sizes)
+            size = max(total_height, max_width)
+            pixels = total_height * max_width
+            if size <= max_dimension and (max_pixels is None or pixels <= max_pixels):
+                return dpi, page_sizes
+
+            if not settings.PDF_CONVERT_DOWNSCALE or dpi <= 1:
+                if size > max_dimension:
+                    raise ValueError(f"The combined image would be {size} pixels, more than the {max_dimension} pixels limit.")
+                raise ValueError(f"The combined image would have {pixels} pixels, more than the {max_pixels} pixels limit.")
+
+            # scale down, then step down until the rounded page sizes fit
+            scale = max_dimension / size
+            if max_pixels is not None:
+                scale = min(scale, (max_pixels / pixels) ** 0.5)
+            dpi = max(min(dpi - 1, int(dpi * scale)), 1)
+            page_sizes = get_rendered_sizes(self.location.path, dpi, page_numbers)
+
+
+class ConversionJob(models.Model):
+    """
+    Model for a queued PDF to image conversion, run by the background workers (see jobs.py).
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    pdf = models.ForeignKey(PdfFile, on_delete=models.CASCADE, related_name='conversion_jobs')
+    image_format = models.CharField(max_length=10, default='png')
+    dpi = models.PositiveSmallIntegerField(default=300)
+    # pages range (1-based, inclusive), all the pages when empty
+    first_page = models.PositiveIntegerField(null=True, blank=True)
+    last_page = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    # percentage of rendered pages
+    progress = models.PositiveSmallIntegerField(default=0)
+    result = models.CharField(max_length=255, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    # seconds a single attempt may run before it is killed
+    timeout = models.PositiveIntegerField(default=300)
+    # conversions cache key of the result, a pending or running job is shared by the same conversions
+    key = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # a failed attempt is retried after this time (backoff)
+    not_before = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.pdf_id} -> {self.image_format} ({self.status})"
+
+    def get_page_numbers(self):
+        """
+        Get the 0-based numbers of the pages to convert, None for all the pages.
+        """
+        if self.first_page is None and self.last_page is None:
+            return None
+        return range((self.first_page or 1) - 1, self.last_page or self.pdf.get_pages_number())
+
+
+class CachedFile(models.Model):
+    """
+    Model for a file derived from an uploaded file (conversion, preview, ...) kept in the disk cache (see cache.py).
+    """
+    # hash of the cache namespace, source and parameters
+    key = models.CharField(max_length=64, unique=True)
+    # source_key of the file it is derived from
+    source_key = models.CharField(max_length=100, db_index=True)
+    # path relative to MEDIA_ROOT
+    location = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField(default=0)
+    last_used_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.location
+
+
+class IngestCheckpoint(models.Model):
+    """
+    Model for the progress of a directory ingest (see ingest.py), updated in the transaction inserting every batch,
+    so an interrupted ingest resumes after the last inserted file.
+    """
+    # absolute path of the ingested directory
+    root = models.CharField(max_length=1024, unique=True)
+    # path (relative to root) of the last ingested file, files are ingested in path order
+    last_path = models.TextField(blank=True, default='')
+    files_count = models.PositiveBigIntegerField(default=0)
+    created_count = models.PositiveBigIntegerField(default=0)
+    skipped_count = models.PositiveBigIntegerField(default=0)
+    error_count = models.PositiveBigIntegerField(default=0)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.root} ({self.files_count} files)"
+
+
+class Tombstone(models.Model):
+    """
+    Model for a stored file to delete, recorded in the transaction removing its last reference,
+    the file is removed later by the reaper (see reaper.py).
+    """
+    # path relative to MEDIA_ROOT
+    location = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.location
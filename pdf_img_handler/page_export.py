@@ -0,0 +1,132 @@
+import io, struct, time, zipfile
+from .metrics import observe
+from .pdf_engine import iter_rendered_pages
+
+# output : content type of the streamed exports
+EXPORT_CONTENT_TYPES = {
+    'zip': 'application/zip',
+    'tiff': 'image/tiff',
+}
+
+# TIFF field types
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+
+# the offsets of a (not Big) TIFF file are 32 bits
+TIFF_MAX_SIZE = 2 ** 32 - 1
+
+
+class StreamBuffer(io.RawIOBase):
+    """
+    Write only, not seekable file collecting the bytes written to it until they are taken.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_pages(pdf_path, dpi, page_numbers, image_format):
+    """
+    Yield (page number, width, height, encoded page) in page order, timing every page.
+    """
+    start = time.perf_counter()
+    rendered_pages = iter_rendered_pages(pdf_path, dpi=dpi, page_numbers=page_numbers, image_format=image_format)
+    for page_num, (width, height, data) in zip(page_numbers, rendered_pages):
+        observe('export_page', time.perf_counter() - start, len(data))
+        yield page_num, width, height, data
+        start = time.perf_counter()
+
+
+def iter_zip_export(pdf_path, dpi, page_numbers, image_format='png'):
+    """
+    Yield the bytes of a ZIP archive of the pages (0-based `page_numbers`) as `image_format` files, page by page.
+    The pages are already compressed, they are stored as they are.
+    """
+    buffer = StreamBuffer()
+    # the archive is written without seeking, with the sizes after every file
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for page_num, width, height, data in iter_pages(pdf_path, dpi, page_numbers, image_format):
+            archive.writestr(f'page-{page_num + 1:04d}.{image_format}', data)
+            yield buffer.take()
+    yield buffer.take()
+
+
+def get_tiff_page(width, height, dpi, offset, strip_size, is_last):
+    """
+    Get the IFD of an RGB, deflate compressed TIFF page written at `offset`, with its values.
+    Its strip follows it, and the next page follows the strip padded to an even length (IFDs start on a word boundary).
+    """
+    entries = 13
+    values_offset = offset + 2 + entries * 12 + 4
+    strip_offset = values_offset + 24
+    next_offset = 0 if is_last else strip_offset + strip_size + strip_size % 2
+    if strip_offset + strip_size > TIFF_MAX_SIZE:
+        raise ValueError("The TIFF file would be larger than 4GB.")
+
+    tags = [
+        (256, TIFF_LONG, 1, width),  # ImageWidth
+        (257, TIFF_LONG, 1, height),  # ImageLength
+        (258, TIFF_SHORT, 3, values_offset),  # BitsPerSample (8, 8, 8)
+        (259, TIFF_SHORT, 1, 8),  # Compression, deflate
+        (262, TIFF_SHORT, 1, 2),  # PhotometricInterpretation, RGB
+        (273, TIFF_LONG, 1, strip_offset),  # StripOffsets
+        (277, TIFF_SHORT, 1, 3),  # SamplesPerPixel
+        (278, TIFF_LONG, 1, height),  # RowsPerStrip, one strip
+        (279, TIFF_LONG, 1, strip_size),  # StripByteCounts
+        (282, TIFF_RATIONAL, 1, values_offset + 8),  # XResolution
+        (283, TIFF_RATIONAL, 1, values_offset + 16),  # YResolution
+        (284, TIFF_SHORT, 1, 1),  # PlanarConfiguration, chunky
+        (296, TIFF_SHORT, 1, 2),  # ResolutionUnit, inch
+    ]
+    ifd = [struct.pack('<H', entries)]
+    for tag, field_type, count, value in tags:
+        # single SHORT values are left-justified in the 4 bytes of the value
+        value_format = '<HH' if field_type == TIFF_SHORT and count == 1 else '<I'
+        value = (value, 0) if value_format == '<HH' else (value,)
+        ifd.append(struct.pack('<HHI', tag, field_type, count) + struct.pack(value_format, *value))
+    ifd.append(struct.pack('<I', next_offset))
+    values = struct.pack('<4H', 8, 8, 8, 0) + struct.pack('<II', dpi, 1) * 2
+    return b''.join(ifd) + values
+
+
+def iter_tiff_export(pdf_path, dpi, page_numbers):
+    """
+    Yield the bytes of a multi-page TIFF of the pages (0-based `page_numbers`), page by page.
+    Every page is written as its IFD then its strip, so the IFD of a page knows where the next one starts
+    and nothing is written back.
+    """
+    # little-endian, first IFD right after the header
+    yield b'II*\x00' + struct.pack('<I', 8)
+    offset = 8
+    last_page = page_numbers[-1]
+    for page_num, width, height, strip in iter_pages(pdf_path, dpi, page_numbers, 'tiff'):
+        page = get_tiff_page(width, height, dpi, offset, len(strip), page_num == last_page)
+        yield page
+        # the IFD size is even, an odd strip is padded so the next IFD starts on a word boundary
+        yield strip
+        if len(strip) % 2:
+            yield b'\x00'
+        offset += len(page) + len(strip) + len(strip) % 2
+
+
+def iter_export(output, pdf_path, dpi, page_numbers, image_format='png'):
+    if output == 'tiff':
+        return iter_tiff_export(pdf_path, dpi, page_numbers)
+    return iter_zip_export(pdf_path, dpi, page_numbers, image_format)
@@ -0,0 +1,220 @@
+import multiprocessing, os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .documents import document_cache
+from .image_writer import encode_page
+
+
+def get_file_source(file):
+    """
+    Get what a PDF library can open for a file: its path on disk when it has one
+    (uploads spooled to a temporary file, stored model and ingested files), otherwise its bytes.
+    Only uploads small enough to be spooled in memory have no path.
+    """
+    if hasattr(file, 'temporary_file_path'):
+        return file.temporary_file_path()
+    if isinstance(file, str):
+        return file
+
+    # a django File wraps the file object, a rolled over SpooledUploadFile is named after its temporary file
+    disk_file = getattr(file, 'file', file)
+    path = getattr(disk_file, 'name', None)
+    if isinstance(path, str) and os.path.isabs(path) and os.path.isfile(path):
+        disk_file.flush()
+        return path
+
+    file.seek(0)
+    return file.read()
+
+
+class PyMuPDFEngine:
+    """
+    PDF engine based on PyMuPDF (fitz), fast to parse and able to render pages.
+    """
+    name = 'pymupdf'
+
+    def __init__(self):
+        import fitz  # PyMuPDF
+        self.fitz = fitz
+
+    def open(self, file):
+        source = get_file_source(file)
+        if isinstance(source, str):
+            return self.fitz.open(source)
+        return self.fitz.open(stream=source, filetype='pdf')
+
+    def iter_pages(self, file):
+        """
+        Yield (width, height, rotation) of every page, loading pages one at a time.
+        """
+        with self.open(file) as doc:
+            yield from self.iter_document_pages(doc)
+
+    def iter_document_pages(self, doc):
+        for page in doc:
+            media_box = page.mediabox
+            yield media_box.width, media_box.height, page.rotation
+
+
+class PyPDF2Engine:
+    """
+    Pure python fallback PDF engine, only able to read the document structure.
+    """
+    name = 'pypdf2'
+
+    def __init__(self):
+        import PyPDF2
+        self.PyPDF2 = PyPDF2
+
+    def open(self, file):
+        if isinstance(file, str):
+            return self.PyPDF2.PdfReader(file)
+        file.seek(0)
+        return self.PyPDF2.PdfReader(file)
+
+    def iter_pages(self, file):
+        """
+        Yield (width, height, rotation) of every page, the page tree is walked lazily.
+        """
+        return self.iter_document_pages(self.open(file))
+
+    def iter_document_pages(self, pdf_reader):
+        for page in pdf_reader.pages:
+            media_box = page.mediabox
+            yield float(media_box.width), float(media_box.height), page.rotation % 360
+
+
+# engine name : engine class, in order of preference
+PDF_ENGINES = {
+    PyMuPDFEngine.name: PyMuPDFEngine,
+    PyPDF2Engine.name: PyPDF2Engine,
+}
+
+_engines = {}
+
+
+def get_pdf_engine(name=None):
+    """
+    Get the PDF engine set by the PDF_ENGINE setting, or the first one which can be imported.
+    Engines are built once per process.
+    An unknown or not installed engine set by PDF_ENGINE raises ImproperlyConfigured.
+    """
+    configured = not name
+    name = name or getattr(settings, 'PDF_ENGINE', None)
+    if name and name not in PDF_ENGINES:
+        raise ImproperlyConfigured(f"Unknown PDF engine {name!r}, the engines are {', '.join(PDF_ENGINES)}.")
+    names = [name] if name else list(PDF_ENGINES)
+
+    for engine_name in names:
+        if engine_name not in _engines:
+            try:
+                _engines[engine_name] = PDF_ENGINES[engine_name]()
+            except ImportError:
+                continue
+        return _engines[engine_name]
+
+    if configured and name:
+        raise ImproperlyConfigured(f"The PDF engine {name!r} set by PDF_ENGINE can't be imported.")
+    raise ImportError(f"No PDF engine available, tried {', '.join(names)}.")
+
+
+def encode_page_sizes(pages):
+    """
+    Run-length encode (width, height, rotation) pages as [width, height, rotation, count] runs.
+    A document with pages of the same size is stored as a single run.
+    """
+    runs = []
+    for width, height, rotation in pages:
+        page = [round(width, 2), round(height, 2), rotation]
+        if runs and runs[-1][:3] == page:
+            runs[-1][3] += 1
+        else:
+            runs.append(page + [1])
+    return runs
+
+
+def iter_page_sizes(runs):
+    """
+    Expand [width, height, rotation, count] runs back to a (width, height, rotation) per page.
+    """
+    for width, height, rotation, count in runs:
+        for _ in range(count):
+            yield width, height, rotation
+
+
+def get_rendered_sizes(pdf_path, dpi, page_numbers=None):
+    """
+    Get the (width, height) in pixels of the pages (all by default) rendered at `dpi`, without rendering them.
+    """
+    engine = get_pdf_engine('pymupdf')
+    matrix = engine.fitz.Matrix(dpi / 72, dpi / 72)
+    with document_cache.open(pdf_path) as doc:
+        if page_numbers is None:
+            page_numbers = range(doc.page_count)
+        sizes = []
+        for page_num in page_numbers:
+            rect = (doc.load_page(page_num).rect * matrix).irect
+            sizes.append((rect.width, rect.height))
+        return sizes
+
+
+# document opened once by every page rendering process
+_render_doc = None
+
+
+def init_render_worker(pdf_path):
+    global _render_doc
+    import fitz  # PyMuPDF
+    _render_doc = fitz.open(pdf_path)
+
+
+def get_page_result(pix, image_format=None):
+    # the page encoded where it is rendered, to encode the pages in parallel
+    if image_format:
+        return pix.width, pix.height, encode_page(pix.width, pix.height, pix.samples, image_format)
+    return pix.width, pix.height, pix.samples
+
+
+def render_page(page_num, dpi, image_format=None):
+    """
+    Render a page of the worker document, returns (width, height, RGB samples or the page encoded to `image_format`).
+    """
+    pix = _render_doc.load_page(page_num).get_pixmap(dpi=dpi)
+    return get_page_result(pix, image_format)
+
+
+def iter_rendered_pages(pdf_path, dpi=300, workers=None, page_numbers=None, image_format=None):
+    """
+    Yield (width, height, RGB samples) of the pages (all by default), in order.
+    With `image_format`, the pages are encoded to it (see encode_page) instead of the RGB samples.
+    Pages are rendered on a pool of `workers` processes (PDF_RENDER_WORKERS by default),
+    each one with its own open document. Only a few pages per worker are in flight at a time.
+    """
+    workers = workers or settings.PDF_RENDER_WORKERS
+    if page_numbers is None:
+        with document_cache.open(pdf_path) as doc:
+            page_numbers = range(doc.page_count)
+
+    # a single page or worker is rendered here from the cached document, without the cost of starting processes
+    if workers <= 1 or len(page_numbers) <= 1:
+        for page_num in page_numbers:
+            # the document is only locked while a page renders, not while it is used
+            with document_cache.open(pdf_path) as doc:
+                pix = doc.load_page(page_num).get_pixmap(dpi=dpi)
+            yield get_page_result(pix, image_format)
+        return
+
+    workers = min(workers, len(page_numbers))
+    # spawned processes, forking a threaded web or job worker is not safe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=init_render_worker, initargs=(pdf_path,)) as executor:
+        pending = deque()
+        for page_num in page_numbers:
+            pending.append(executor.submit(render_page, page_num, dpi, image_format))
+            # keep every worker busy, without rendering far ahead of the pages already used
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,87 @@
+import threading, time, traceback
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from .backfill import get_referenced_locations
+from .models import Tombstone
+
+
+def bury(locations):
+    """
+    Record a tombstone for every stored file (relative to MEDIA_ROOT) no row references anymore.
+    Called in the transaction removing the references, the tombstones are dropped with it on a rollback.
+    """
+    Tombstone.objects.bulk_create([Tombstone(location=location) for location in locations if location])
+
+
+class Reaper:
+    """
+    Remove the files of the tombstones, by batches, at most REAPER_MAX_FILES_PER_SECOND files per second
+    so it doesn't compete with the requests for the disk.
+    A tombstone is only reaped after REAPER_GRACE_PERIOD (responses being sent keep their file),
+    and its file is kept when a row references the same location again (a re-upload of the same content).
+    """
+    def __init__(self, batch_size=None, max_rate=None, grace_period=None, poll_interval=None):
+        self.batch_size = batch_size or settings.REAPER_BATCH_SIZE
+        self.max_rate = max_rate or settings.REAPER_MAX_FILES_PER_SECOND
+        self.grace_period = settings.REAPER_GRACE_PERIOD if grace_period is None else grace_period
+        self.poll_interval = poll_interval or settings.REAPER_POLL_INTERVAL
+        self.stop_event = threading.Event()
+        self.next_delete = 0
+
+    def throttle(self):
+        now = time.monotonic()
+        if self.next_delete > now:
+            time.sleep(self.next_delete - now)
+        self.next_delete = max(now, self.next_delete) + 1 / self.max_rate
+
+    def reap_batch(self):
+        """
+        Reap a batch of tombstones, returns the number of tombstones reaped.
+        """
+        cutoff = timezone.now() - timedelta(seconds=self.grace_period)
+        tombstones = list(Tombstone.objects.filter(created_at__lte=cutoff).order_by('id').values_list('id', 'location')[:self.batch_size])
+        if not tombstones:
+            return 0
+
+        referenced = get_referenced_locations({location for tombstone_id, location in tombstones})
+        deleted = set()
+        for tombstone_id, location in tombstones:
+            if location in referenced or location in deleted:
+                continue
+            self.throttle()
+            # checked again right before the delete, the batch check is older than the throttled deletes before it
+            if get_referenced_locations([location]):
+                continue
+            # missing files are ignored, a tombstone may be reaped twice after a crash
+            default_storage.delete(location)
+            deleted.add(location)
+
+        Tombstone.objects.filter(id__in=[tombstone_id for tombstone_id, location in tombstones]).delete()
+        return len(tombstones)
+
+    def reap(self):
+        """
+        Reap every tombstone past the grace period, returns the number of tombstones reaped.
+        """
+        count = 0
+        while not self.stop_event.is_set():
+            reaped = self.reap_batch()
+            count += reaped
+            if reaped < self.batch_size:
+                break
+        return count
+
+    def run_forever(self):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                try:
+                    self.reap()
+                except Exception:
+                    traceback.print_exc()
+                self.stop_event.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            self.stop_event.set()
@@ -0,0 +1,187 @@
+import html, logging, threading
+from itertools import islice
+from django.db import close_old_connections, connection, transaction
+from .documents import document_cache
+
+logger = logging.getLogger(__name__)
+
+# models are imported in the functions, this module is imported by the ingest before django is set up
+
+# FTS5 table of the page texts (migration 0010), its rowid is (PdfFile id << PAGE_BITS) + page number
+PAGE_TEXT_TABLE = 'pdf_img_handler_pdfpagetext'
+PAGE_BITS = 20
+# pages after this one are not indexed
+MAX_PAGES = 2 ** PAGE_BITS - 1
+# pages written per transaction, the database is not locked while a long document is read
+PAGES_PER_TRANSACTION = 100
+# marks of the matched terms in the snippets, replaced once the snippet is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+SNIPPET_TOKENS = 16
+
+
+def get_rowid(pdf_id, page):
+    return (pdf_id << PAGE_BITS) + page
+
+
+def iter_page_texts(path):
+    """
+    Yield (page number (1-based), text) of the pages of a PDF, one page at a time,
+    so the text of a large document is never in memory at once.
+    """
+    with document_cache.open(path) as doc:
+        page_count = min(doc.page_count, MAX_PAGES)
+    for page_num in range(page_count):
+        with document_cache.open(path) as doc:
+            text = doc.load_page(page_num).get_text()
+        yield page_num + 1, text.replace(MATCH_START, '').replace(MATCH_END, '')
+
+
+def delete_page_texts(pdf_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {PAGE_TEXT_TABLE} WHERE rowid BETWEEN %s AND %s',
+            [get_rowid(pdf_id, 0), get_rowid(pdf_id, MAX_PAGES)],
+        )
+
+
+def index_pdf(pdf_file):
+    """
+    Index the text of the pages of a PdfFile, replacing its previous text.
+    The text of a content already indexed for another row is copied instead of being extracted again.
+    Pages are written PAGES_PER_TRANSACTION at a time, the PDF is searchable once all of them are.
+    Returns the number of pages with text.
+    """
+    from .models import PdfFile
+
+    with transaction.atomic():
+        PdfFile.objects.filter(id=pdf_file.id).update(text_indexed=False)
+        delete_page_texts(pdf_file.id)
+        indexed_id = None
+        if pdf_file.content_hash:
+            indexed_id = PdfFile.objects.filter(content_hash=pdf_file.content_hash, text_indexed=True).values_list('id', flat=True).first()
+        if indexed_id:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {PAGE_TEXT_TABLE} (rowid, text) SELECT rowid - %s, text FROM {PAGE_TEXT_TABLE} WHERE rowid BETWEEN %s AND %s',
+                    [get_rowid(indexed_id, 0) - get_rowid(pdf_file.id, 0), get_rowid(indexed_id, 0), get_rowid(indexed_id, MAX_PAGES)],
+                )
+                count = cursor.rowcount
+            PdfFile.objects.filter(id=pdf_file.id).update(text_indexed=True)
+            return count
+
+    count = 0
+    # scanned pages without a text layer are not stored
+    pages = ((page, text) for page, text in iter_page_texts(pdf_file.location.path) if text.strip())
+    while chunk := list(islice(pages, PAGES_PER_TRANSACTION)):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {PAGE_TEXT_TABLE} (rowid, text) VALUES (%s, %s)',
+                [(get_rowid(pdf_file.id, page), text) for page, text in chunk],
+            )
+        count += len(chunk)
+    PdfFile.objects.filter(id=pdf_file.id).update(text_indexed=True)
+    return count
+
+
+def build_match_query(query):
+    """
+    Build the FTS5 query of a user query: every term must be on the page, terms are matched as they are
+    (no FTS5 operators), and a term ending with * matches the words starting with it.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if term:
+            terms.append('"' + term.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def format_snippet(snippet):
+    # the page text is escaped, only the marks of the matched terms are HTML
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def search_pages(q, limit=20, offset=0):
+    """
+    Search the indexed pages, best matches first (bm25).
+    Returns a dict per page with the PDF id and name, the page number (1-based), a snippet and the score.
+    """
+    match = build_match_query(q)
+    if not match:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {PAGE_TEXT_TABLE}.rowid, p.name, snippet({PAGE_TEXT_TABLE}, 0, %s, %s, %s, %s), {PAGE_TEXT_TABLE}.rank '
+            f'FROM {PAGE_TEXT_TABLE} JOIN pdf_img_handler_pdffile p ON p.id = {PAGE_TEXT_TABLE}.rowid >> {PAGE_BITS} '
+            f'WHERE {PAGE_TEXT_TABLE} MATCH %s AND p.text_indexed '
+            f'ORDER BY {PAGE_TEXT_TABLE}.rank LIMIT %s OFFSET %s',
+            [MATCH_START, MATCH_END, '…', SNIPPET_TOKENS, match, limit, offset],
+        )
+        rows = cursor.fetchall()
+
+    return [
+        {
+            'id': rowid >> PAGE_BITS,
+            'name': name,
+            'page': rowid & MAX_PAGES,
+            'snippet': format_snippet(snippet),
+            # bm25 ranks are negative, lower is better
+            'score': round(-rank, 4),
+        }
+        for rowid, name, snippet, rank in rows
+    ]
+
+
+class TextIndexer:
+    """
+    Index the text of the PDFs not indexed yet (all of them with `force`), in id order, by chunks of `chunk_size`.
+    Running forever, new PDFs (uploads) are indexed every `poll_interval` seconds.
+    """
+    def __init__(self, force=False, chunk_size=100, poll_interval=10):
+        self.force = force
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.last_id = 0
+        # (PdfFile id, error) of the PDFs which couldn't be indexed
+        self.errors = []
+        self.stop_event = threading.Event()
+
+    def index(self):
+        """
+        Index the PDFs after the last indexed id, returns the number of PDFs indexed.
+        """
+        from .models import PdfFile
+
+        queryset = PdfFile.objects.order_by('id')
+        if not self.force:
+            queryset = queryset.filter(text_indexed=False)
+
+        count = 0
+        while not self.stop_event.is_set():
+            pdf_files = list(queryset.filter(id__gt=self.last_id)[:self.chunk_size])
+            if not pdf_files:
+                break
+            for pdf_file in pdf_files:
+                try:
+                    index_pdf(pdf_file)
+                    count += 1
+                except Exception as e:
+                    self.errors.append((pdf_file.id, str(e)))
+                self.last_id = pdf_file.id
+        return count
+
+    def run_forever(self):
+        # PDFs which couldn't be indexed are tried again on the next start, not on every poll
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                self.index()
+                for pdf_id, error in self.errors:
+                    logger.warning("Text of PdfFile %s not indexed: %s", pdf_id, error)
+                self.errors.clear()
+                self.stop_event.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            self.stop_event.set()
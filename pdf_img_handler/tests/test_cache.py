@@ -0,0 +1,76 @@
+import pytest
+import os
+from pdf_img_handler.cache import DerivativeCache, evict, invalidate_source
+from pdf_img_handler.models import CachedFile
+from pdf_img_handler.reaper import Reaper
+
+
+def write_cached_file(cache, source_key, size, *params):
+    key = cache.get_key(source_key, *params)
+    name = cache.get_name(key, 'bin')
+    path = cache.get_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    return key, cache.add(key, source_key, name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cache_lru_eviction(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.DERIVATIVE_CACHE_MAX_SIZE = 250
+    cache = DerivativeCache('test')
+
+    first_key, first = write_cached_file(cache, 'source', 100, 1)
+    second_key, second = write_cached_file(cache, 'source', 100, 2)
+    assert cache.get(first_key) is not None
+
+    # the least recently used entry is evicted, with its file
+    CachedFile.objects.filter(id=second.id).update(last_used_at=first.last_used_at.replace(year=2000))
+    write_cached_file(cache, 'other', 100, 3)
+    assert cache.get(second_key) is None
+    # the file is removed by the reaper
+    assert os.path.exists(cache.get_path(second.location))
+    Reaper(grace_period=0).reap()
+    assert not os.path.exists(cache.get_path(second.location))
+    assert cache.get(first_key) is not None
+
+    invalidate_source('source')
+    Reaper(grace_period=0).reap()
+    assert not os.path.exists(cache.get_path(first.location))
+    assert list(CachedFile.objects.values_list('source_key', flat=True)) == ['other']
+
+    evict(max_size=0)
+    assert not CachedFile.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cache_concurrent_renders(settings, tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from django.db import connection
+    from pdf_img_handler.thumbnails import get_cached_thumbnail
+    settings.MEDIA_ROOT = str(tmp_path)
+    cache = DerivativeCache('test')
+    # both requests miss the cache before either records its thumbnail
+    rendered = threading.Barrier(2)
+
+    def render(output_path):
+        with open(output_path, 'wb') as file:
+            file.write(b'thumbnail')
+        rendered.wait(timeout=10)
+
+    def get_thumbnail():
+        try:
+            return get_cached_thumbnail('source', (10, 10), 'jpeg', render, cache=cache).id
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ids = list(executor.map(lambda index: get_thumbnail(), range(2)))
+    assert ids[0] == ids[1]
+    assert CachedFile.objects.count() == 1
+
+    # the same key recorded twice keeps the first entry
+    key = cache.get_key('source', 10, 10, 'jpeg')
+    assert cache.add(key, 'source', cache.get_name(key, 'jpeg')).id == ids[0]
@@ -20,3 +20,146 @@ def test_models_file():
     assert img_pdf.page_height == 200
     assert img_pdf.pages_number == 2
 
+
+
+@pytest.fixture
+def mixed_pdf(settings, tmp_path):
+    import fitz
+    settings.MEDIA_ROOT = str(tmp_path)
+
+    # pages of different widths, with some content
+    doc = fitz.open()
+    for width in [200, 100, 150]:
+        page = doc.new_page(width=width, height=80)
+        page.draw_rect(fitz.Rect(10, 10, 60, 40), color=(1, 0, 0), fill=(0, 0, 1))
+    doc.save(str(tmp_path / 'mixed.pdf'))
+    return PdfFile.objects.create(name="mixed", location='mixed.pdf', page_width=200, page_height=80, pages_number=3)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('image_format', ['png', 'webp'])
+def test_convert_to_image(mixed_pdf, tmp_path, image_format):
+    from PIL import Image
+    progress = []
+    assert mixed_pdf.convert_to_image(image_format, progress=lambda done, total: progress.append((done, total)), dpi=72)
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+
+    image = Image.open(tmp_path / 'pdf_images' / f'{mixed_pdf.id}.{image_format}')
+    assert image.size == (200, 240)
+    if image_format == 'png':
+        # narrower pages are padded with black
+        assert image.getpixel((150, 100)) == (0, 0, 0)
+        assert image.getpixel((5, 100)) == (255, 255, 255)
+        assert image.getpixel((30, 100)) == (0, 0, 255)
+
+
+@pytest.mark.django_db
+def test_convert_to_image_downscale(mixed_pdf, settings):
+    dpi, page_sizes = mixed_pdf.get_render_sizes(300, max_dimension=500)
+    assert dpi < 300
+    assert sum(height for width, height in page_sizes) <= 500
+
+    settings.PDF_CONVERT_DOWNSCALE = False
+    with pytest.raises(ValueError):
+        mixed_pdf.get_render_sizes(300, max_dimension=500)
+
+
+@pytest.mark.django_db
+def test_convert_to_image_canvas_pixels(mixed_pdf, tmp_path, settings, monkeypatch):
+    from PIL import Image
+    from pdf_img_handler import image_writer
+    # the JPEG canvas is decoded in memory to be encoded, its size is capped
+    settings.PDF_CONVERT_MAX_CANVAS_PIXELS = 20000
+    canvas_sizes = []
+    original_init = image_writer.CanvasWriter.__init__
+
+    def record_init(self, path, width, height, image_format):
+        canvas_sizes.append(width * height)
+        original_init(self, path, width, height, image_format)
+
+    monkeypatch.setattr(image_writer.CanvasWriter, '__init__', record_init)
+    assert mixed_pdf.convert_to_image('jpeg', dpi=72)
+    assert canvas_sizes and canvas_sizes[0] <= 20000
+    image = Image.open(tmp_path / 'pdf_images' / f'{mixed_pdf.id}.jpeg')
+    assert image.width * image.height <= 20000
+
+    # PNG is written row by row, it isn't capped
+    assert mixed_pdf.convert_to_image('png', dpi=72)
+    assert Image.open(tmp_path / 'pdf_images' / f'{mixed_pdf.id}.png').size == (200, 240)
+
+    settings.PDF_CONVERT_DOWNSCALE = False
+    with pytest.raises(ValueError):
+        mixed_pdf.convert_to_image('webp', dpi=72, raise_errors=True)
+
+
+def store_image(tmp_path, image, image_format, name, **options):
+    from pdf_img_handler.utils import ProcessImage
+    os.makedirs(tmp_path / 'img', exist_ok=True)
+    image.save(tmp_path / 'img' / name, image_format, **options)
+    with open(tmp_path / 'img' / name, 'rb') as file:
+        meta_data = ProcessImage().process_file(file)
+    return ImgFile.objects.create(name=name, location=f'img/{name}', **meta_data)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('image_format, name', [('PNG', 'rotate.png'), ('WEBP', 'rotate.webp'), ('JPEG', 'rotate.jpg')])
+def test_rotate(settings, tmp_path, image_format, name):
+    from PIL import Image
+    settings.MEDIA_ROOT = str(tmp_path)
+    image = Image.new('RGB', (64, 32), (255, 255, 255))
+    image.paste((255, 0, 0), (0, 0, 16, 16))
+    img_file = store_image(tmp_path, image, image_format, name)
+    other_file = ImgFile.objects.create(name='other', location=img_file.location.name, width=64, height=32)
+    original_path = img_file.location.path
+
+    # counter-clockwise: the red top left corner goes to the bottom left
+    img_file.rotate(90)
+    assert (img_file.width, img_file.height) == (32, 64)
+    rotated = Image.open(img_file.location.path).convert('RGB')
+    assert rotated.size == (32, 64)
+    assert rotated.getpixel((4, 60))[0] > 200 and rotated.getpixel((4, 60))[1] < 60
+
+    # the file shared with another row is kept
+    assert img_file.location.path != original_path
+    assert os.path.exists(original_path)
+    other_file.refresh_from_db()
+    assert other_file.location.path == original_path
+
+    img_file.rotate(45)
+    assert img_file.width > 32 and img_file.height > 64
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rotate_exif_only(settings, tmp_path):
+    from PIL import Image
+    settings.MEDIA_ROOT = str(tmp_path)
+    image = Image.new('RGB', (64, 32), (255, 255, 255))
+    image.paste((0, 0, 0), (0, 0, 32, 16))
+    img_file = store_image(tmp_path, image, 'JPEG', 'exif.jpg')
+    with open(img_file.location.path, 'rb') as file:
+        image_data = file.read()
+
+    img_file.rotate(90, exif_only=True)
+    assert (img_file.width, img_file.height) == (32, 64)
+    rotated = Image.open(img_file.location.path)
+    assert rotated.getexif()[0x0112] == 8
+    # the image data is not encoded again
+    with open(img_file.location.path, 'rb') as file:
+        assert file.read().endswith(image_data[image_data.index(b'\xff\xda'):])
+
+    # the extractor (backfill, uploads of the same content) and the thumbnails see the displayed image
+    from pdf_img_handler.utils import ProcessImage
+    from pdf_img_handler.thumbnails import render_image_thumbnail
+    with open(img_file.location.path, 'rb') as file:
+        meta_data = ProcessImage().read_file(file)
+    assert (meta_data['width'], meta_data['height']) == (32, 64)
+    assert meta_data['dhash'] == img_file.dhash
+    render_image_thumbnail(img_file.location.path, (16, 16), str(tmp_path / 'thumbnail.png'), 'png')
+    assert Image.open(tmp_path / 'thumbnail.png').size == (8, 16)
+
+    img_file.rotate(270, exif_only=True)
+    assert Image.open(img_file.location.path).getexif()[0x0112] == 1
+    assert (img_file.width, img_file.height) == (64, 32)
+
+    with pytest.raises(ValueError):
+        img_file.rotate(45, exif_only=True)
@@ -36,3 +36,25 @@ def test_serializer_valid_data():
 
 
 
+
+@pytest.mark.django_db
+def test_serializer_chunked_base64():
+    test_path = os.path.dirname(os.path.abspath(__file__))
+    img = os.path.join(test_path, 'test.webp')
+    with open(img, "rb") as file:
+        file_data = file.read()
+
+    # data URI prefix and line-wrapped base64 are both accepted
+    base64_img = base64.encodebytes(file_data).decode("utf-8")
+    serializer_img = Base64FileUploadSerializer(data={'file': 'data:image/webp;base64,' + base64_img})
+    assert serializer_img.is_valid() is True
+    file = serializer_img.validated_data['file']
+    assert file.name.endswith('.webp')
+    file.seek(0)
+    assert file.read() == file_data
+
+    # unsupported types are rejected from the header alone
+    base64_text = base64.b64encode(b"plain text " * 10000).decode("utf-8")
+    serializer_text = Base64FileUploadSerializer(data={'file': base64_text})
+    assert serializer_text.is_valid() is False
+    assert 'Unsupported file type' in str(serializer_text.errors)
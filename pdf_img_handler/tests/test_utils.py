@@ -0,0 +1,414 @@
+import pytest
+import io
+import os
+from PIL import Image
+from pdf_img_handler.image_header import read_image_header
+from pdf_img_handler.pdf_engine import iter_page_sizes, iter_rendered_pages
+from pdf_img_handler.utils import ProcessImage, ProcessPdf
+
+
+def make_image(mode, image_format, **options):
+    image = Image.new(mode, (123, 45))
+    if options.pop('transparency', False):
+        image.info['transparency'] = 0
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.parametrize('mode, image_format, options, channels_number', [
+    ('RGB', 'PNG', {}, 3),
+    ('RGBA', 'PNG', {}, 4),
+    ('L', 'PNG', {}, 1),
+    ('LA', 'PNG', {}, 2),
+    ('P', 'PNG', {}, 3),
+    ('P', 'PNG', {'transparency': True}, 4),
+    ('RGB', 'JPEG', {}, 3),
+    ('L', 'JPEG', {}, 1),
+    ('CMYK', 'JPEG', {}, 4),
+    ('RGB', 'JPEG', {'progressive': True}, 3),
+    ('RGB', 'WEBP', {}, 3),
+    ('RGBA', 'WEBP', {}, 4),
+    ('RGB', 'WEBP', {'lossless': True}, 3),
+    ('RGBA', 'WEBP', {'lossless': True}, 4),
+])
+def test_image_header(mode, image_format, options, channels_number):
+    file = make_image(mode, image_format, **options)
+    expected = {'width': 123, 'height': 45, 'channels_number': channels_number}
+
+    # the header parser and the Pillow fallback agree
+    assert read_image_header(file) == expected
+    assert file.tell() == 0
+    image = Image.open(file)
+    assert ProcessImage().get_channels_number(image) == channels_number
+
+
+def test_image_header_fallback():
+    # formats without a header parser are opened with Pillow
+    file = make_image('LA', 'TIFF')
+    assert read_image_header(file) is None
+    # a plain image has no darker pixels, its hash is 0
+    assert ProcessImage().process_file(file) == {'width': 123, 'height': 45, 'channels_number': 2, 'dhash': 0}
+
+
+@pytest.mark.parametrize('engine_name', ['pymupdf', 'pypdf2'])
+def test_process_pdf_page_sizes(settings, engine_name):
+    import fitz
+    settings.PDF_ENGINE = engine_name
+
+    # 3 A4 pages, 1 rotated letter page, 2 A4 pages
+    doc = fitz.open()
+    for width, height, rotation in [(595, 842, 0)] * 3 + [(612, 792, 90)] + [(595, 842, 0)] * 2:
+        page = doc.new_page(width=width, height=height)
+        page.set_rotation(rotation)
+    file = io.BytesIO(doc.tobytes())
+
+    meta_info = ProcessPdf().process_file(file)
+    assert meta_info['pages_number'] == 6
+    assert (meta_info['page_width'], meta_info['page_height']) == (595, 842)
+    assert meta_info['page_sizes'] == [[595, 842, 0, 3], [612, 792, 90, 1], [595, 842, 0, 2]]
+    assert list(iter_page_sizes(meta_info['page_sizes']))[3] == (612, 792, 90)
+
+
+def test_spooled_upload_path(settings):
+    import fitz
+    from django.core.files import File
+    from pdf_img_handler.pdf_engine import get_file_source
+    from pdf_img_handler.utils import SpooledUploadFile
+    doc = fitz.open()
+    doc.new_page(width=100, height=50)
+    data = doc.tobytes()
+
+    # a small upload stays in memory, a large one is opened from its temporary file
+    small = SpooledUploadFile(max_size=len(data))
+    small.write(data)
+    assert get_file_source(File(small, name='upload')) == data
+    large = SpooledUploadFile(max_size=len(data) - 1)
+    large.write(data)
+    path = get_file_source(File(large, name='upload'))
+    assert isinstance(path, str)
+    settings.PDF_ENGINE = 'pymupdf'
+    assert ProcessPdf().process_file(File(large, name='upload'))['page_sizes'] == [[100, 50, 0, 1]]
+    large.close()
+
+
+def test_pdf_engine_setting(settings, monkeypatch):
+    from django.core.exceptions import ImproperlyConfigured
+    from pdf_img_handler import pdf_engine
+    settings.PDF_ENGINE = 'pymupdff'
+    with pytest.raises(ImproperlyConfigured):
+        pdf_engine.get_pdf_engine()
+
+    # the configured engine is not installed
+    def not_installed():
+        raise ImportError
+    monkeypatch.setattr(pdf_engine, '_engines', {})
+    monkeypatch.setitem(pdf_engine.PDF_ENGINES, 'pypdf2', not_installed)
+    settings.PDF_ENGINE = 'pypdf2'
+    with pytest.raises(ImproperlyConfigured):
+        pdf_engine.get_pdf_engine()
+    settings.PDF_ENGINE = ''
+    assert pdf_engine.get_pdf_engine().name == 'pymupdf'
+
+
+def test_tiff_export_word_alignment(monkeypatch):
+    import struct, zlib
+    from pdf_img_handler import page_export
+
+    # 2x2 pages, stored (odd length) and compressed (even length) deflate strips
+    pixels = [bytes((color * 37 + index * 11) % 256 for index in range(12)) for color in range(3)]
+    strips = [zlib.compress(pixels[0], 0), zlib.compress(pixels[1], 9), zlib.compress(pixels[2], 0)]
+    assert [len(strip) % 2 for strip in strips] == [1, 0, 1]
+    pages = [(page_num, 2, 2, strip) for page_num, strip in enumerate(strips)]
+    monkeypatch.setattr(page_export, 'iter_pages', lambda *args: iter(pages))
+    data = b''.join(page_export.iter_tiff_export('unused.pdf', 72, [0, 1, 2]))
+
+    offsets = []
+    offset = struct.unpack('<I', data[4:8])[0]
+    while offset:
+        offsets.append(offset)
+        entries = struct.unpack('<H', data[offset:offset + 2])[0]
+        offset = struct.unpack('<I', data[offset + 2 + entries * 12:offset + 6 + entries * 12])[0]
+    assert len(offsets) == 3
+    assert all(offset % 2 == 0 for offset in offsets)
+
+    tiff = Image.open(io.BytesIO(data))
+    for frame in range(3):
+        tiff.seek(frame)
+        assert tiff.tobytes() == pixels[frame]
+
+
+def render_job_pages(job_id):
+    # job process of test_isolated_job_render_pool, the in memory test database isn't shared with it
+    pages = list(iter_rendered_pages(os.path.join(os.path.dirname(__file__), 'test.pdf'), dpi=36))
+    if len(pages) != 2:
+        raise SystemExit(1)
+
+
+def render_job_pages_forever(job_id):
+    # job process of test_isolated_job_timeout_kills_render_pool, records its rendering processes then hangs
+    import multiprocessing, time
+    pages = iter_rendered_pages(os.path.join(os.path.dirname(__file__), 'test.pdf'), dpi=36)
+    next(pages)
+    with open(os.environ['RENDER_PIDS_PATH'], 'w') as file:
+        file.write(' '.join(str(process.pid) for process in multiprocessing.active_children()))
+    time.sleep(3600)
+
+
+def is_running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            # a zombie is dead, it only waits to be reaped
+            return file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.django_db
+def test_isolated_job_render_pool(monkeypatch):
+    from pdf_img_handler import jobs
+    from pdf_img_handler.models import ConversionJob, PdfFile
+    # read by the settings of the job process
+    monkeypatch.setenv('PDF_RENDER_WORKERS', '2')
+    monkeypatch.setattr(jobs, 'convert_in_process', render_job_pages)
+    pdf = PdfFile.objects.create(name='test.pdf', location='pdf/test.pdf', page_width=1, page_height=1)
+    job = ConversionJob.objects.create(pdf=pdf, max_attempts=1)
+
+    # the job process may start the page rendering processes
+    assert jobs.process_next_job(isolate=True)
+    job.refresh_from_db()
+    assert job.status == ConversionJob.RUNNING
+    assert job.error == ''
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(not hasattr(os, 'killpg'), reason="process groups are POSIX only")
+def test_isolated_job_timeout_kills_render_pool(monkeypatch, tmp_path):
+    import time
+    from pdf_img_handler import jobs
+    from pdf_img_handler.models import ConversionJob, PdfFile
+    monkeypatch.setenv('PDF_RENDER_WORKERS', '2')
+    monkeypatch.setenv('RENDER_PIDS_PATH', str(tmp_path / 'pids'))
+    monkeypatch.setattr(jobs, 'convert_in_process', render_job_pages_forever)
+    pdf = PdfFile.objects.create(name='test.pdf', location='pdf/test.pdf', page_width=1, page_height=1)
+    job = ConversionJob.objects.create(pdf=pdf, max_attempts=1, timeout=5)
+
+    assert jobs.process_next_job(isolate=True)
+    job.refresh_from_db()
+    assert job.status == ConversionJob.FAILED
+    pids = [int(pid) for pid in (tmp_path / 'pids').read_text().split()]
+    assert len(pids) == 2
+    for _ in range(50):
+        if not any(is_running(pid) for pid in pids):
+            break
+        time.sleep(0.1)
+    assert not any(is_running(pid) for pid in pids)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_iter_rendered_pages(tmp_path, workers):
+    import fitz
+
+    # pages of different sizes come back in page order
+    doc = fitz.open()
+    for width in [100, 200, 300]:
+        doc.new_page(width=width, height=50)
+    pdf_path = str(tmp_path / 'pages.pdf')
+    doc.save(pdf_path)
+
+    pages = list(iter_rendered_pages(pdf_path, dpi=72, workers=workers))
+    assert [(width, height) for width, height, samples in pages] == [(100, 50), (200, 50), (300, 50)]
+    assert all(len(samples) == width * height * 3 for width, height, samples in pages)
+
+
+@pytest.mark.parametrize('engine_name', ['pymupdf', 'pypdf2'])
+def test_document_cache(settings, tmp_path, engine_name):
+    import fitz
+    from pdf_img_handler.documents import DocumentCache, document_cache, get_stored_path
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.PDF_ENGINE = engine_name
+    document_cache.clear()
+
+    doc = fitz.open()
+    doc.new_page(width=100, height=50)
+    pdf_path = str(tmp_path / 'doc.pdf')
+    doc.save(pdf_path)
+    assert get_stored_path(pdf_path) == pdf_path
+    assert get_stored_path(io.BytesIO()) is None
+
+    # a stored file is parsed once, the next reads use the open document
+    stats = document_cache.get_stats()
+    assert ProcessPdf().process_file(pdf_path)['page_sizes'] == [[100, 50, 0, 1]]
+    assert ProcessPdf().process_file(pdf_path)['page_sizes'] == [[100, 50, 0, 1]]
+    assert document_cache.get_stats()['misses'] == stats['misses'] + 1
+    assert document_cache.get_stats()['hits'] == stats['hits'] + 1
+
+    # a changed file is read again
+    doc.new_page(width=200, height=50)
+    doc.save(str(tmp_path / 'other.pdf'))
+    (tmp_path / 'other.pdf').replace(pdf_path)
+    assert ProcessPdf().process_file(pdf_path)['pages_number'] == 2
+
+    image_path = str(tmp_path / 'image.png')
+    Image.new('RGB', (12, 34)).save(image_path)
+    assert ProcessImage().process_file(image_path) == {'width': 12, 'height': 34, 'channels_number': 3, 'dhash': 0}
+    assert ProcessImage().process_file(image_path) == {'width': 12, 'height': 34, 'channels_number': 3, 'dhash': 0}
+    assert document_cache.get_stats()['hits'] == stats['hits'] + 2
+
+    # evicted beyond the estimated memory, the most recent entry is kept
+    cache = DocumentCache(max_count=10, max_memory=1)
+    with cache.open(pdf_path, engine_name):
+        pass
+    cache.get_header_info(image_path, ProcessImage().read_path)
+    assert cache.get_stats()['entries'] == 1
+    assert cache.get_stats()['evictions'] == 1
+
+
+@pytest.mark.django_db
+def test_benchmark_smoke(settings, tmp_path):
+    from pdf_img_handler.benchmark import BENCHMARKS, generate_corpus, run_benchmarks
+    settings.MEDIA_ROOT = str(tmp_path / 'media')
+
+    corpus = generate_corpus(str(tmp_path / 'corpus'), 'smoke', seed=1)
+    # the same seed generates the same files
+    again = generate_corpus(str(tmp_path / 'again'), 'smoke', seed=1)
+    with open(corpus['images'][-1], 'rb') as file, open(again['images'][-1], 'rb') as other:
+        assert file.read() == other.read()
+
+    results = run_benchmarks(corpus, 'smoke')
+    assert [result['name'] for result in results] == list(BENCHMARKS)
+    for result in results:
+        assert result['count'] > 0
+        assert result['latency_ms']['p50'] <= result['latency_ms']['p99'] <= result['latency_ms']['max']
+        assert result['peak_rss_bytes'] > 0
+
+
+@pytest.fixture
+def archive(tmp_path):
+    import fitz
+    root = tmp_path / 'archive'
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'c').mkdir()
+    Image.new('RGB', (30, 20)).save(root / 'a' / 'one.png')
+    Image.new('L', (10, 40)).save(root / 'a' / 'b' / 'two.jpg')
+    # same content as one.png, stored once
+    Image.new('RGB', (30, 20)).save(root / 'c' / 'copy.png')
+    (root / 'c' / 'notes.txt').write_text('not an image')
+    doc = fitz.open()
+    doc.new_page(width=100, height=200)
+    doc.save(str(root / 'doc.pdf'))
+    return root
+
+
+def test_iter_files_resume(archive):
+    from pdf_img_handler.ingest import iter_files
+    paths = list(iter_files(str(archive)))
+    assert paths == ['a/b/two.jpg', 'a/one.png', 'c/copy.png', 'c/notes.txt', 'doc.pdf']
+    assert list(iter_files(str(archive), after='a/one.png')) == paths[2:]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('workers', [1, 2])
+def test_ingest_resumes(archive, settings, tmp_path, workers, monkeypatch):
+    import os
+    from pdf_img_handler.ingest import Ingest
+    from pdf_img_handler.models import ImgFile, PdfFile, Tombstone
+    settings.MEDIA_ROOT = str(tmp_path / 'media')
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(checkpoint, files_per_second):
+        raise Interrupted
+
+    # the rows of the first batch can't be inserted, its copies are buried
+    def failing_bulk_create(*args, **kwargs):
+        raise Interrupted
+    with monkeypatch.context() as patch:
+        patch.setattr(ImgFile.objects, 'bulk_create', failing_bulk_create)
+        with pytest.raises(Interrupted):
+            Ingest(str(archive), workers=workers, batch_size=2).run()
+    buried = set(Tombstone.objects.values_list('location', flat=True))
+    assert len(buried) == 2
+    assert not ImgFile.objects.exists()
+
+    # interrupted after the first batch
+    with pytest.raises(Interrupted):
+        Ingest(str(archive), workers=workers, batch_size=2, report=interrupt).run()
+    assert ImgFile.objects.count() == 2
+
+    checkpoint = Ingest(str(archive), workers=workers, batch_size=2, index_text=True).run()
+    assert (checkpoint.files_count, checkpoint.created_count, checkpoint.skipped_count) == (5, 4, 1)
+    assert ImgFile.objects.count() == 3
+    assert PdfFile.objects.get().pages_number == 1
+    assert PdfFile.objects.get().text_indexed
+    one, copy = ImgFile.objects.filter(name__in=['one.png', 'copy.png']).order_by('name')
+    assert one.location.name == copy.location.name
+    assert (copy.width, copy.height) == (30, 20)
+    # the files copied before a checkpoint are reused, not copied again under another name
+    locations = set(ImgFile.objects.values_list('location', flat=True))
+    assert buried <= locations
+    assert sorted(os.listdir(tmp_path / 'media' / 'img')) == sorted(os.path.basename(location) for location in locations)
+
+    # nothing left to ingest
+    assert Ingest(str(archive), workers=workers).run().created_count == 4
+    assert ImgFile.objects.count() == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('workers', [1, 2])
+def test_backfill_metadata(settings, tmp_path, workers):
+    from pdf_img_handler.backfill import Backfill, find_dangling_rows, find_orphaned_files
+    from pdf_img_handler.models import ImgFile
+    settings.MEDIA_ROOT = str(tmp_path)
+    (tmp_path / 'img').mkdir()
+    Image.new('RGBA', (30, 20)).save(tmp_path / 'img' / 'stale.png')
+    Image.new('L', (5, 5)).save(tmp_path / 'img' / 'orphan.png')
+
+    # metadata of an older extractor, and a current row which is not touched
+    stale = ImgFile.objects.create(name='stale', location='img/stale.png', width=1, height=1, channels_number=3)
+    current = ImgFile.objects.create(name='current', location='img/stale.png', width=2, height=2, channels_number=3,
+                                     extractor_version=ProcessImage.version)
+    missing = ImgFile.objects.create(name='missing', location='img/missing.png')
+
+    backfill = Backfill(workers=workers, chunk_size=1)
+    assert backfill.run() == {'img': 1, 'pdf': 0}
+    stale.refresh_from_db()
+    assert (stale.width, stale.height, stale.channels_number, stale.extractor_version) == (30, 20, 4, ProcessImage.version)
+    current.refresh_from_db()
+    assert current.width == 2
+    assert [(row_id, error) for name, row_id, location, error in backfill.errors] == [(missing.id, "File not found.")]
+
+    assert list(find_dangling_rows()) == [('img', missing.id, 'img/missing.png')]
+    assert list(find_orphaned_files(min_age=0)) == ['img/orphan.png']
+    assert list(find_orphaned_files()) == []
+
+
+@pytest.mark.django_db
+def test_delete_orphans(settings, tmp_path):
+    from django.core.management import call_command
+    from pdf_img_handler.models import ImgFile, PdfFile, Tombstone
+    from pdf_img_handler.reaper import Reaper
+    settings.MEDIA_ROOT = str(tmp_path)
+    ImgFile.objects.create(name='kept', location='img/kept.png')
+    pdf = PdfFile.objects.create(name='pdf', location='pdf/test.pdf', page_width=1, page_height=1)
+    # the conversion of a deleted PDF and a temporary file left by a conversion
+    for name in ['img/orphan.png', 'img/kept.png', f'pdf_images/{pdf.id}.png', f'pdf_images/{pdf.id + 1}.png', 'pdf_images/tmpabc']:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(b'data')
+
+    call_command('backfill_metadata', '--delete-orphans', '--orphan-min-age=0', stdout=io.StringIO())
+    # the orphans are buried, not deleted
+    buried = set(Tombstone.objects.values_list('location', flat=True))
+    assert buried == {'img/orphan.png', f'pdf_images/{pdf.id + 1}.png', 'pdf_images/tmpabc'}
+    assert (tmp_path / 'img' / 'orphan.png').exists()
+
+    # a row referencing a buried file again keeps it
+    ImgFile.objects.create(name='orphan', location='img/orphan.png')
+    Reaper(grace_period=0).reap()
+    assert (tmp_path / 'img' / 'orphan.png').exists()
+    assert not (tmp_path / 'pdf_images' / 'tmpabc').exists()
+    assert not (tmp_path / 'pdf_images' / f'{pdf.id + 1}.png').exists()
+    assert (tmp_path / 'pdf_images' / f'{pdf.id}.png').exists()
+    assert (tmp_path / 'img' / 'kept.png').exists()
@@ -0,0 +1,728 @@
+import pytest
+import os
+import base64
+import json
+import io
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework.test import APIClient
+from pdf_img_handler.jobs import enqueue_conversion, process_next_job
+from pdf_img_handler.models import ImgFile, PdfFile, ConversionJob, CachedFile, Tombstone
+from pdf_img_handler.reaper import Reaper
+from pdf_img_handler.utils import ProcessFileData
+
+test_path = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    # keep uploaded files out of the project media directory
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.django_db
+def test_stream_upload_raw_body(media_root):
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+
+    client = APIClient()
+    response = client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream')
+    assert response.status_code == 201
+    pdf = PdfFile.objects.get(id=response.data['id'])
+    assert pdf.pages_number > 0
+    assert pdf.location.name.endswith('.pdf')
+
+
+@pytest.mark.django_db
+def test_stream_upload_multipart(media_root):
+    with open(os.path.join(test_path, 'test.webp'), 'rb') as file:
+        upload = SimpleUploadedFile('anything.bin', file.read())
+
+    client = APIClient()
+    response = client.post('/api/upload/stream/', data={'file': upload}, format='multipart')
+    assert response.status_code == 201
+    img = ImgFile.objects.get(id=response.data['id'])
+    assert img.width and img.height
+    assert img.location.name.endswith('.webp')
+
+
+@pytest.mark.django_db
+def test_stream_upload_rejects_large_and_unsupported(media_root, settings):
+    client = APIClient()
+    response = client.post('/api/upload/stream/', data=b'just some text', content_type='application/octet-stream')
+    assert response.status_code == 400
+
+    settings.FILE_UPLOAD_MAX_SIZE = 10
+    response = client.post('/api/upload/stream/', data=b'x' * 100, content_type='application/octet-stream')
+    assert response.status_code == 413
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('path, field', [('/api/upload/stream/', 'file'), ('/api/upload/batch/', 'files')])
+def test_multipart_upload_size_read(media_root, settings, path, field):
+    from django.test import RequestFactory
+    from django.urls import resolve
+    settings.FILE_UPLOAD_MAX_SIZE = 100
+    # a chunked body, its size isn't declared (the server gives no or a wrong Content-Length)
+    request = RequestFactory().post(path, data={field: SimpleUploadedFile('big.pdf', b'x' * 1000)})
+    request.META['CONTENT_LENGTH'] = '50'
+    response = resolve(path).func(request)
+    assert response.status_code == 413
+
+
+@pytest.mark.django_db(transaction=True)
+def test_upload_deduplicates_content(media_root, monkeypatch):
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+
+    client = APIClient()
+    first = client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream')
+    assert first.status_code == 201
+
+    # the second upload must not be processed again
+    monkeypatch.setattr(ProcessFileData, 'get_file_data', lambda self: pytest.fail('file processed again'))
+    second = client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream')
+    assert second.status_code == 201
+
+    first_pdf = PdfFile.objects.get(id=first.data['id'])
+    second_pdf = PdfFile.objects.get(id=second.data['id'])
+    assert first_pdf.id != second_pdf.id
+    assert first_pdf.location.name == second_pdf.location.name
+    assert first_pdf.get_meta_data() == second_pdf.get_meta_data()
+    assert first_pdf.get_references_count() == 2
+
+    # the stored file is kept while another row references it
+    path = first_pdf.location.path
+    first_pdf.delete()
+    assert os.path.exists(path)
+    second_pdf.delete()
+    # then removed by the reaper, after the grace period
+    Reaper(grace_period=0).reap()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_convert_pdf_job(media_root, settings):
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+
+    client = APIClient()
+    upload = client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream')
+
+    # the conversion is queued, not run in the request
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': upload.data['id']}, format='json')
+    assert response.status_code == 202
+    assert response.data['status'] == ConversionJob.PENDING
+    # the same conversion queued again shares the job
+    queued = client.post('/api/convert-pdf-to-image/', data={'pdf_id': upload.data['id']}, format='json')
+    assert queued.status_code == 202
+    assert queued.data['id'] == response.data['id']
+
+    assert process_next_job(isolate=False) is True
+    assert process_next_job(isolate=False) is False
+
+    job = client.get(f"/api/jobs/{response.data['id']}/").data
+    assert job['status'] == ConversionJob.DONE
+    assert job['progress'] == 100
+    assert job['image_path'].endswith('.png')
+    image_path = os.path.join(media_root, job['image_path'][len(settings.MEDIA_URL):])
+    assert os.path.exists(image_path)
+
+    # the same conversion is served from the cache, a different one is queued
+    cached = client.post('/api/convert-pdf-to-image/', data={'pdf_id': upload.data['id']}, format='json')
+    assert cached.status_code == 200
+    assert cached.data['status'] == ConversionJob.DONE
+    assert cached.data['image_path'] == job['image_path']
+    other = client.post('/api/convert-pdf-to-image/', data={'pdf_id': upload.data['id'], 'dpi': 72, 'last_page': 1}, format='json')
+    assert other.status_code == 202
+    assert other.data['status'] == ConversionJob.PENDING
+    invalid = client.post('/api/convert-pdf-to-image/', data={'pdf_id': upload.data['id'], 'first_page': 3}, format='json')
+    assert invalid.status_code == 400
+
+    # the cached conversions are deleted with their source
+    PdfFile.objects.get(id=upload.data['id']).delete()
+    assert not CachedFile.objects.exists()
+
+
+@pytest.mark.django_db
+def test_convert_pdf_job_retries(media_root, settings):
+    pdf = PdfFile.objects.create(name='missing.pdf', location='pdf/missing.pdf', page_width=1, page_height=1)
+    job = enqueue_conversion(pdf)
+
+    # a failed attempt is retried after a delay, with the error of the conversion
+    assert process_next_job(isolate=False)
+    job.refresh_from_db()
+    assert job.status == ConversionJob.PENDING
+    assert 'missing.pdf' in job.error
+    assert process_next_job(isolate=False) is False
+
+    # every attempt fails on the missing file, until there are no attempts left
+    settings.CONVERSION_JOB_RETRY_DELAY = 0
+    ConversionJob.objects.filter(id=job.id).update(not_before=None)
+    while process_next_job(isolate=False):
+        pass
+
+    job.refresh_from_db()
+    assert job.status == ConversionJob.FAILED
+    assert job.attempts == job.max_attempts
+
+
+@pytest.mark.django_db
+def test_convert_pdf_job_timeout(media_root, monkeypatch):
+    import time
+    from pdf_img_handler import jobs
+    pdf = PdfFile.objects.create(name='slow.pdf', location='pdf/slow.pdf', page_width=1, page_height=1)
+    # the job process sleeps for job id seconds, longer than the job timeout
+    monkeypatch.setattr(jobs, 'convert_in_process', time.sleep)
+    job = ConversionJob.objects.create(id=3600, pdf=pdf, timeout=1, max_attempts=1)
+
+    start = time.monotonic()
+    assert process_next_job(isolate=True)
+    assert time.monotonic() - start < 30
+    job.refresh_from_db()
+    assert job.status == ConversionJob.FAILED
+    assert job.error == "Conversion timed out after 1 seconds."
+
+
+@pytest.mark.django_db(transaction=True)
+def test_requeue_stale_jobs(media_root):
+    import time
+    from datetime import timedelta
+    from django.utils import timezone
+    from pdf_img_handler.jobs import JobWorkerPool
+    pdf = PdfFile.objects.create(name='stale.pdf', location='pdf/stale.pdf', page_width=1, page_height=1)
+    job = ConversionJob.objects.create(pdf=pdf, status=ConversionJob.RUNNING, attempts=1, timeout=1,
+                                       started_at=timezone.now() - timedelta(seconds=3))
+
+    # the stale jobs are put back by the pool while it runs
+    pool = JobWorkerPool(workers=1, isolate=False, requeue_interval=0.05)
+    pool.work = lambda: None
+    pool.start()
+    try:
+        for _ in range(100):
+            job.refresh_from_db()
+            if job.status != ConversionJob.RUNNING:
+                break
+            time.sleep(0.05)
+    finally:
+        pool.stop()
+    assert job.status == ConversionJob.PENDING
+    assert job.error == "Worker stopped while running the job."
+
+
+@pytest.mark.django_db
+def test_batch_upload(media_root):
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+    with open(os.path.join(test_path, 'test.webp'), 'rb') as file:
+        img_data = file.read()
+    base64_pdf = base64.b64encode(pdf_data).decode('utf-8')
+    base64_img = base64.b64encode(img_data).decode('utf-8')
+
+    client = APIClient()
+    response = client.post('/api/upload/batch/', data={'files': [base64_img, base64_pdf, 'invalid', base64_img]}, format='json')
+    assert response.status_code == 207
+    results = response.data['results']
+    assert [result['index'] for result in results] == [0, 1, 2, 3]
+    assert 'error' in results[2]
+
+    # the same content is stored once
+    first_img, second_img = ImgFile.objects.get(id=results[0]['id']), ImgFile.objects.get(id=results[3]['id'])
+    assert first_img.location.name == second_img.location.name
+    assert first_img.width == second_img.width == 1920
+    assert PdfFile.objects.get(id=results[1]['id']).pages_number > 0
+
+    uploads = [SimpleUploadedFile('a', img_data), SimpleUploadedFile('b', pdf_data)]
+    response = client.post('/api/upload/batch/', data={'files': uploads}, format='multipart')
+    assert response.status_code == 201
+    assert ImgFile.objects.count() == 3
+    assert PdfFile.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_batch_upload_failures(media_root, monkeypatch):
+    from pdf_img_handler.api.serializers import BatchFileUploadSerializer
+    from PIL import Image
+    client = APIClient()
+
+    def new_image(color):
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), color).save(buffer, 'PNG')
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    # every copy of a file which couldn't be stored gets its error
+    def store_file(self, file, file_processor):
+        raise ValueError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(BatchFileUploadSerializer, 'store_file', store_file)
+        results = client.post('/api/upload/batch/', data={'files': [new_image('red')] * 2}, format='json').data['results']
+    assert results[0]['error'] == results[1]['error'] == "Error processing file: disk full"
+
+    # the blobs of a batch which couldn't be inserted are buried
+    def bulk_create(*args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(ImgFile.objects, 'bulk_create', bulk_create)
+    with pytest.raises(RuntimeError):
+        client.post('/api/upload/batch/', data={'files': [new_image('blue'), new_image('green')]}, format='json')
+    assert Tombstone.objects.count() == 2
+    assert not ImgFile.objects.exists()
+
+
+@pytest.mark.django_db
+def test_list_pagination_and_filters():
+    for index in range(5):
+        ImgFile.objects.create(name=f'img{index}', location=f'img/{index}.png', width=100 * (index + 1), height=50, channels_number=3)
+
+    client = APIClient()
+    names = []
+    url = '/api/images/?page_size=2'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.data['results']) <= 2
+        names += [result['name'] for result in response.data['results']]
+        url = response.data['next']
+    # newest first, every row once
+    assert names == ['img4', 'img3', 'img2', 'img1', 'img0']
+
+    response = client.get('/api/images/?min_width=200&max_width=400&channels_number=3')
+    assert [result['name'] for result in response.data['results']] == ['img3', 'img2', 'img1']
+    assert client.get('/api/images/?min_width=abc').status_code == 400
+    assert client.get('/api/images/?cursor=abc').status_code == 404
+    assert client.get('/api/pdfs/?min_pages_number=1').data == {'next': None, 'results': []}
+
+
+@pytest.mark.django_db
+def test_thumbnails(media_root, monkeypatch):
+    from PIL import Image
+    client = APIClient()
+    with open(os.path.join(test_path, 'test.webp'), 'rb') as file:
+        img = client.post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream').data
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf = client.post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream').data
+
+    response = client.get(f"/api/images/{img['id']}/thumbnail/?w=160&h=160&format=png")
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'image/png'
+    thumbnail = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+    assert thumbnail.size == (160, 90)
+
+    # later requests are served from the cache
+    monkeypatch.setattr('pdf_img_handler.thumbnails.render_image_thumbnail', lambda *args: pytest.fail('rendered again'))
+    assert client.get(f"/api/images/{img['id']}/thumbnail/?w=160&h=160&format=png").status_code == 200
+
+    response = client.get(f"/api/pdfs/{pdf['id']}/pages/2/thumbnail/?h=100")
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'image/jpeg'
+    assert Image.open(io.BytesIO(b''.join(response.streaming_content))).height == 100
+
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/3/thumbnail/").status_code == 404
+    # rows without a stored page count are checked on the document
+    PdfFile.objects.filter(id=pdf['id']).update(pages_number=None)
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/3/thumbnail/").status_code == 404
+    assert client.get(f"/api/images/{img['id']}/thumbnail/?format=gif").status_code == 400
+
+
+@pytest.mark.django_db
+def test_media_conditional_and_range_requests(media_root, settings):
+    client = APIClient()
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+    pdf = PdfFile.objects.get(id=client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream').data['id'])
+    url = f'/media/{pdf.location.name}'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content) == pdf_data
+    # stored under its content hash, so the ETag is the hash
+    assert response['ETag'] == f'"{pdf.content_hash}"'
+    assert 'immutable' in response['Cache-Control']
+
+    assert client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+    assert client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code == 304
+
+    response = client.get(url, HTTP_RANGE='bytes=10-19')
+    assert response.status_code == 206
+    assert response['Content-Range'] == f'bytes 10-19/{len(pdf_data)}'
+    assert b''.join(response.streaming_content) == pdf_data[10:20]
+    response = client.get(url, HTTP_RANGE='bytes=-5')
+    assert b''.join(response.streaming_content) == pdf_data[-5:]
+    # a range of another version of the file sends the whole file
+    assert client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"').status_code == 200
+    assert client.get(url, HTTP_RANGE=f'bytes={len(pdf_data)}-').status_code == 416
+
+    assert client.get('/media/../settings.py').status_code == 404
+    assert client.get('/media/missing.pdf').status_code == 404
+
+    settings.MEDIA_SENDFILE = 'x-accel-redirect'
+    response = client.get(url)
+    assert response['X-Accel-Redirect'] == f'/protected-media/{pdf.location.name}'
+    assert not response.content
+
+
+@pytest.mark.django_db
+def test_media_etag_of_legacy_names(media_root):
+    (media_root / 'img').mkdir()
+    (media_root / 'img' / 'legacy.png').write_bytes(b'legacy')
+    (media_root / 'img' / 'unknown.png').write_bytes(b'unknown')
+    ImgFile.objects.create(name='legacy', location='img/legacy.png', content_hash='a' * 64)
+    client = APIClient()
+
+    # a row gives the content hash of an original uploaded before the hashed names
+    response = client.get('/media/img/legacy.png')
+    assert response['ETag'] == f'"{"a" * 64}"'
+    assert 'immutable' not in response['Cache-Control']
+    assert client.get('/media/img/legacy.png', HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+    assert client.get('/media/img/unknown.png')['ETag'].startswith('W/"')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_upload_view(media_root):
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncRequestFactory
+    from pdf_img_handler.api.asgi import offload
+    from pdf_img_handler.api.views import FileStreamUploadView
+
+    view = offload(FileStreamUploadView.as_view())
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        request = AsyncRequestFactory().post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream')
+
+    response = async_to_sync(view)(request)
+    assert response.status_code == 201
+    assert PdfFile.objects.get(id=json.loads(response.content)['id']).pages_number > 0
+
+
+def test_asgi_body_size_limit(settings):
+    from asgiref.sync import async_to_sync
+    from pdf_img_handler.api.asgi import LimitBodySize
+    settings.FILE_UPLOAD_MAX_SIZE = 10
+
+    async def app(scope, receive, send):
+        # reads the body like django does, until the end or a disconnect
+        while (await receive())['type'] == 'http.request':
+            pass
+
+    def request(headers, chunks):
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/upload/stream/', 'headers': headers}
+        async_to_sync(LimitBodySize(app))(scope, receive, send)
+        return sent
+
+    assert request([(b'content-length', b'100')], [])[0]['status'] == 413
+    # chunked body without a declared size
+    assert request([], [b'x' * 6, b'x' * 6])[0]['status'] == 413
+
+
+@pytest.mark.django_db
+def test_metrics(media_root):
+    client = APIClient()
+    with open(os.path.join(test_path, 'test.webp'), 'rb') as file:
+        data = base64.b64encode(file.read()).decode()
+    assert client.post('/api/upload/', data={'file': data}, format='json').status_code == 201
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    metrics = response.content.decode()
+    for stage in ('base64_decode', 'mime_sniff', 'process_img', 'storage_write', 'db_insert'):
+        assert f'pdf_img_handler_stage_duration_seconds_count{{stage="{stage}"}}' in metrics
+    assert 'pdf_img_handler_stage_size_bytes_bucket{stage="base64_decode",le="+Inf"}' in metrics
+
+
+@pytest.mark.django_db(transaction=True)
+def test_delete_reaps_files_kept_by_reuploads(media_root):
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf_data = file.read()
+    client = APIClient()
+    pdf = PdfFile.objects.get(id=client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream').data['id'])
+    path = pdf.location.path
+    converted = media_root / 'pdf_images' / f'{pdf.id}.png'
+    converted.parent.mkdir()
+    converted.write_bytes(b'png')
+
+    assert client.delete(f'/api/pdfs/{pdf.id}/').status_code == 204
+    assert os.path.exists(path)
+    # nothing is reaped before the grace period
+    assert Reaper(grace_period=60).reap() == 0
+
+    # the same content uploaded again before the reaper runs references the buried file
+    reupload = PdfFile.objects.get(id=client.post('/api/upload/stream/', data=pdf_data, content_type='application/octet-stream').data['id'])
+    assert reupload.location.name == pdf.location.name
+
+    Reaper(grace_period=0).reap()
+    assert not Tombstone.objects.exists()
+    assert os.path.exists(path)
+    assert not converted.exists()
+
+
+@pytest.mark.django_db
+def test_reaper_checks_references_before_every_delete(media_root):
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+    from pdf_img_handler.reaper import bury
+    locations = [default_storage.save(f'img/{name}.png', ContentFile(b'png')) for name in 'ab']
+    bury(locations)
+
+    # a row references the second file while the first one is deleted
+    reaper = Reaper(grace_period=0)
+    throttle = reaper.throttle
+    def referencing_throttle():
+        throttle()
+        if not ImgFile.objects.exists():
+            ImgFile.objects.create(name='b', location=locations[1], width=1, height=1, channels_number=3)
+    reaper.throttle = referencing_throttle
+
+    assert reaper.reap() == 2
+    assert not default_storage.exists(locations[0])
+    assert default_storage.exists(locations[1])
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('workers', [1, 2])
+def test_convert_pdf_streamed_exports(media_root, settings, workers):
+    import zipfile
+    from PIL import Image
+    settings.PDF_RENDER_WORKERS = workers
+    client = APIClient()
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf = client.post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream').data
+
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'zip', 'image_format': 'jpeg', 'dpi': 36}, format='json')
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+    assert archive.namelist() == ['page-0001.jpeg', 'page-0002.jpeg']
+    assert Image.open(archive.open('page-0002.jpeg')).format == 'JPEG'
+
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'tiff', 'dpi': 36, 'first_page': 2}, format='json')
+    assert response['Content-Type'] == 'image/tiff'
+    tiff = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+    assert tiff.n_frames == 1
+    assert tiff.info['dpi'] == (36, 36)
+    tiff.load()
+
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'tiff', 'dpi': 36}, format='json')
+    tiff = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+    assert tiff.n_frames == 2
+
+    # rows without a stored page count use the count of the document
+    PdfFile.objects.filter(id=pdf['id']).update(pages_number=None)
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'zip', 'dpi': 36, 'first_page': 2}, format='json')
+    assert zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist() == ['page-0002.png']
+    response = client.post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'zip', 'first_page': 3}, format='json')
+    assert response.status_code == 400
+    tiff.seek(1)
+    tiff.load()
+    assert tiff.mode == 'RGB'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_streamed_export(media_root, monkeypatch):
+    import warnings, zipfile
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncRequestFactory
+    from pdf_img_handler import page_export
+    from pdf_img_handler.api.asgi import offload
+    from pdf_img_handler.api.views import ConvertPdfToSingleImage
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf = APIClient().post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream').data
+
+    rendered = []
+    iter_pages = page_export.iter_pages
+    def tracked_iter_pages(*args):
+        for page in iter_pages(*args):
+            rendered.append(page[0])
+            yield page
+    monkeypatch.setattr(page_export, 'iter_pages', tracked_iter_pages)
+
+    view = offload(ConvertPdfToSingleImage.as_view())
+    request = AsyncRequestFactory().post('/api/convert-pdf-to-image/', data={'pdf_id': pdf['id'], 'output': 'zip', 'dpi': 36}, content_type='application/json')
+
+    async def read():
+        response = await view(request)
+        assert response.is_async
+        chunks = []
+        async for chunk in response:
+            # the first page is sent before the next one is rendered
+            chunks.append((chunk, list(rendered)))
+        return chunks
+
+    with warnings.catch_warnings():
+        # django warns when it reads a sync stream in full
+        warnings.filterwarnings('error', message='StreamingHttpResponse must consume')
+        chunks = async_to_sync(read)()
+    assert chunks[0][1] == [0]
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunk for chunk, pages in chunks)))
+    assert archive.namelist() == ['page-0001.png', 'page-0002.png']
+
+
+@pytest.mark.django_db
+def test_pdf_page_tiles(media_root, monkeypatch):
+    from PIL import Image
+    from pdf_img_handler.documents import document_cache
+    client = APIClient()
+    with open(os.path.join(test_path, 'test.pdf'), 'rb') as file:
+        pdf = client.post('/api/upload/stream/', data=file.read(), content_type='application/octet-stream').data
+
+    info = client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/").data
+    assert info['tile_size'] == 256
+    assert info['levels'][0]['columns'] == info['levels'][0]['rows'] == 1
+    deepest = info['levels'][-1]
+
+    response = client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/0/0/0/?format=png")
+    assert response.status_code == 200
+    assert max(Image.open(io.BytesIO(b''.join(response.streaming_content))).size) == 256
+
+    # edge tiles only hold the rest of the page
+    x, y = deepest['columns'] - 1, deepest['rows'] - 1
+    response = client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/{info['max_zoom']}/{x}/{y}/")
+    assert response['Content-Type'] == 'image/jpeg'
+    assert Image.open(io.BytesIO(b''.join(response.streaming_content))).size == (deepest['width'] - x * 256, deepest['height'] - y * 256)
+
+    # cached tiles are not rendered again
+    monkeypatch.setattr('pdf_img_handler.tiles.render_tile', lambda *args: pytest.fail('rendered again'))
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/0/0/0/?format=png").status_code == 200
+
+    monkeypatch.undo()
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/0/1/0/").status_code == 404
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/{info['max_zoom'] + 1}/0/0/").status_code == 404
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/3/tiles/0/0/0/").status_code == 404
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/3/tiles/").status_code == 404
+    assert len(document_cache.entries) >= 1
+
+
+@pytest.mark.django_db
+def test_pdf_page_tiles_crop_box(media_root):
+    import fitz
+    client = APIClient()
+    # the MediaBox is twice as wide as the CropBox shown by the viewers
+    doc = fitz.open()
+    page = doc.new_page(width=1000, height=500)
+    page.set_cropbox(fitz.Rect(0, 0, 500, 500))
+    pdf = client.post('/api/upload/stream/', data=doc.tobytes(), content_type='application/octet-stream').data
+
+    info = client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/").data
+    level = info['levels'][1]
+    assert (level['width'], level['height'], level['columns'], level['rows']) == (512, 512, 2, 2)
+    # every tile of the grid is on the rendered page
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/1/1/1/").status_code == 200
+    assert client.get(f"/api/pdfs/{pdf['id']}/pages/1/tiles/1/2/0/").status_code == 404
+
+
+@pytest.mark.django_db
+def test_pdf_text_search(media_root):
+    import fitz
+    from pdf_img_handler.search import TextIndexer
+
+    doc = fitz.open()
+    for text in ['Quarterly report of the <pipeline>', 'Nothing to see here', 'Pipelines and reports']:
+        doc.new_page().insert_text((72, 72), text)
+    client = APIClient()
+    pdf_ids = []
+    # the second upload has the same content, its text is copied
+    for name in ['report.pdf', 'copy.pdf']:
+        response = client.post('/api/upload/stream/', data=doc.tobytes(), content_type='application/octet-stream', HTTP_CONTENT_DISPOSITION=f'attachment; filename="{name}"')
+        assert response.status_code == 201
+        pdf_ids.append(response.data['id'])
+
+    # PDFs are searchable once indexed
+    assert client.get('/api/pdfs/search/', {'q': 'report'}).data['results'] == []
+    indexer = TextIndexer()
+    assert indexer.index() == 2
+    assert not indexer.errors
+    assert PdfFile.objects.filter(text_indexed=True).count() == 2
+
+    results = client.get('/api/pdfs/search/', {'q': 'quarterly report'}).data['results']
+    assert sorted((hit['id'], hit['page']) for hit in results) == [(pdf_ids[0], 1), (pdf_ids[1], 1)]
+    # the page text is escaped, the matches are marked
+    assert '<mark>Quarterly</mark> <mark>report</mark> of the &lt;pipeline&gt;' in results[0]['snippet']
+
+    # prefix terms, FTS5 syntax is matched as text
+    results = client.get('/api/pdfs/search/', {'q': 'pipe*', 'limit': 10}).data['results']
+    assert sorted(hit['page'] for hit in results) == [1, 1, 3, 3]
+    assert client.get('/api/pdfs/search/', {'q': 'report" OR "nothing'}).data['results'] == []
+    assert client.get('/api/pdfs/search/', {'q': 'NEAR('}).status_code == 200
+    assert client.get('/api/pdfs/search/').status_code == 400
+
+    # the text of a deleted PDF is removed
+    assert client.delete(f'/api/pdfs/{pdf_ids[0]}/').status_code == 204
+    results = client.get('/api/pdfs/search/', {'q': 'nothing'}).data['results']
+    assert [(hit['id'], hit['page']) for hit in results] == [(pdf_ids[1], 2)]
+
+
+@pytest.mark.django_db
+def test_similar_images_and_near_duplicate_uploads(media_root):
+    from PIL import Image
+    from django.utils import timezone
+    from pdf_img_handler.image_hash import image_hash_index
+    image_hash_index.clear()
+
+    def encode(image, image_format, **options):
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **options)
+        return buffer.getvalue()
+
+    image = Image.effect_mandelbrot((300, 200), (-2, -1, 1, 1), 100).convert('RGB')
+    client = APIClient()
+    original = client.post('/api/upload/stream/', data=encode(image, 'PNG'), content_type='application/octet-stream').data['id']
+    other = client.post('/api/upload/stream/', data=encode(Image.radial_gradient('L'), 'PNG'), content_type='application/octet-stream').data['id']
+
+    # a resized and recompressed copy is refused when asked, and found as similar once stored
+    copy_data = encode(image.resize((150, 100)), 'JPEG', quality=60)
+    response = client.post('/api/upload/stream/?reject_near_duplicates=1', data=copy_data, content_type='application/octet-stream')
+    assert response.status_code == 400
+    assert str(original) in str(response.data)
+    response = client.post('/api/upload/', {'file': base64.b64encode(copy_data).decode(), 'reject_near_duplicates': True}, format='json')
+    assert response.status_code == 400
+    copy = client.post('/api/upload/stream/', data=copy_data, content_type='application/octet-stream').data['id']
+
+    results = client.get(f'/api/images/{original}/similar/').data['results']
+    assert [result['id'] for result in results] == [copy]
+    assert results[0]['distance'] <= 10
+    assert client.get(f'/api/images/{original}/similar/', {'max_distance': 64}).status_code == 400
+
+    # deleted and changed images leave the results
+    assert client.delete(f'/api/images/{copy}/').status_code == 204
+    assert client.get(f'/api/images/{original}/similar/').data['results'] == []
+    ImgFile.objects.filter(id=other).update(dhash=ImgFile.objects.get(id=original).dhash, updated_at=timezone.now())
+    assert [result['id'] for result in client.get(f'/api/images/{original}/similar/').data['results']] == [other]
+
+
+@pytest.mark.django_db
+def test_similar_images_after_deletes():
+    from pdf_img_handler.image_hash import find_similar_images, image_hash_index
+    image_hash_index.clear()
+    # the closest images are deleted once the index is loaded
+    closest = [ImgFile.objects.create(name=f'{index}', location=f'img/{index}.png', width=1, height=1, channels_number=3, dhash=0) for index in range(10)]
+    farther = ImgFile.objects.create(name='far', location='img/far.png', width=1, height=1, channels_number=3, dhash=1)
+    assert len(find_similar_images(0, 5, limit=1)) == 1
+    ImgFile.objects.filter(id__in=[img_file.id for img_file in closest]).delete()
+
+    assert find_similar_images(0, 5, limit=1) == [(farther, 1)]
+    assert image_hash_index.search(0, 5) == [(farther.id, 1)]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_similar_images_order(monkeypatch, use_numpy):
+    from pdf_img_handler import image_hash
+    if not use_numpy:
+        monkeypatch.setattr(image_hash, 'numpy', None)
+    image_hash.image_hash_index.clear()
+    ids = [ImgFile.objects.create(name=f'{dhash}', location=f'img/{dhash}.png', width=1, height=1, channels_number=3, dhash=dhash).id for dhash in [7, 1, 0, 2, 3]]
+
+    # closest first, then in id order
+    expected = [(ids[2], 0), (ids[1], 1), (ids[3], 1), (ids[4], 2), (ids[0], 3)]
+    assert image_hash.image_hash_index.search(0, 5) == expected
+    assert image_hash.image_hash_index.search(0, 5, limit=3) == expected[:3]
+    assert image_hash.image_hash_index.search(0, 1, limit=10) == expected[:3]
+    assert [(image.id, distance) for image, distance in image_hash.find_similar_images(0, 5, limit=4, exclude_id=ids[2])] == expected[1:5]
+    image_hash.image_hash_index.clear()
@@ -0,0 +1,103 @@
+import os
+import tempfile
+from PIL import Image
+from .cache import DerivativeCache
+from .documents import document_cache
+from .image_rotation import apply_orientation, get_orientation
+from .pdf_engine import get_pdf_engine
+
+# output format : Pillow format
+THUMBNAIL_FORMATS = {
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP',
+}
+
+THUMBNAIL_CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+thumbnail_cache = DerivativeCache('thumbnails')
+
+
+class PageNotFound(ValueError):
+    pass
+
+
+def save_thumbnail(image, output_path, image_format):
+    if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA')
+
+    # written to a temporary file first, so a thumbnail being rendered is never served
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(output_path), delete=False) as output:
+        image.save(output, THUMBNAIL_FORMATS[image_format])
+    os.replace(output.name, output_path)
+
+
+def render_image_thumbnail(path, size, output_path, image_format):
+    """
+    Render an image thumbnail fitting in `size`.
+    JPEG images are decoded at a reduced scale (draft mode), skipping the full resolution decode.
+    The thumbnail is displayed like the image, with its EXIF orientation applied.
+    """
+    image = Image.open(path)
+    orientation = get_orientation(image)
+    image.draft('RGB', size)
+    image.thumbnail(size)
+    save_thumbnail(apply_orientation(image, orientation), output_path, image_format)
+
+
+def render_pdf_page_thumbnail(path, page_num, size, output_path, image_format):
+    """
+    Render a PDF page thumbnail fitting in `size`, the page is rendered at the thumbnail resolution.
+    Raises PageNotFound when the page is outside of the document.
+    """
+    engine = get_pdf_engine('pymupdf')
+    with document_cache.open(path) as doc:
+        if not 0 <= page_num < doc.page_count:
+            raise PageNotFound("Page not found.")
+        page = doc.load_page(page_num)
+        zoom = min(size[0] / page.rect.width, size[1] / page.rect.height)
+        pix = page.get_pixmap(matrix=engine.fitz.Matrix(zoom, zoom))
+        image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    save_thumbnail(image, output_path, image_format)
+
+
+def get_cached_thumbnail(source_key, params, image_format, render, cache=thumbnail_cache):
+    """
+    Get the cached thumbnail of a source, `render(output_path)` renders it on a cache miss.
+    """
+    key = cache.get_key(source_key, *params, image_format)
+    cached_file = cache.get(key)
+    if cached_file:
+        return cached_file
+
+    name = cache.get_name(key, image_format)
+    output_path = cache.get_path(name)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    render(output_path)
+    return cache.add(key, source_key, name)
+
+
+def get_image_thumbnail(img_file, width, height, image_format='jpeg'):
+    """
+    Get the cached thumbnail of an ImgFile, rendered on the first request.
+    """
+    return get_cached_thumbnail(
+        img_file.source_key, ('image', width, height), image_format,
+        lambda output_path: render_image_thumbnail(img_file.location.path, (width, height), output_path, image_format),
+    )
+
+
+def get_pdf_page_thumbnail(pdf_file, page_number, width, height, image_format='jpeg'):
+    """
+    Get the cached thumbnail of a PdfFile page (1-based), rendered on the first request.
+    """
+    return get_cached_thumbnail(
+        pdf_file.source_key, ('page', page_number, width, height), image_format,
+        lambda output_path: render_pdf_page_thumbnail(pdf_file.location.path, page_number - 1, (width, height), output_path, image_format),
+    )
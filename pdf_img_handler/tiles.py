@@ -0,0 +1,99 @@
+import math
+from PIL import Image
+from .cache import DerivativeCache
+from .documents import document_cache
+from .pdf_engine import get_pdf_engine
+from .thumbnails import get_cached_thumbnail, save_thumbnail
+
+# width and height of a tile in pixels
+TILE_SIZE = 256
+# resolution of the deepest zoom level, at most
+TILE_MAX_DPI = 600
+
+tile_cache = DerivativeCache('tiles')
+
+
+class TileNotFound(ValueError):
+    pass
+
+
+def get_zoom_scale(width, height, zoom):
+    """
+    Pixels per point at a zoom level, the whole page fits in one tile at level 0 and every level doubles it.
+    """
+    return TILE_SIZE * 2 ** zoom / max(width, height)
+
+
+def get_max_zoom(width, height):
+    return max(math.ceil(math.log2(max(width, height) * TILE_MAX_DPI / 72 / TILE_SIZE)), 0)
+
+
+def get_tile_info(width, height):
+    """
+    Get the tile size, the zoom levels and the number of tiles of every level of a page (size in points).
+    """
+    max_zoom = get_max_zoom(width, height)
+    levels = []
+    for zoom in range(max_zoom + 1):
+        scale = get_zoom_scale(width, height, zoom)
+        levels.append({
+            'zoom': zoom,
+            'width': math.ceil(width * scale),
+            'height': math.ceil(height * scale),
+            'columns': math.ceil(width * scale / TILE_SIZE),
+            'rows': math.ceil(height * scale / TILE_SIZE),
+        })
+    return {'tile_size': TILE_SIZE, 'max_zoom': max_zoom, 'levels': levels}
+
+
+def load_page(doc, page_num):
+    if not 0 <= page_num < doc.page_count:
+        raise TileNotFound("Page not found.")
+    return doc.load_page(page_num)
+
+
+def get_page_tile_info(path, page_num):
+    """
+    Get the tile info of a page, from the page as the tiles render it (CropBox, rotated),
+    read from the document kept open by the process.
+    Raises TileNotFound when the page is outside of the document.
+    """
+    with document_cache.open(path) as doc:
+        rect = load_page(doc, page_num).rect
+    return get_tile_info(rect.width, rect.height)
+
+
+def render_tile(path, page_num, zoom, x, y, output_path, image_format):
+    """
+    Render the tile (x, y) of a page at a zoom level: only the clip rectangle of the tile is rendered,
+    from the document kept open by the process.
+    Raises TileNotFound when the tile is outside of the page.
+    """
+    fitz = get_pdf_engine('pymupdf').fitz
+    with document_cache.open(path) as doc:
+        page = load_page(doc, page_num)
+        # the page as displayed (rotated), the clip uses the same coordinates
+        rect = page.rect
+        if zoom > get_max_zoom(rect.width, rect.height):
+            raise TileNotFound("Zoom level not found.")
+
+        scale = get_zoom_scale(rect.width, rect.height, zoom)
+        size = TILE_SIZE / scale
+        clip = fitz.Rect(x * size, y * size, (x + 1) * size, (y + 1) * size) & rect
+        if clip.is_empty:
+            raise TileNotFound("Tile not found.")
+
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip)
+        image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    save_thumbnail(image, output_path, image_format)
+
+
+def get_pdf_tile(pdf_file, page_number, zoom, x, y, image_format='jpeg'):
+    """
+    Get the cached tile of a PdfFile page (1-based), rendered on the first request.
+    """
+    return get_cached_thumbnail(
+        pdf_file.source_key, ('tile', page_number, zoom, x, y), image_format,
+        lambda output_path: render_tile(pdf_file.location.path, page_number - 1, zoom, x, y, output_path, image_format),
+        cache=tile_cache,
+    )
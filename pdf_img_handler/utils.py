@@ -1,56 +1,204 @@
 from PIL import Image
-import PyPDF2, os
+import os, base64, binascii, hashlib, tempfile, threading
+import magic
+from .documents import document_cache, get_stored_path
+from .image_hash import get_dhash
+from .image_header import read_image_header
+from .image_rotation import get_orientation, is_transposed
+from .pdf_engine import get_pdf_engine, encode_page_sizes
+from .metrics import measure
+
+# number of bytes from the start of a file used to sniff its MIME type
+MIME_SNIFF_SIZE = 8192
+
+_magic_lock = threading.Lock()
+_magic = None
+
+
+def get_mime_type(buffer):
+    """
+    Sniff the MIME type of a buffer with a libmagic handle built once per process.
+    python-magic serializes calls on the same handle with its own lock.
+    """
+    global _magic
+    if _magic is None:
+        with _magic_lock:
+            if _magic is None:
+                _magic = magic.Magic(mime=True)
+    with measure('mime_sniff', len(buffer)):
+        return _magic.from_buffer(buffer)
+
+
+def iter_base64_decode(data, start=0, first_size=MIME_SNIFF_SIZE, chunk_size=64 * 1024):
+    """
+    Decode a base64 string chunk by chunk, starting at index `start`.
+    The first chunk holds about `first_size` bytes (enough to sniff the type),
+    the next ones about `chunk_size` bytes, so the whole decoded file is never in memory.
+    Raises binascii.Error on invalid base64 data.
+    """
+    carry = ''
+    # sizes in base64 characters, 4 characters for every 3 bytes
+    size = first_size // 3 * 4
+    while start < len(data):
+        # whitespace (line breaks of wrapped base64) is ignored
+        chunk = carry + ''.join(data[start:start + size].split())
+        start += size
+        size = chunk_size // 3 * 4
+
+        # only decode complete 4 character groups, keep the rest for the next chunk
+        cut = len(chunk) - len(chunk) % 4
+        carry = chunk[cut:]
+        if cut:
+            yield base64.b64decode(chunk[:cut], validate=True)
+
+    if carry:
+        raise binascii.Error('Incorrect padding')
+
+
+class SpooledUploadFile(tempfile.SpooledTemporaryFile):
+    """
+    Spooled temporary file of an upload, kept in memory up to `max_size` bytes, then rolled over to a
+    named temporary file, so PDF libraries open a large upload by its path instead of its bytes.
+    """
+    def rollover(self):
+        if self._rolled:
+            return
+        memory_file = self._file
+        self._file = tempfile.NamedTemporaryFile(mode='w+b')
+        position = memory_file.tell()
+        self._file.write(memory_file.getvalue())
+        self._file.seek(position)
+        self._rolled = True
+
+
+def save_content(storage, name, file):
+    """
+    Save a file under its content-addressed name (content hash), or reuse the file already stored under it:
+    a file of a deleted row not reaped yet, or saved by an interrupted run, has the same content.
+    A file of another size (a partial write) is not reused.
+    Returns the name of the stored file.
+    """
+    size = getattr(file, 'size', None)
+    if size is not None and storage.exists(name) and storage.size(name) == size:
+        return name
+    return storage.save(name, file)
+
+
+def get_file_hash(file):
+    """
+    Get the SHA-256 hex digest of a file, read in chunks.
+    The digest computed while the file was received (`content_hash` attribute) is used when there is one.
+    """
+    content_hash = getattr(file, 'content_hash', None)
+    if content_hash:
+        return content_hash
+
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    file.seek(0)
+
+    file.content_hash = sha256.hexdigest()
+    return file.content_hash
+
+
+def get_extension_from_mime(mime_type):
+    """
+    Map a sniffed MIME type to the file extension used to store the file.
+    Returns None when the type is neither an image nor a PDF.
+    """
+    if mime_type.startswith('image'):
+        return mime_type.split('/')[1]  # e.g., 'jpeg', 'png'
+    if mime_type == 'application/pdf':
+        return 'pdf'
+    return None
+
 
 class ProcessImage:
+    # bump when the extracted metadata changes, rows of an older version are recomputed by `manage.py backfill_metadata`
+    version = 4
+
     def process_file(self, file):
         """
-        Process an image to get its width, height, and the number of channels.
-        Returns: width, height, and channels number of the image.
+        Process an image to get its width, height, the number of channels and its perceptual hash.
+        PNG, JPEG and WebP headers are parsed directly, other formats are opened with Pillow.
+        The header of a stored file is parsed once per process (see documents.py).
+        Returns: width, height, channels number and difference hash (see image_hash.py) of the image,
+        the width and height are the displayed ones, with the EXIF orientation applied.
         """
+        path = get_stored_path(file)
+        if path:
+            return dict(document_cache.get_header_info(path, self.read_path))
+        return self.read_file(file)
+
+    def read_path(self, path):
+        with open(path, 'rb') as file:
+            return self.read_file(file)
+
+    def read_file(self, file):
+        meta_info = read_image_header(file)
+
         # Open the image using Pillow
         image = Image.open(file)
 
-        # Get image width and height
-        width, height = image.size
+        if not meta_info:
+            # Get image width and height
+            width, height = image.size
 
-        # Get number of channels (RGB has 3 channels, RGBA has 4 channels)
-        if image.mode in ['RGB', 'RGBA']:
-            channels_number = len(image.getbands())  # RGBA has 4 channels, RGB has 3 channels
-        else:
-            channels_number = 1  # Default to 1 channel for grayscale or others
+            meta_info = {
+                    'width': width, 
+                    'height': height, 
+                    'channels_number': self.get_channels_number(image)
+            }
 
-        return {
-                'width': width, 
-                'height': height, 
-                'channels_number': channels_number
-        }
+        if is_transposed(get_orientation(image)):
+            meta_info['width'], meta_info['height'] = meta_info['height'], meta_info['width']
+
+        # the only step decoding the pixels
+        with measure('image_hash'):
+            meta_info['dhash'] = get_dhash(image)
+        return meta_info
+
+    def get_channels_number(self, image):
+        # a palette image has the channels of its palette (RGB, RGBA with transparency)
+        if image.mode in ['P', 'PA']:
+            return 4 if image.mode == 'PA' or 'transparency' in image.info else 3
+
+        # one channel per band (L has 1, LA has 2, RGB has 3, RGBA and CMYK have 4)
+        return len(image.getbands())
         
 
     
 class ProcessPdf:
+    # bump when the extracted metadata changes, rows of an older version are recomputed by `manage.py backfill_metadata`
+    version = 2
+
     def process_file(self, file):
         """
         Process a PDF file to get the page width, page height, and number of pages.
-        Returns: page width, page height, and the number of pages of the PDF.
+        Every page is read from a single open of the file with the preferred PDF engine,
+        the document of a stored file is kept open by the process (see documents.py).
+        Returns: page width, page height (of the first page), the number of pages of the PDF,
+        and the run-length encoded sizes of all pages.
         """
-        # Initialize PDF reader
-        pdf_reader = PyPDF2.PdfReader(file)
-
-        # Get the number of pages
-        pages_number = len(pdf_reader.pages)
-
-        # Get the first page to extract dimensions
-        first_page = pdf_reader.pages[0]
+        engine = get_pdf_engine()
+        path = get_stored_path(file)
+        if path:
+            with document_cache.open(path, engine.name) as doc:
+                page_sizes = encode_page_sizes(engine.iter_document_pages(doc))
+        else:
+            page_sizes = encode_page_sizes(engine.iter_pages(file))
+        if not page_sizes:
+            raise ValueError("The PDF file has no pages.")
 
-        # Extract page dimensions (media box gives the dimensions)
-        media_box = first_page.mediabox
-        page_width = float(media_box.width)
-        page_height = float(media_box.height)
+        # Extract page dimensions of the first page (media box gives the dimensions)
+        page_width, page_height, rotation, count = page_sizes[0]
 
         return {
                 'page_width':page_width, 
                 'page_height': page_height, 
-                'pages_number':pages_number
+                'pages_number': sum(run[3] for run in page_sizes),
+                'page_sizes': page_sizes,
             }
 
 
@@ -59,35 +207,32 @@ class ProcessFileData:
     """
     Process file data (image or PDF) and return relevant information.
     """
+    # file extension : file type, built once for every file
+    allowed_extensions = {
+        'pdf': 'pdf',
+        'png': 'img',
+        'jpg': 'img',
+        'jpeg': 'img',
+        'webp': 'img',
+        'jpe': 'img',
+        'jif': 'img',
+        'jfif': 'img',
+        'jfi': 'img',
+    }
+    # every file type must use process class
+    allowed_process = {
+        'pdf': ProcessPdf,
+        'img': ProcessImage,
+    }
 
     def __init__(self, file):
         self.file = file
-        self.allowed_extensions = self.get_allowed_extensions()
-        self.allowed_process = self.get_allowed_process()
-
-        
 
     def get_allowed_extensions(self):
-        # file extension : file type
-        return {
-            'pdf': 'pdf',
-            'png': 'img',
-            'jpg': 'img',
-            'jpeg': 'img',
-            'webp': 'img',
-            'jpe': 'img',
-            'jif': 'img',
-            'jpe': 'img',
-            'jfif': 'img',
-            'jfi': 'img',
-        }
+        return self.allowed_extensions
     
     def get_allowed_process(self):
-        # every file type must use process class
-        return {
-            'pdf': ProcessPdf,
-            'img': ProcessImage,
-        }
+        return self.allowed_process
     
     def check_file_support(self):
         # check the file is supported
@@ -116,5 +261,7 @@ class ProcessFileData:
             return None , None
         file_type = self.get_file_type()
         process_class = self.get_process_class(file_type)
-        meta_info = process_class().process_file(self.file)
+        with measure(f'process_{file_type}', getattr(self.file, 'size', None)):
+            meta_info = process_class().process_file(self.file)
+        meta_info = dict(meta_info, extractor_version=process_class.version)
         return file_type , meta_info